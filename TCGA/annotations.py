@@ -1,83 +1,99 @@
 import json
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Optional, Tuple, Union
 
+import numpy
 import pandas
 
 from .constants import CONF
 from .client import get_client
+from .read_vectors import get_roi_region
+from .schema import to_wide_numpy
+
+
+def iter_roi_groups(vector):
+    # yields each ROI with the positions of its rows in the full sequence of vector rows
+    if isinstance(vector, pandas.DataFrame):
+        for roi_name, positions in vector.groupby('roiname', observed=True).indices.items():
+            yield roi_name, vector.iloc[positions], positions
+    else:
+        offset = 0
+        for roi_name, roi_vector in vector:
+            yield roi_name, roi_vector, numpy.arange(offset, offset + len(roi_vector))
+            offset += len(roi_vector)
+
+
+def get_roi_elements(roi_name, roi_vector, roi_meta_vector=None):
+    region = get_roi_region(roi_name)
+    # coordinates are relative to ROI and half resolution
+    centroidX = to_wide_numpy(roi_vector['Unconstrained.Identifier.CentroidX']) * 2 + region.get('left', 0)
+    centroidY = to_wide_numpy(roi_vector['Unconstrained.Identifier.CentroidY']) * 2 + region.get('top', 0)
+    width = to_wide_numpy(roi_vector['Size.MinorAxisLength']) * 2
+    height = to_wide_numpy(roi_vector['Size.MajorAxisLength']) * 2
+    # negated orientation
+    rotation = 0 - to_wide_numpy(roi_vector['Orientation.Orientation'])
+    # json only serializes builtin scalars
+    centroidX, centroidY, width, height, rotation = [
+        values.tolist() for values in (centroidX, centroidY, width, height, rotation)
+    ]
+    metadata = (
+        roi_meta_vector.to_dict(orient='records')
+        if roi_meta_vector is not None
+        else [{}] * len(roi_vector)
+    )
+
+    color = '#00FF00'
+    for i, index in enumerate(roi_vector.index.tolist()):
+        # ObjectCode is not unique; use index instead
+        meta = dict(id=index)
+        meta.update(metadata[i])
+        yield dict(
+            type='ellipse',
+            lineColor=color,
+            lineWidth=2,
+            fillColor=color,
+            center=[centroidX[i], centroidY[i], 0],
+            width=width[i],
+            height=height[i],
+            rotation=rotation[i],
+            user=meta  # adhere to schema; user is unconstrained
+        )
 
 
 def write_annotation(
     filepath: Path,
-    vector: pandas.DataFrame,
+    vector: Union[pandas.DataFrame, Iterable[Tuple[str, pandas.DataFrame]]],
     meta_vector: Optional[pandas.DataFrame],
     name: str = 'TCGA Nuclei'
 ):
-    features = []
+    """
+    Write an annotation with one ellipse element per nucleus.
+    `vector` is either a DataFrame or an iterable of (roi_name, vector) pairs such as
+    `iter_case_rois`, so a whole case can be written one ROI at a time.
+    Rows of `meta_vector` are matched to the rows of `vector` by position.
+    """
     if not filepath.parent.exists():
         filepath.parent.mkdir(parents=True, exist_ok=True)
 
-    # assumes roiname is a string like "TCGA-3C-AALI-01Z-00-DX1_roi-0_left-15953_top-45779_right-18001_bottom-47827"
-    for roi_name, roi_group in vector.groupby('roiname'):
-        components = roi_name.split('_')[2:]
-        region = {}
-        for component in components:
-            key, value = component.split('-')
-            region[key] = int(value)
-        roi_center = [
-            (region.get('right') + region.get('left')) / 2,
-            (region.get('bottom') + region.get('top')) / 2,
-        ]
-        for index, feature in roi_group.iterrows():
-            major, minor, centroidX, centroidY, orientation = [
-                feature['Size.MajorAxisLength'],
-                feature['Size.MinorAxisLength'],
-                feature['Unconstrained.Identifier.CentroidX'],
-                feature['Unconstrained.Identifier.CentroidY'],
-                feature['Orientation.Orientation'],
-            ]
-            # coordinates are relative to ROI and half resolution
-            centroidX *= 2
-            centroidY *= 2
-            centroidX += region.get('left', 0)
-            centroidY += region.get('top', 0)
-
-            color = '#00FF00'
-            meta = dict(
-                # ObjectCode is not unique; use index instead
-                # id=feature['Identifier.ObjectCode']
-                id=index
-            )
-            if meta_vector is not None:
-                metadata = {
-                    k: v if not isinstance(v, dict) else next(iter(v.values()))
-                    for k, v in meta_vector.loc[index].to_dict().items()
-                }
-                meta.update(metadata)
-
-            features.append(dict(
-                type='ellipse',
-                lineColor=color,
-                lineWidth=2,
-                fillColor=color,
-                center=[centroidX, centroidY, 0],
-                width=minor * 2,
-                height=major * 2,
-                rotation=(0 - orientation),  # negated orientation
-                user=meta  # adhere to schema; user is unconstrained
-            ))
-    # export case_features to annotation file
-    annotation = dict(
+    # stream elements to the file instead of holding every element of the case in memory
+    header = json.dumps(dict(
         name=name,
         description="Interpreted from feature vectors",
         display=dict(
             visible=True,
         ),
-        elements=features
-    )
+    ))
     with open(filepath, 'w') as f:
-        json.dump(annotation, f)
+        f.write(header[:-1] + ', "elements": [')
+        first = True
+        for roi_name, roi_vector, positions in iter_roi_groups(vector):
+            roi_meta_vector = meta_vector.iloc[positions] if meta_vector is not None else None
+            for element in get_roi_elements(roi_name, roi_vector, roi_meta_vector):
+                if not first:
+                    f.write(', ')
+                f.write(json.dumps(element))
+                first = False
+        f.write(']}')
 
 
 def clear_annotations(
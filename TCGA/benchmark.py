@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy
+import pandas
+import sklearn
+import umap as umap_lib
+
+from .annotations import write_annotation
+from .clustering import (find_cluster_distinction_columns, get_coordinates,
+                         get_optimal_clusters)
+from .constants import BENCHMARKS_FOLDER, DOWNLOADS_FOLDER
+from .feature_store import build_feature_store, get_store_folder
+from .get_ellipses import get_ellipses
+from .instrumentation import describe, record
+from .parallel import run_captured
+from .preprocessing import FeaturePreprocessor
+from .read_vectors import get_case_vector
+from .reduce_dims import MIN_GROUP_SIZES, tsne, umap
+from .synthetic import generate_case
+
+BENCHMARKS = [
+    'ingest',
+    'get_case_vector',
+    'preprocess',
+    'umap',
+    'tsne',
+    'get_optimal_clusters',
+    'find_cluster_distinction_columns',
+    'write_annotation',
+    'get_ellipses',
+]
+DEFAULT_SCALES = [10000]
+# reductions and clustering run on a sample so large scales finish; the sampled row count is recorded
+MAX_REDUCE_ROWS = 20000
+
+
+def get_synthetic_case(n_nuclei, seed=0, workers=1):
+    # synthetic cases are deterministic, so an existing case of the same size and seed is reused
+    case_name = f'synthetic-{n_nuclei}' if seed == 0 else f'synthetic-{n_nuclei}-{seed}'
+    if not (DOWNLOADS_FOLDER / case_name).exists():
+        generate_case(case_name, n_nuclei, seed=seed, workers=workers)
+    return case_name
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        commit=commit,
+        timestamp=datetime.now().isoformat(timespec='seconds'),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+        numpy=numpy.__version__,
+        pandas=pandas.__version__,
+        sklearn=sklearn.__version__,
+        umap=umap_lib.__version__,
+    )
+
+
+def benchmark_case(case_name, n_nuclei, benchmarks, results, repeat=0, max_reduce_rows=MAX_REDUCE_ROWS, seed=0):
+    """
+    Time each step of the pipeline once on a case, appending one record per selected benchmark to `results`.
+    Steps that a selected benchmark depends on run without being recorded.
+    """
+    def run(name, func, *args, **kwargs):
+        if name not in benchmarks:
+            return run_captured(func, *args, **kwargs)[0]
+        with record(name, case=case_name, nuclei=n_nuclei, repeat=repeat) as entry:
+            # functions print progress; keep the benchmark output to one line per step
+            value, _ = run_captured(func, *args, **kwargs)
+            entry.update(describe(value))
+        results.append(entry)
+        print(f'\t{name}: {entry["wall_seconds"]} seconds.')
+        return value
+
+    needs_vector = set(benchmarks) - {'ingest', 'get_ellipses'}
+    needs_reduction = {'umap', 'get_optimal_clusters', 'find_cluster_distinction_columns'} & set(benchmarks)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        if 'ingest' in benchmarks:
+            shutil.rmtree(get_store_folder(case_name), ignore_errors=True)
+        run('ingest', build_feature_store, case_name)
+        if not needs_vector:
+            vector = None
+        else:
+            vector = run('get_case_vector', get_case_vector, case_name)
+            matrix = run('preprocess', FeaturePreprocessor().fit_transform, vector)
+
+            rng = numpy.random.default_rng(seed)
+            rows = numpy.sort(rng.choice(len(matrix), min(len(matrix), max_reduce_rows), replace=False))
+            sample = matrix[rows]
+            if needs_reduction:
+                result = run('umap', umap, sample, tmp / 'umap.parquet', use_cache=False)
+                if 'get_optimal_clusters' in benchmarks or 'find_cluster_distinction_columns' in benchmarks:
+                    labels = run('get_optimal_clusters', get_optimal_clusters, get_coordinates(result), 'all')
+                    run(
+                        'find_cluster_distinction_columns', find_cluster_distinction_columns,
+                        case_name, None, groups=[('all', vector.iloc[rows])], clusters=dict(all=labels),
+                    )
+            if 'tsne' in benchmarks and len(sample) >= MIN_GROUP_SIZES['tsne']:
+                run('tsne', tsne, sample, tmp / 'tsne.parquet', use_cache=False)
+            if 'write_annotation' in benchmarks:
+                run('write_annotation', write_annotation, tmp / 'annotation.json', vector, None)
+        run('get_ellipses', get_ellipses, cases=[case_name])
+
+
+def warm_up(tmp):
+    # numba compiles UMAP on its first call; compile on a small input so it is not timed
+    rng = numpy.random.default_rng(0)
+    run_captured(umap, rng.random((100, 10), dtype=numpy.float32), Path(tmp) / 'warm_up.parquet', use_cache=False)
+
+
+def run_benchmarks(scales=None, benchmarks=None, repeats=1, max_reduce_rows=MAX_REDUCE_ROWS, seed=0, workers=1, output=None):
+    """Benchmark every scale, write the results to a JSON file and return its path."""
+    scales = scales or DEFAULT_SCALES
+    benchmarks = benchmarks or BENCHMARKS
+    results = []
+    if 'umap' in benchmarks:
+        with tempfile.TemporaryDirectory() as tmp:
+            warm_up(tmp)
+    for n_nuclei in scales:
+        case_name = get_synthetic_case(n_nuclei, seed=seed, workers=workers)
+        print(f'Benchmarking {n_nuclei} nuclei.')
+        for repeat in range(repeats):
+            benchmark_case(
+                case_name, n_nuclei, benchmarks, results,
+                repeat=repeat, max_reduce_rows=max_reduce_rows, seed=seed,
+            )
+
+    environment = get_environment()
+    if output is None:
+        commit = (environment.get('commit') or 'unknown')[:8]
+        output = BENCHMARKS_FOLDER / f'{datetime.now().strftime("%Y%m%d-%H%M%S")}-{commit}.json'
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(dict(
+            environment=environment,
+            settings=dict(scales=scales, benchmarks=benchmarks, repeats=repeats, max_reduce_rows=max_reduce_rows, seed=seed),
+            results=results,
+        ), f, indent=2, default=str)
+    print(f'Wrote {len(results)} results to {output}.')
+    return output
+
+
+def read_results(filepath):
+    with open(filepath) as f:
+        results = json.load(f)['results']
+    results = pandas.DataFrame(results, columns=['stage', 'nuclei', 'wall_seconds', 'cpu_seconds', 'peak_rss_delta_mb'])
+    # the median over repeats is robust to one slow repeat
+    return results.groupby(['stage', 'nuclei'], sort=False).median()
+
+
+def compare_results(base_filepath, new_filepath):
+    """Return the wall time of each benchmark in two result files, and their ratio."""
+    base = read_results(base_filepath)
+    new = read_results(new_filepath)
+    comparison = pandas.DataFrame(dict(
+        base_seconds=base['wall_seconds'],
+        new_seconds=new['wall_seconds'],
+    )).dropna()
+    comparison['ratio'] = (comparison['new_seconds'] / comparison['base_seconds']).round(3)
+    return comparison
+
+
+def main(raw_args=None):
+    parser = argparse.ArgumentParser(
+        prog="Benchmark",
+        description="Time the pipeline steps on synthetic cases, or compare two benchmark result files.",
+    )
+    parser.add_argument('command', choices=['run', 'compare'], help='Action to perform.')
+    parser.add_argument(
+        'files', nargs='*',
+        help='For compare, the base and the new result file.'
+    )
+    parser.add_argument(
+        '--nuclei', nargs='*', type=int,
+        help=f'Number of nuclei in each synthetic case to benchmark. Default={DEFAULT_SCALES}.'
+    )
+    parser.add_argument(
+        '--benchmarks', nargs='*', choices=BENCHMARKS,
+        help='Benchmarks to run. If not specified, run all benchmarks.'
+    )
+    parser.add_argument('--repeats', type=int, default=1, help='Number of times to run each benchmark. Default=1.')
+    parser.add_argument(
+        '--max-reduce-rows', type=int, default=MAX_REDUCE_ROWS,
+        help=f'Number of sampled rows used for dimensionality reduction and clustering. Default={MAX_REDUCE_ROWS}.'
+    )
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic cases. Default=0.')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of ROIs to write in parallel when generating a synthetic case. Default=1.'
+    )
+    parser.add_argument(
+        '--output', type=str,
+        help='Result file to write. If not specified, write to TCGA/benchmarks/<timestamp>-<commit>.json.'
+    )
+    args = vars(parser.parse_args(raw_args))
+
+    if args.get('command') == 'run':
+        run_benchmarks(
+            scales=args.get('nuclei'),
+            benchmarks=args.get('benchmarks'),
+            repeats=args.get('repeats'),
+            max_reduce_rows=args.get('max_reduce_rows'),
+            seed=args.get('seed'),
+            workers=args.get('workers'),
+            output=args.get('output'),
+        )
+    elif args.get('command') == 'compare':
+        files = args.get('files')
+        if len(files) != 2:
+            parser.error('compare requires a base and a new result file.')
+        print(compare_results(*files).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy
+import pandas
+
+from .constants import RESULT_CACHE_FOLDER
+
+# least recently used results are evicted once the cache grows past this size
+RESULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+
+def hash_matrix(matrix):
+    matrix = numpy.ascontiguousarray(matrix)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((matrix.shape, matrix.dtype.str)).encode())
+    digest.update(memoryview(matrix).cast('B'))
+    return digest.hexdigest()
+
+
+def get_result_key(matrix, columns, reducer, params, matrix_hash=None):
+    """
+    Key a reduction result on the content of its input: a hash of the matrix,
+    the column list, the reducer name and every reducer parameter.
+    """
+    key = dict(
+        matrix=matrix_hash or hash_matrix(matrix),
+        columns=list(columns) if columns is not None else None,
+        reducer=reducer,
+        params=params,
+    )
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_entry_files(key):
+    return (
+        RESULT_CACHE_FOLDER / f'{key}.parquet',
+        RESULT_CACHE_FOLDER / f'{key}.json',
+    )
+
+
+def load_result(key, index=None):
+    result_file, meta_file = get_entry_files(key)
+    if not result_file.exists() or not meta_file.exists():
+        return None
+    result = pandas.read_parquet(result_file)
+    if index is not None:
+        if len(index) != len(result):
+            return None
+        result.index = index
+    # the modification time of the metadata file records the last use of an entry
+    os.utime(meta_file)
+    return result
+
+
+def store_result(key, result, reducer, params, columns=None, max_bytes=RESULT_CACHE_MAX_BYTES):
+    RESULT_CACHE_FOLDER.mkdir(parents=True, exist_ok=True)
+    result_file, meta_file = get_entry_files(key)
+    result.reset_index(drop=True).to_parquet(result_file)
+    with open(meta_file, 'w') as f:
+        json.dump(dict(
+            reducer=reducer,
+            params=params,
+            rows=len(result),
+            n_columns=len(columns) if columns is not None else None,
+            created=time.time(),
+        ), f, default=str)
+    if max_bytes is not None:
+        prune(max_bytes)
+
+
+def list_entries():
+    entries = []
+    for meta_file in RESULT_CACHE_FOLDER.glob('*.json'):
+        result_file = meta_file.with_suffix('.parquet')
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            meta = {}
+        size = meta_file.stat().st_size
+        if result_file.exists():
+            size += result_file.stat().st_size
+        entries.append(dict(
+            key=meta_file.stem,
+            reducer=meta.get('reducer'),
+            rows=meta.get('rows'),
+            params=json.dumps(meta.get('params'), sort_keys=True),
+            size=size,
+            last_used=meta_file.stat().st_mtime,
+        ))
+    entries = pandas.DataFrame(entries, columns=['key', 'reducer', 'rows', 'params', 'size', 'last_used'])
+    return entries.sort_values('last_used', ascending=False, ignore_index=True)
+
+
+def prune(max_bytes=RESULT_CACHE_MAX_BYTES):
+    """Evict least recently used entries until the cache fits in max_bytes. Return the evicted keys."""
+    entries = list_entries()
+    removed = []
+    total = int(entries['size'].sum())
+    for _, entry in entries[::-1].iterrows():
+        if total <= max_bytes:
+            break
+        for f in get_entry_files(entry['key']):
+            f.unlink(missing_ok=True)
+        total -= entry['size']
+        removed.append(entry['key'])
+    return removed
+
+
+def main(raw_args=None):
+    parser = argparse.ArgumentParser(
+        prog="ResultCache",
+        description="Inspect or prune cached dimensionality reduction results",
+    )
+    parser.add_argument('command', choices=['ls', 'prune'], help='Action to perform.')
+    parser.add_argument(
+        '--max-mb', type=float, default=RESULT_CACHE_MAX_BYTES / 1024 ** 2,
+        help=f'Size limit for prune, in megabytes. Default={RESULT_CACHE_MAX_BYTES // 1024 ** 2}.'
+    )
+    args = vars(parser.parse_args(raw_args))
+    command, max_mb = args.get('command'), args.get('max_mb')
+
+    if command == 'ls':
+        entries = list_entries()
+        if len(entries):
+            entries['size'] = (entries['size'] / 1024 ** 2).round(2).astype(str) + ' MB'
+            entries['last_used'] = pandas.to_datetime(entries['last_used'], unit='s').dt.strftime('%Y-%m-%d %H:%M:%S')
+            entries['key'] = entries['key'].str[:12]
+            print(entries.to_string(index=False))
+        print(f'{len(entries)} cached result(s) in {RESULT_CACHE_FOLDER}.')
+    elif command == 'prune':
+        removed = prune(int(max_mb * 1024 ** 2))
+        print(f'Removed {len(removed)} cached result(s).')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,108 +1,471 @@
-import json
+import time
+from concurrent.futures import as_completed
+from datetime import datetime
+
 import numpy
+import pandas
 import scipy.stats as stats
-
-from datetime import datetime
+import sklearn
+from scipy import sparse
 from sklearn import cluster
-from sklearn.metrics import silhouette_score
+from sklearn.manifold import spectral_embedding
+from sklearn.metrics import (calinski_harabasz_score, davies_bouldin_score,
+                             silhouette_samples)
+from sklearn.neighbors import KDTree, kneighbors_graph
 
-from .constants import COLUMN_NAMES, CLASS_PREFIX
+from .instrumentation import record
+from .parallel import get_process_pool
+from .pipeline import LABELS
+from .preprocessing import get_chunks
 from .read_vectors import get_case_vector
-
+from .schema import get_classifications, get_feature_columns
 
 MAX_CLUSTERS = 5
 RANDOM_STATE = 0
 SIGNIFICANCE_LEVEL = 0.05
 N_CORRELATION_COLS = 5
+# neighbors in the affinity graph, as in SpectralClustering's nearest_neighbors affinity
+N_AFFINITY_NEIGHBORS = 10
+# groups larger than this are scored on a sample stratified by cluster
+SILHOUETTE_SAMPLE_SIZE = 10000
+# memory for each block of pairwise distances in an exact silhouette score
+SILHOUETTE_WORKING_MEMORY_MB = 256
+DEFAULT_SCORE_METHOD = 'sampled-silhouette'
+CLUSTER_METHODS = ['spectral', 'minibatch-kmeans', 'hdbscan']
+DEFAULT_CLUSTER_METHOD = 'spectral'
+# rows per partial_fit call and passes over the group for mini-batch k-means
+CLUSTER_CHUNK_SIZE = 100000
+MINIBATCH_EPOCHS = 3
+# HDBSCAN's smallest cluster is this share of the sample it is fit on, and at least this many features
+HDBSCAN_MIN_CLUSTER_SHARE = 0.01
+HDBSCAN_MIN_CLUSTER_SIZE = 5
+# neighbors that define the core density; HDBSCAN defaults to the min cluster size, which is far larger
+HDBSCAN_MIN_SAMPLES = 10
+# rows HDBSCAN is fit on; the rest are labeled by their nearest fitted row
+HDBSCAN_SAMPLE_SIZE = 20000
+# rows accumulated at a time by the cluster ANOVA
+ANOVA_CHUNK_SIZE = 100000
+CORRECTION_METHODS = ['bonferroni', 'fdr']
+
+
+def get_coordinates(result):
+    # results may carry other columns, such as the multiplicity of duplicate rows
+    return result[[c for c in ['x', 'y', 'z'] if c in result.columns]].to_numpy()
+
+
+def get_silhouette(data, labels):
+    # silhouette_samples computes pairwise distances in blocks of the configured working memory
+    with sklearn.config_context(working_memory=SILHOUETTE_WORKING_MEMORY_MB):
+        return silhouette_samples(data, labels)
+
+
+def get_label_sample(labels, sample_size=SILHOUETTE_SAMPLE_SIZE, seed=RANDOM_STATE):
+    """Choose rows in proportion to cluster sizes, with at least two rows of every cluster."""
+    rng = numpy.random.default_rng(seed)
+    _, inverse, counts = numpy.unique(labels, return_inverse=True, return_counts=True)
+    order = numpy.argsort(inverse, kind='stable')
+    rows = []
+    for positions in numpy.split(order, numpy.cumsum(counts)[:-1]):
+        n = min(len(positions), max(2, round(sample_size * len(positions) / len(labels))))
+        rows.append(rng.choice(positions, n, replace=False))
+    return numpy.sort(numpy.concatenate(rows))
+
+
+def score_silhouette(data, labels):
+    return float(get_silhouette(data, labels).mean()), None
+
+
+def score_sampled_silhouette(data, labels):
+    # exact for groups that fit in the sample; otherwise also return the half width of a 95% interval
+    if len(data) <= SILHOUETTE_SAMPLE_SIZE:
+        return score_silhouette(data, labels)
+    rows = get_label_sample(labels)
+    samples = get_silhouette(data[rows], labels[rows])
+    return float(samples.mean()), float(1.96 * samples.std(ddof=1) / numpy.sqrt(len(samples)))
+
+
+def score_calinski_harabasz(data, labels):
+    return float(calinski_harabasz_score(data, labels)), None
+
+
+def score_davies_bouldin(data, labels):
+    return float(davies_bouldin_score(data, labels)), None
+
+
+# all but the exact silhouette take linear time in the number of features
+SCORE_METHODS = {
+    'silhouette': score_silhouette,
+    'sampled-silhouette': score_sampled_silhouette,
+    'calinski-harabasz': score_calinski_harabasz,
+    'davies-bouldin': score_davies_bouldin,
+}
+# scores that are lower for better clusterings
+MINIMIZED_SCORES = {'davies-bouldin'}
+
+
+def get_spectral_maps(data, n_components):
+    """
+    Return the spectral embedding SpectralClustering(affinity='nearest_neighbors') assigns labels in.
+    Its leading n eigenvectors are the embedding for n clusters, so one embedding with the largest
+    n serves every smaller one.
+    """
+    connectivity = kneighbors_graph(data, n_neighbors=N_AFFINITY_NEIGHBORS, include_self=True)
+    affinity = 0.5 * (connectivity + connectivity.T)
+    return spectral_embedding(
+        affinity,
+        n_components=n_components,
+        eigen_solver='arpack',
+        random_state=RANDOM_STATE,
+        drop_first=False,
+    )
+
+
+def fit_minibatch_kmeans(data, n, chunk_size=CLUSTER_CHUNK_SIZE, epochs=MINIBATCH_EPOCHS):
+    """
+    Fit k-means with `partial_fit` on chunks of `chunk_size` shuffled rows, then label the rows
+    one chunk at a time, so only a chunk of rows is copied at once however large the group is.
+    """
+    rng = numpy.random.default_rng(RANDOM_STATE)
+    kmeans = cluster.MiniBatchKMeans(n_clusters=n, random_state=RANDOM_STATE, n_init=3)
+    chunks = get_chunks(len(data), chunk_size, min_size=n)
+    for _ in range(epochs):
+        # slides are read ROI by ROI, so unshuffled chunks would each cover one part of the embedding
+        order = rng.permutation(len(data))
+        for chunk_start, chunk_stop in chunks:
+            kmeans.partial_fit(data[numpy.sort(order[chunk_start:chunk_stop])])
+    return numpy.concatenate([
+        kmeans.predict(data[chunk_start:chunk_stop]) for chunk_start, chunk_stop in chunks
+    ])
+
+
+def fit_hdbscan(data, sample_size=HDBSCAN_SAMPLE_SIZE, chunk_size=CLUSTER_CHUNK_SIZE):
+    """
+    Cluster a random sample of at most `sample_size` rows with HDBSCAN, whose tree is built in
+    quadratic time, then give every other row the label of its nearest sampled row, one chunk of
+    rows at a time. Noise is labeled -1.
+    """
+    rng = numpy.random.default_rng(RANDOM_STATE)
+    sample = numpy.sort(rng.choice(len(data), min(sample_size, len(data)), replace=False))
+    # the smallest cluster scales with the group so large groups are not fragmented
+    min_cluster_size = max(HDBSCAN_MIN_CLUSTER_SIZE, round(HDBSCAN_MIN_CLUSTER_SHARE * len(sample)))
+    sample_labels = cluster.HDBSCAN(
+        min_cluster_size=min_cluster_size,
+        min_samples=min(HDBSCAN_MIN_SAMPLES, min_cluster_size),
+        copy=True,
+    ).fit_predict(data[sample])
+    if len(sample) == len(data):
+        return sample_labels
+    tree = KDTree(data[sample])
+    return numpy.concatenate([
+        sample_labels[tree.query(data[chunk_start:chunk_stop], k=1, return_distance=False)[:, 0]]
+        for chunk_start, chunk_stop in get_chunks(len(data), chunk_size)
+    ])
+
+
+def prepare_clusters(data, method, max_clusters):
+    # work shared by every candidate number of clusters of a group
+    if method == 'spectral':
+        # The affinity graph and eigenvectors do not depend on n_clusters, so they are computed once
+        return get_spectral_maps(data, max_clusters - 1)
+    return None
+
+
+def get_cluster_counts(method, max_clusters):
+    # HDBSCAN chooses the number of clusters itself, so it has a single candidate
+    return [None] if method == 'hdbscan' else list(range(2, max_clusters))
+
 
+def score_clusters(maps, data, n, score_method, group_name=None, method=DEFAULT_CLUSTER_METHOD):
+    # one candidate of the search; maps of the group are shared by every n
+    with record('clusters', group=group_name, rows=len(data), columns=data.shape[1], n_clusters=n, method=method):
+        if method == 'spectral':
+            _, labels, _ = cluster.k_means(maps[:, :n], n, random_state=RANDOM_STATE, n_init=10)
+        elif method == 'minibatch-kmeans':
+            labels = fit_minibatch_kmeans(data, n)
+        else:
+            return fit_hdbscan(data), None, None
+        score, interval = SCORE_METHODS[score_method](data, labels)
+    return labels, score, interval
 
-def get_optimal_clusters(data, group_name, clusters_file=None, use_cache=False):
+
+def run_timed(func, *args):
+    # timed in the worker, so the time a task waits in the pool queue is not counted
+    start = time.perf_counter()
+    value = func(*args)
+    return value, time.perf_counter() - start
+
+
+def search_clusters(
+    group_data, max_clusters=MAX_CLUSTERS, score_method=DEFAULT_SCORE_METHOD, workers=1,
+    method=DEFAULT_CLUSTER_METHOD,
+):
+    """
+    Cluster every group in `group_data` ({group name: coordinates}) with `method`, trying each
+    number of clusters from 2 up to `max_clusters` (exclusive). Work shared by the candidates of
+    a group, such as its spectral embedding, is done once; with more than one worker, that work
+    and then every (group, n_clusters) candidate run in a process pool, largest groups first.
+    Return {group name: (candidates in order of n, seconds)}, where each candidate is a
+    (labels, score, interval) tuple and seconds is the time spent on the tasks of the group.
+    """
+    order = sorted(group_data, key=lambda name: len(group_data[name]), reverse=True)
+    n_values = get_cluster_counts(method, max_clusters)
+    if not n_values:
+        raise ValueError(f'max_clusters is exclusive and must be at least 3 to try 2 clusters, not {max_clusters}.')
+    candidates = {name: {} for name in order}
+    seconds = {name: 0 for name in order}
+    if workers is not None and workers > 1 and len(order) * len(n_values) > 1:
+        with get_process_pool(workers) as executor:
+            maps_futures = {
+                executor.submit(run_timed, prepare_clusters, group_data[name], method, max_clusters): name
+                for name in order
+            }
+            candidate_futures = {}
+            for future in as_completed(maps_futures):
+                name = maps_futures[future]
+                maps, task_seconds = future.result()
+                seconds[name] += task_seconds
+                for n in n_values:
+                    candidate_futures[executor.submit(
+                        run_timed, score_clusters, maps, group_data[name], n, score_method, name, method,
+                    )] = name, n
+            for future in as_completed(candidate_futures):
+                name, n = candidate_futures[future]
+                candidates[name][n], task_seconds = future.result()
+                seconds[name] += task_seconds
+    else:
+        for name in order:
+            start = datetime.now()
+            maps = prepare_clusters(group_data[name], method, max_clusters)
+            for n in n_values:
+                candidates[name][n] = score_clusters(maps, group_data[name], n, score_method, name, method)
+            seconds[name] = (datetime.now() - start).total_seconds()
+    return {name: ([candidates[name][n] for n in n_values], seconds[name]) for name in order}
+
+
+def choose_clusters(candidates, score_method=DEFAULT_SCORE_METHOD):
+    # the first candidate with the best score, so ties keep the fewer clusters
+    sign = -1 if score_method in MINIMIZED_SCORES else 1
+    best = None
+    for candidate in candidates:
+        if best is None or (candidate[1] is not None and sign * candidate[1] > sign * best[1]):
+            best = candidate
+    return best
+
+
+def print_clusters(group_name, n_features, seconds, best, score_method):
+    labels, score, interval = best
+    print(f'Got optimal clusters for {n_features} {group_name} features in {seconds} seconds.')
+    n_clusters = len(set(labels) - {-1})
+    if score is None:
+        print(f'\t{n_clusters} clusters, {numpy.mean(labels == -1):.1%} of features unclustered.')
+    else:
+        interval = f' ± {interval:.3f}' if interval is not None else ''
+        print(f'\t{n_clusters} clusters, {score_method} score {score:.3f}{interval}.')
+
+
+def get_optimal_clusters(
+    data, group_name, max_clusters=MAX_CLUSTERS, score_method=DEFAULT_SCORE_METHOD, workers=1,
+    method=DEFAULT_CLUSTER_METHOD,
+):
+    candidates, seconds = search_clusters({group_name: data}, max_clusters, score_method, workers, method)[group_name]
+    best = choose_clusters(candidates, score_method)
+    print_clusters(group_name, len(data), seconds, best, score_method)
+    return best[0].tolist()
+
+
+def find_clusters(
+    all_results, clusters_file=None, use_cache=False, max_clusters=MAX_CLUSTERS,
+    score_method=DEFAULT_SCORE_METHOD, workers=1, method=DEFAULT_CLUSTER_METHOD,
+):
+    """
+    Return the labels of the best clustering of every group in `all_results`. With a `clusters_file`,
+    the labels of every group are written to it as compact integers in parquet once the search
+    is done; with `use_cache`, groups already in that file are not searched again.
+    """
     cached = {}
     if use_cache and clusters_file is not None and clusters_file.exists():
-        with open(clusters_file) as f:
-            try:
-                cached = json.load(f)
-                if cached.get(group_name) is not None:
-                    return cached.get(group_name)
-            except json.JSONDecodeError:
-                pass
-    start = datetime.now()
-    optimal_clusters = None
-    max_silhouette_score = -1
-    # Try different n_clusters and return result with highest silhouette score
-    for n in range(2, MAX_CLUSTERS):
-        spectral = cluster.SpectralClustering(
-            n_clusters=n,
-            eigen_solver='arpack',
-            affinity='nearest_neighbors',
-            random_state=RANDOM_STATE,
-        )
-        spectral.fit(data)
-        labels = spectral.labels_
-        score = silhouette_score(data, labels)
-        if score > max_silhouette_score:
-            max_silhouette_score = score
-            optimal_clusters = labels
-    seconds = (datetime.now() - start).total_seconds()
-    print(f'Got optimal clusters for {len(data)} {group_name} features in {seconds} seconds.')
-    cached[group_name] = optimal_clusters.tolist()
-    with open(clusters_file, 'w') as f:
-        json.dump(cached, f)
-    return cached[group_name]
-
-
-def find_clusters(all_results, clusters_file=None, use_cache=False):
-    cluster_results = {}
-    for group_name, result in all_results.items():
-        data = result.to_numpy()
-        cluster_results[group_name] = get_optimal_clusters(
-            data,
-            group_name,
-            clusters_file=clusters_file,
-            use_cache=use_cache
+        cached = LABELS.load(clusters_file)
+    group_data = {
+        group_name: get_coordinates(result)
+        for group_name, result in all_results.items()
+        if cached.get(group_name) is None
+    }
+    searched = search_clusters(group_data, max_clusters, score_method, workers, method)
+    # results are printed in group order, however the search was scheduled
+    for group_name in all_results:
+        if group_name in searched:
+            candidates, seconds = searched[group_name]
+            best = choose_clusters(candidates, score_method)
+            print_clusters(group_name, len(group_data[group_name]), seconds, best, score_method)
+            cached[group_name] = best[0].tolist()
+    if clusters_file is not None and searched:
+        LABELS.save(cached, clusters_file)
+    return {group_name: cached[group_name] for group_name in all_results}
+
+
+def get_anova(values, labels, groups=None, chunk_size=ANOVA_CHUNK_SIZE):
+    """
+    One-way ANOVA of every column of `values` (an array or DataFrame) between the clusters in
+    `labels`, separately within each group in `groups` (per-row codes, e.g. the case and class of
+    every nucleus of a cohort; one group if None). Cluster counts, sums and sums of squares of
+    every column are accumulated one chunk of rows at a time, so every group and column is tested
+    in one pass. Rows labeled -1 (noise) are left out.
+    Return the F statistics, p-values and effect sizes (eta squared) as arrays of shape
+    (groups, columns), with groups in order of their codes; they are NaN where a group has fewer
+    than two clusters.
+    """
+    labels = numpy.asarray(labels)
+    groups = numpy.zeros(len(labels), dtype=int) if groups is None else numpy.asarray(groups)
+    keep = labels >= 0
+    # every (group, cluster) pair is one cell
+    cell_keys, cells = numpy.unique(numpy.stack([groups[keep], labels[keep]]), axis=1, return_inverse=True)
+    cells = cells.ravel()
+    cell_groups = cell_keys[0]
+    n_groups = int(groups.max()) + 1 if len(groups) else 0
+    n_cells, n_columns = cell_keys.shape[1], values.shape[1]
+
+    # sums are taken around the first row, so the sums of squares do not cancel for large values
+    rows = numpy.flatnonzero(keep)
+    shift = None
+    counts = numpy.bincount(cells, minlength=n_cells).astype(float)
+    sums = numpy.zeros((n_cells, n_columns))
+    squares = numpy.zeros((n_cells, n_columns))
+    for chunk_start, chunk_stop in get_chunks(len(rows), chunk_size):
+        chunk_rows = rows[chunk_start:chunk_stop]
+        chunk = values.iloc[chunk_rows] if hasattr(values, 'iloc') else values[chunk_rows]
+        chunk = numpy.asarray(chunk, dtype=numpy.float64)
+        if shift is None:
+            shift = numpy.nan_to_num(chunk[0])
+        # not in place; a DataFrame of float64 columns may return a read-only view
+        chunk = chunk - shift
+        indicator = sparse.csr_matrix(
+            (numpy.ones(len(chunk_rows)), (cells[chunk_start:chunk_stop], numpy.arange(len(chunk_rows)))),
+            shape=(n_cells, len(chunk_rows)),
         )
-    return cluster_results
+        sums += indicator @ chunk
+        squares += indicator @ (chunk * chunk)
+
+    def per_group(cell_values):
+        totals = numpy.zeros((n_groups,) + cell_values.shape[1:])
+        numpy.add.at(totals, cell_groups, cell_values)
+        return totals
+
+    group_counts = per_group(counts)
+    group_clusters = per_group(numpy.ones(n_cells))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        correction = per_group(sums) ** 2 / group_counts[:, None]
+        between = per_group(sums ** 2 / counts[:, None]) - correction
+        total = per_group(squares) - correction
+        within = numpy.maximum(total - between, 0)
+        df_between = group_clusters - 1
+        df_within = group_counts - group_clusters
+        f_stats = (between / df_between[:, None]) / (within / df_within[:, None])
+        p_values = stats.f.sf(f_stats, df_between[:, None], df_within[:, None])
+        effect_sizes = between / total
+    invalid = (df_between < 1) | (df_within < 1)
+    for result in (f_stats, p_values, effect_sizes):
+        result[invalid] = numpy.nan
+    return f_stats, p_values, effect_sizes
+
+
+def correct_p_values(p_values, method=None):
+    """Adjust the p-values of each row for the number of columns tested, with 'bonferroni' or 'fdr' (Benjamini-Hochberg)."""
+    if method is None:
+        return p_values
+    adjusted = numpy.full_like(p_values, numpy.nan)
+    for i, row in enumerate(p_values):
+        tested = ~numpy.isnan(row)
+        if not tested.any():
+            continue
+        if method == 'bonferroni':
+            adjusted[i, tested] = numpy.minimum(row[tested] * tested.sum(), 1)
+        else:
+            adjusted[i, tested] = stats.false_discovery_control(row[tested], method='bh')
+    return adjusted
+
+
+def print_distinction_columns(distinction_columns):
+    for group_name, group_distinction_cols in distinction_columns.items():
+        print(f'Cluster distinction columns for {group_name}:')
+        print_group_distinction_columns(group_distinction_cols)
+
 
+def print_group_distinction_columns(group_distinction_cols):
+    for col_name, f_val in group_distinction_cols.items():
+        # with effect sizes, each column maps to its F statistic, p-value and eta squared
+        if isinstance(f_val, dict):
+            print(f'\t{col_name}: {f_val["f_stat"]} (p={f_val["p_value"]:.3g}, eta squared={f_val["eta_squared"]:.3f})')
+        else:
+            print(f'\t{col_name}: {f_val}')
 
-def find_cluster_distinction_columns(case_name, clusters_file, groups=None, print_results=False):
+
+def get_distinction_columns(columns, f_stats, p_values, effect_sizes, effect_size=False):
+    # the N_CORRELATION_COLS significant columns with the highest F statistics
+    significant = numpy.flatnonzero(p_values < SIGNIFICANCE_LEVEL)
+    top = significant[numpy.argsort(-f_stats[significant], kind='stable')][:N_CORRELATION_COLS]
+    if effect_size:
+        return {
+            columns[i]: dict(
+                f_stat=float(f_stats[i]), p_value=float(p_values[i]), eta_squared=float(effect_sizes[i]),
+            )
+            for i in top
+        }
+    return {columns[i]: float(f_stats[i]) for i in top}
+
+
+def find_cluster_distinction_columns(
+    case_name, clusters_file, groups=None, print_results=False, clusters=None,
+    correction=None, effect_size=False,
+):
+    """
+    Return the columns that differ most between the clusters of each group, by one-way ANOVA.
+    With `correction` ('bonferroni' or 'fdr'), p-values are adjusted for the number of columns
+    tested; with `effect_size`, each column maps to its F statistic, p-value and eta squared
+    instead of only its F statistic.
+    """
     distinction_columns = {}
-    clusters = None
-    with open(clusters_file) as f:
-        clusters = json.load(f)
+    if clusters is None:
+        clusters = LABELS.load(clusters_file)
 
     if groups is None:
         vector = get_case_vector(case_name)
-        class_cols = [c for c in COLUMN_NAMES if CLASS_PREFIX in c]
-        classes = [c.replace(CLASS_PREFIX, '') for c in vector[class_cols].idxmax(axis=1)]
-        vector = vector.assign(classification=classes)
-        groups = vector.groupby('classification')
+        vector = vector.assign(classification=get_classifications(vector))
+        groups = vector.groupby('classification', observed=True)
 
+    # every group is tested in a single ANOVA pass, with the group of each row as its code
+    start = datetime.now()
+    group_names, group_columns, group_values, group_labels = [], [], [], []
     for group_name, group in groups:
-        start = datetime.now()
         labels = clusters.get(group_name)
-        columns = [c for c, d in group.dtypes.to_dict().items() if d == numpy.float64]
-        column_f_stats = {}
         if labels is not None:
-            group = group.assign(cluster=labels)
-            cluster_groups = group.groupby('cluster')
-            for column_name in columns:
-                column_per_cluster = [
-                    cluster[column_name]
-                    for cluster_id, cluster in cluster_groups
-                ]
-                f_stat, p_val = stats.f_oneway(*column_per_cluster)
-                if p_val < SIGNIFICANCE_LEVEL:
-                    column_f_stats[column_name] = float(f_stat)
-            group_distinction_cols = dict(sorted(
-                column_f_stats.items(),
-                key=lambda item: item[1],
-                reverse=True
-            )[:N_CORRELATION_COLS])
-            distinction_columns[group_name] = group_distinction_cols
-
-            if print_results:
-                seconds = (datetime.now() - start).total_seconds()
-                print(f'Found cluster distinction columns for {group_name} in {seconds} seconds.')
-                for col_name, f_val in group_distinction_cols.items():
-                    print(f'\t{col_name}: {f_val}')
+            columns = get_feature_columns(group)
+            group_names.append(group_name)
+            group_columns.append(columns)
+            group_values.append(group[columns])
+            group_labels.append(numpy.asarray(labels))
+    if not group_names:
+        return distinction_columns
+
+    # columns a group does not have are NaN for its rows, so they are never significant for it
+    values = pandas.concat(group_values, ignore_index=True)
+    columns = list(values.columns)
+    column_positions = {c: j for j, c in enumerate(columns)}
+    codes = numpy.repeat(numpy.arange(len(group_names)), [len(v) for v in group_values])
+    with record('distinctions', rows=len(values), columns=len(columns), groups=len(group_names)):
+        f_stats, p_values, effect_sizes = get_anova(values, numpy.concatenate(group_labels), codes)
+        p_values = correct_p_values(p_values, correction)
+    seconds = (datetime.now() - start).total_seconds()
+    if print_results:
+        print(f'Found cluster distinction columns for {len(group_names)} group(s) in {seconds} seconds.')
+
+    for i, group_name in enumerate(group_names):
+        # p-values of columns the group does not have are NaN, so correction only counts its own columns
+        positions = [column_positions[c] for c in group_columns[i]]
+        group_distinction_cols = get_distinction_columns(
+            group_columns[i], f_stats[i, positions], p_values[i, positions], effect_sizes[i, positions], effect_size,
+        )
+        distinction_columns[group_name] = group_distinction_cols
+        if print_results:
+            print(f'Cluster distinction columns for {group_name}:')
+            print_group_distinction_columns(group_distinction_cols)
     return distinction_columns
@@ -1,10 +1,21 @@
 import json
+import os
 from pathlib import Path
 
-DOWNLOADS_FOLDER = Path(__file__).parent / 'downloads'
-ELLIPSES_FOLDER = Path(__file__).parent / 'ellipses'
-ANNOTATIONS_FOLDER = Path(__file__).parent / 'annotations'
-REDUCE_DIMS_RESULTS_FOLDER = Path(__file__).parent / 'reduce_dims_results'
+# generated data is written inside the package unless TCGA_DATA_FOLDER points elsewhere, e.g. for tests
+DATA_FOLDER = Path(os.environ.get('TCGA_DATA_FOLDER', Path(__file__).parent))
+DOWNLOADS_FOLDER = DATA_FOLDER / 'downloads'
+FEATURE_STORE_FOLDER = DATA_FOLDER / 'feature_store'
+MATRIX_CACHE_FOLDER = DATA_FOLDER / 'matrix_cache'
+RESULT_CACHE_FOLDER = DATA_FOLDER / 'result_cache'
+KNN_CACHE_FOLDER = DATA_FOLDER / 'knn_cache'
+PIPELINE_FOLDER = DATA_FOLDER / 'pipeline'
+RUN_LOGS_FOLDER = DATA_FOLDER / 'run_logs'
+BENCHMARKS_FOLDER = DATA_FOLDER / 'benchmarks'
+MODELS_FOLDER = DATA_FOLDER / 'models'
+ELLIPSES_FOLDER = DATA_FOLDER / 'ellipses'
+ANNOTATIONS_FOLDER = DATA_FOLDER / 'annotations'
+REDUCE_DIMS_RESULTS_FOLDER = DATA_FOLDER / 'reduce_dims_results'
 PLOTS_FOLDER = REDUCE_DIMS_RESULTS_FOLDER / 'plots'
 COLUMN_NAMES_FILE = Path(__file__).parent / 'column_names.json'
 CLASS_PREFIX = 'Unconstrained.ClassifProbab.'
@@ -12,5 +23,8 @@ CLASS_PREFIX = 'Unconstrained.ClassifProbab.'
 with open(COLUMN_NAMES_FILE) as f:
     COLUMN_NAMES = json.load(f)
 
-with open('conf.json') as f:
+# scripts run from the repository root; notebook kernels run in jupyter/ and use the root conf.json
+CONF_FILE = Path('conf.json') if Path('conf.json').exists() else Path(__file__).parent.parent / 'conf.json'
+
+with open(CONF_FILE) as f:
     CONF = json.load(f)
@@ -0,0 +1,156 @@
+import numpy
+import pandas
+
+from .constants import DOWNLOADS_FOLDER
+from .feature_matrix import get_feature_matrix
+
+DEFAULT_CHUNK_SIZE = 100000
+# value used for columns that a case does not have; case rows are already L1-normalized,
+# and a zero leaves their norm unchanged
+MISSING_VALUE = 0
+
+
+class FeatureCorpus():
+    """
+    Present the cleaned feature matrices of several cases as one virtual matrix.
+    Each case stays a memory-mapped float32 array in the matrix cache; rows are addressed
+    by global offsets, so row slices, column projections and chunked iteration only
+    read the parts of each case that they touch.
+    Pass a fitted `preprocessor` to transform every case into the same columns.
+    """
+    def __init__(self, cases=None, rois=None, exclude_column_patterns=None, use_cache=True, preprocessor=None):
+        self._cases = []
+        self._matrices = []
+        self._indexes = []
+        self._case_columns = []
+        for case in DOWNLOADS_FOLDER.glob('*'):
+            case_name = case.name.split('.')[0]
+            if cases is None or case_name in cases:
+                matrix, index, columns = get_feature_matrix(
+                    case_name,
+                    rois=rois,
+                    exclude_column_patterns=exclude_column_patterns,
+                    use_cache=use_cache,
+                    preprocessor=preprocessor,
+                )
+                self._cases.append(case_name)
+                self._matrices.append(matrix)
+                self._indexes.append(index)
+                self._case_columns.append(columns)
+
+        # union of case columns, in first-seen order
+        self._columns = list(dict.fromkeys(c for columns in self._case_columns for c in columns))
+        self._offsets = numpy.cumsum([0] + [len(m) for m in self._matrices])
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, columns = key
+            return self.get(rows, columns)
+        return self.get(key)
+
+    @property
+    def shape(self):
+        return (len(self), len(self._columns))
+
+    @property
+    def cases(self):
+        return list(self._cases)
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    @property
+    def offsets(self):
+        return {case_name: int(self._offsets[i]) for i, case_name in enumerate(self._cases)}
+
+    @property
+    def index(self):
+        frames = []
+        for case_name, index in zip(self._cases, self._indexes):
+            frames.append(pandas.DataFrame(dict(
+                case=case_name,
+                roiname=index['roiname'].astype(str).to_numpy(),
+                row=index.index.to_numpy(),
+            )))
+        index = pandas.concat(frames, ignore_index=True)
+        index['case'] = index['case'].astype('category')
+        index['roiname'] = index['roiname'].astype('category')
+        return index
+
+    def case_rows(self, case_name):
+        i = self._cases.index(case_name)
+        return slice(int(self._offsets[i]), int(self._offsets[i + 1]))
+
+    def _column_positions(self, case_index, columns):
+        case_positions = {c: j for j, c in enumerate(self._case_columns[case_index])}
+        return numpy.array([case_positions.get(c, -1) for c in columns])
+
+    def get(self, rows=None, columns=None):
+        """
+        Return the selected rows and columns as a float32 array.
+        `rows` may be None, a slice, an integer or an array of global row positions;
+        `columns` may be None, a list of column names or a single column name.
+        """
+        if columns is None:
+            columns = self._columns
+        elif isinstance(columns, str):
+            columns = [columns]
+        # only columns that some cases lack are filled; a name no case has is an error
+        unknown = set(columns).difference(self._columns)
+        if unknown:
+            raise KeyError(f'Columns not in any case of the corpus: {sorted(unknown)}')
+        if rows is None:
+            rows = slice(None)
+        if isinstance(rows, slice):
+            rows = numpy.arange(len(self))[rows]
+        rows = numpy.atleast_1d(numpy.asarray(rows, dtype=numpy.int64))
+        rows = numpy.where(rows < 0, rows + len(self), rows)
+        if len(rows) and (rows.min() < 0 or rows.max() >= len(self)):
+            raise IndexError('Row position out of range for corpus.')
+
+        result = numpy.full((len(rows), len(columns)), MISSING_VALUE, dtype=numpy.float32)
+        row_cases = numpy.searchsorted(self._offsets, rows, side='right') - 1
+        for case_index in numpy.unique(row_cases):
+            selected = numpy.flatnonzero(row_cases == case_index)
+            local_rows = rows[selected] - self._offsets[case_index]
+            column_positions = self._column_positions(case_index, columns)
+            present = column_positions >= 0
+            # read row-wise first so a memory-mapped case only touches the selected rows
+            values = self._matrices[case_index][local_rows]
+            result[numpy.ix_(selected, numpy.flatnonzero(present))] = values[:, column_positions[present]]
+        return result
+
+    def iter_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE, columns=None):
+        """Yield (start, chunk) pairs covering every row of the corpus in order."""
+        for start in range(0, len(self), chunk_size):
+            yield start, self.get(slice(start, start + chunk_size), columns)
+
+    def column_statistics(self, chunk_size=DEFAULT_CHUNK_SIZE, columns=None):
+        """Compute per-column count, mean, std, min and max in one chunked pass."""
+        if columns is None:
+            columns = self._columns
+        count = 0
+        total = numpy.zeros(len(columns))
+        total_squares = numpy.zeros(len(columns))
+        minimum = numpy.full(len(columns), numpy.inf)
+        maximum = numpy.full(len(columns), -numpy.inf)
+        for _, chunk in self.iter_chunks(chunk_size, columns):
+            chunk = chunk.astype(numpy.float64)
+            count += len(chunk)
+            total += chunk.sum(axis=0)
+            total_squares += numpy.square(chunk).sum(axis=0)
+            minimum = numpy.minimum(minimum, chunk.min(axis=0))
+            maximum = numpy.maximum(maximum, chunk.max(axis=0))
+        mean = total / max(count, 1)
+        variance = numpy.maximum(total_squares / max(count, 1) - numpy.square(mean), 0)
+        return pandas.DataFrame(dict(
+            count=count,
+            mean=mean,
+            std=numpy.sqrt(variance),
+            min=minimum,
+            max=maximum,
+        ), index=columns)
@@ -0,0 +1,235 @@
+import glob
+import json
+import pickle
+import re
+import time
+from collections import deque
+from datetime import datetime
+
+import numpy
+import pandas
+import umap as umap_lib
+
+from .cache import get_result_key
+from .constants import MODELS_FOLDER
+from .instrumentation import record
+from .knn import get_knn_graph
+from .preprocessing import FeaturePreprocessor
+from .read_vectors import get_case_vector
+from .schema import CLASS_COLUMNS, get_classifications
+
+DEFAULT_SAMPLE_SIZE = 50000
+DEFAULT_BATCH_SIZE = 20000
+# share of a group the incremental model may not have been fit on before it is refit
+DEFAULT_REFIT_THRESHOLD = 0.2
+
+# models loaded by this process, so pool workers unpickle a model once rather than once per batch
+_loaded_models = {}
+
+
+def get_strata(case_names, rois=None):
+    """
+    Return the case and most probable class of every row of the cases, in the order of a
+    FeatureCorpus of the same cases.
+    """
+    strata = []
+    for case_name in case_names:
+        vector = get_case_vector(case_name, rois=rois, columns=CLASS_COLUMNS)
+        strata.append(pandas.DataFrame(dict(
+            case=case_name,
+            classification=numpy.asarray(get_classifications(vector)).astype(str),
+        )))
+    return pandas.concat(strata, ignore_index=True)
+
+
+def get_stratified_sample(strata, sample_size=DEFAULT_SAMPLE_SIZE, seed=0):
+    """
+    Choose corpus rows to fit a shared model on. Every case gets an equal share of the sample,
+    so one large slide does not dominate the embedding; within a case the share is split in
+    proportion to class counts, with at least one row of every class that occurs.
+    """
+    rng = numpy.random.default_rng(seed)
+    case_share = sample_size / max(1, strata['case'].nunique())
+    rows = []
+    for _, case_strata in strata.groupby('case', sort=False):
+        n_case = min(len(case_strata), round(case_share))
+        for positions in case_strata.groupby('classification').indices.values():
+            n = min(len(positions), max(1, round(n_case * len(positions) / len(case_strata))))
+            rows.append(case_strata.index.to_numpy()[rng.choice(positions, n, replace=False)])
+    return numpy.sort(numpy.concatenate(rows)) if rows else numpy.array([], dtype=int)
+
+
+def fit_shared_preprocessor(strata, sample_rows, rois=None, exclude_column_patterns=None):
+    """
+    Fit one FeaturePreprocessor on the sampled rows of every case, so every case of the
+    corpus is transformed into the same columns as the rows the shared model is fit on.
+    """
+    sample = []
+    for case_name, case_strata in strata.groupby('case', sort=False):
+        case_start = case_strata.index[0]
+        case_rows = sample_rows[(sample_rows >= case_start) & (sample_rows < case_start + len(case_strata))]
+        vector = get_case_vector(case_name, rois=rois)
+        sample.append(vector.iloc[case_rows - case_start])
+    return FeaturePreprocessor(exclude_column_patterns).fit(pandas.concat(sample, ignore_index=True))
+
+
+def get_model_files(key):
+    return MODELS_FOLDER / f'{key}.pkl', MODELS_FOLDER / f'{key}.json'
+
+
+def fit_shared_model(
+    corpus, sample_rows, use_cache=True, n_components=2, n_neighbors=15, init='random',
+):
+    """
+    Fit one UMAP on the sampled corpus rows and save it. The model is keyed on the sample content,
+    the columns and the parameters, so a later run with the same selection loads it instead.
+    Return the path of the pickled model.
+    """
+    sample = corpus.get(sample_rows)
+    params = dict(n_components=n_components, n_neighbors=n_neighbors, init=init)
+    key = get_result_key(sample, corpus.columns, 'shared-umap', params)
+    model_file, meta_file = get_model_files(key)
+    if use_cache and model_file.exists() and meta_file.exists():
+        print(f'Using shared UMAP fit on {len(sample)} features.')
+        return model_file
+
+    print(f'Fitting shared UMAP on {len(sample)} features from {len(corpus.cases)} case(s)... ', end='')
+    start = datetime.now()
+    with record('shared_fit', rows=len(sample), columns=len(corpus.columns)):
+        reducer = umap_lib.UMAP(**params).fit(sample)
+    MODELS_FOLDER.mkdir(parents=True, exist_ok=True)
+    with open(model_file, 'wb') as f:
+        pickle.dump(reducer, f)
+    with open(meta_file, 'w') as f:
+        json.dump(dict(
+            reducer='umap',
+            params=params,
+            cases=corpus.cases,
+            columns=corpus.columns,
+            rows=len(sample),
+            created=time.time(),
+        ), f)
+    print(f'Completed in {datetime.now() - start} seconds.')
+    return model_file
+
+
+def load_model(model_file):
+    model_file = str(model_file)
+    if model_file not in _loaded_models:
+        with open(model_file, 'rb') as f:
+            _loaded_models[model_file] = pickle.load(f)
+    return _loaded_models[model_file]
+
+
+def transform_batch(model_file, batch):
+    return load_model(model_file).transform(batch)
+
+
+def transform_case(
+    corpus, case_name, model_file, batch_size=DEFAULT_BATCH_SIZE, executor=None, max_pending=4, index=None,
+):
+    """
+    Project every row of a case into the shared embedding, in batches of `batch_size` rows.
+    With an `executor`, batches are transformed in its worker processes; at most `max_pending`
+    batches are in flight at a time so memory stays bounded for large cases.
+    Pass the corpus `index` when projecting several cases, so it is only built once.
+    """
+    case_rows = corpus.case_rows(case_name)
+    starts = range(case_rows.start, case_rows.stop, batch_size)
+    print(f'\tProjecting {case_rows.stop - case_rows.start} features into shared UMAP... ', end='')
+    start = datetime.now()
+    outputs = []
+    with record('shared_transform', rows=case_rows.stop - case_rows.start, columns=len(corpus.columns)):
+        if executor is not None:
+            pending = deque()
+            for batch_start in starts:
+                batch = corpus.get(slice(batch_start, min(batch_start + batch_size, case_rows.stop)))
+                pending.append(executor.submit(transform_batch, model_file, batch))
+                if len(pending) >= max_pending:
+                    outputs.append(pending.popleft().result())
+            outputs.extend(future.result() for future in pending)
+        else:
+            for batch_start in starts:
+                batch = corpus.get(slice(batch_start, min(batch_start + batch_size, case_rows.stop)))
+                outputs.append(transform_batch(model_file, batch))
+    print(f'Completed in {datetime.now() - start} seconds.')
+    result = numpy.concatenate(outputs) if outputs else numpy.empty((0, 2))
+    if index is None:
+        index = corpus.index
+    index = index.iloc[case_rows]
+    return pandas.DataFrame(result, index=pandas.Index(index['row'].to_numpy()), columns=['x', 'y'])
+
+
+def get_nucleus_ids(roinames):
+    # a nucleus is identified by its ROI and its position in that ROI, which adding other ROIs does not change
+    roinames = pandas.Series(numpy.asarray(roinames, dtype=str))
+    return (roinames + ':' + roinames.groupby(roinames).cumcount().astype(str)).to_numpy()
+
+
+def get_incremental_files(case_name, group_name, params, columns):
+    # the model is only reused with the same reducer parameters and feature columns
+    key = get_result_key(numpy.empty(0), columns, 'incremental-umap', params)[:12]
+    folder = MODELS_FOLDER / 'incremental' / case_name
+    return folder / f'{group_name}-{key}.pkl', folder / f'{group_name}-{key}.parquet'
+
+
+def prune_incremental_files(case_name, group_name, keep):
+    # a model saved with other parameters or columns is never loaded again for this group
+    pattern = re.compile(rf'{re.escape(group_name)}-[0-9a-f]{{12}}')
+    for path in (MODELS_FOLDER / 'incremental' / case_name).glob(f'{glob.escape(group_name)}-*'):
+        if path not in keep and pattern.fullmatch(path.stem):
+            path.unlink(missing_ok=True)
+
+
+def update_embedding(
+    matrix, roinames, case_name, group_name, columns=None, refit_threshold=DEFAULT_REFIT_THRESHOLD,
+    use_cache=True, n_components=2, n_neighbors=15, min_dist=0.1, init='random', entry=None,
+):
+    """
+    Embed a group with the UMAP kept from earlier runs of the same case and group. Nuclei the
+    model has already placed keep their coordinates and only new ones are projected into it,
+    unless the nuclei the model was not fit on make up more than `refit_threshold` of the group;
+    then the model is refit on every nucleus. Return the coordinates of every row, in row order.
+    If given, the record `entry` is updated with the number of new nuclei and whether the model was refit.
+    """
+    ids = get_nucleus_ids(roinames)
+    params = dict(n_components=n_components, n_neighbors=n_neighbors, min_dist=min_dist, init=init)
+    model_file, embedding_file = get_incremental_files(case_name, group_name, params, columns)
+    embedding = None
+    if use_cache and model_file.exists() and embedding_file.exists():
+        embedding = pandas.read_parquet(embedding_file)
+        embedding = embedding[embedding.index.isin(ids)]
+
+    is_new = ~numpy.isin(ids, embedding.index) if embedding is not None else numpy.ones(len(ids), dtype=bool)
+    not_fitted = is_new.sum() + (int((~embedding['fitted']).sum()) if embedding is not None else 0)
+    refit = embedding is None or not_fitted > refit_threshold * len(ids)
+    if entry is not None:
+        entry.update(new=int(is_new.sum()), refit=bool(refit))
+    start = datetime.now()
+    if refit:
+        print(f'\tFitting incremental UMAP for {len(ids)} features... ', end='')
+        # the search index is kept with the graph so the model can project new nuclei later
+        precomputed_knn = (None, None, None)
+        if len(matrix) > n_neighbors:
+            precomputed_knn = get_knn_graph(matrix, n_neighbors, use_cache=use_cache, with_index=True)
+        reducer = umap_lib.UMAP(**params, precomputed_knn=precomputed_knn).fit(matrix)
+        embedding = pandas.DataFrame(reducer.embedding_, index=pandas.Index(ids), columns=['x', 'y'])
+        embedding['fitted'] = True
+        model_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(model_file, 'wb') as f:
+            pickle.dump(reducer, f)
+        _loaded_models[str(model_file)] = reducer
+    elif is_new.any():
+        print(f'\tProjecting {is_new.sum()} new features into the UMAP of {len(ids) - is_new.sum()} features... ', end='')
+        new_embedding = pandas.DataFrame(
+            load_model(model_file).transform(matrix[is_new]), index=pandas.Index(ids[is_new]), columns=['x', 'y'],
+        )
+        new_embedding['fitted'] = False
+        embedding = pandas.concat([embedding, new_embedding])
+    else:
+        print(f'\tUsing the UMAP of {len(ids)} features.')
+        return embedding.loc[ids, ['x', 'y']].to_numpy()
+    embedding.to_parquet(embedding_file)
+    prune_incremental_files(case_name, group_name, keep=(model_file, embedding_file))
+    print(f'Completed in {datetime.now() - start} seconds.')
+    return embedding.loc[ids, ['x', 'y']].to_numpy()
@@ -8,6 +8,7 @@ import girder_client
 import requests
 
 from .constants import CONF, DOWNLOADS_FOLDER
+from .instrumentation import record, start_run
 from .read_vectors import get_case_vector
 from .client import get_client, get_case_folder_item, sync_file
 
@@ -30,7 +31,8 @@ def download_examples(cases):
         case_name = case_folder_item.get('name')
         if (cases is None and 'test' not in case_name) or (cases is not None and case_name in cases):
             print(f'Downloading {case_name}.')
-            client.downloadFolderRecursive(case_folder_item.get('_id'), DOWNLOADS_FOLDER / case_name)
+            with record('download', case=case_name):
+                client.downloadFolderRecursive(case_folder_item.get('_id'), DOWNLOADS_FOLDER / case_name)
 
     print(f'Completed download in {datetime.now() - start} seconds.')
 
@@ -60,7 +62,8 @@ def upload_examples(cases, username=None, password=None):
                     vector = get_case_vector(case_name=case_name)
                     vector.to_parquet(parquet_path)
                 print(f'Uploading parquet file for {case_name}.')
-                sync_file(client, case_folder_item, parquet_path)
+                with record('upload', case=case_name):
+                    sync_file(client, case_folder_item, parquet_path)
     print(f'Completed upload in {datetime.now() - start} seconds.')
 
 
@@ -87,6 +90,7 @@ def main(raw_args=None):
         args.get('username'),
         args.get('password'),
     )
+    start_run(f'examples-{command}')
 
     if command == 'upload':
         upload_examples(cases, username=username, password=password)
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+
+import numpy
+import pandas
+
+from .constants import COLUMN_NAMES, MATRIX_CACHE_FOLDER
+from .feature_store import build_feature_store
+from .instrumentation import record
+from .preprocessing import FeaturePreprocessor, compile_patterns
+from .read_vectors import get_case_vector
+
+# bump to invalidate every cached matrix when the cleaning steps change
+MATRIX_CACHE_VERSION = 2
+
+
+def resolve_exclude_columns(exclude_column_patterns):
+    pattern = compile_patterns(exclude_column_patterns)
+    if pattern is None:
+        return []
+    return [c for c in COLUMN_NAMES if pattern.match(c)]
+
+
+def get_matrix_key(case_name, rois, preprocessor, manifest):
+    params = preprocessor.get_params()
+    # patterns are keyed by the columns they resolve to, so equivalent patterns share a matrix
+    exclude_columns = resolve_exclude_columns(params.pop('exclude_column_patterns')) + params.pop('exclude_columns')
+    key = dict(
+        version=MATRIX_CACHE_VERSION,
+        case=case_name,
+        rois=sorted(rois) if rois is not None else None,
+        exclude_columns=sorted(exclude_columns),
+        preprocessor=params,
+        columns=preprocessor.columns,
+        # source mtimes tie the matrix to the feature store contents it was built from
+        sources={roi_name: roi_record.get('mtimes') for roi_name, roi_record in manifest['rois'].items()},
+    )
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_matrix_files(case_name, key):
+    case_folder = MATRIX_CACHE_FOLDER / case_name
+    return (
+        case_folder / f'{key}.npy',
+        case_folder / f'{key}.index.parquet',
+        case_folder / f'{key}.json',
+    )
+
+
+def get_feature_matrix(
+    case_name, rois=None, exclude_column_patterns=None, vector=None, use_cache=True, preprocessor=None,
+):
+    """
+    Return the preprocessed float32 feature matrix of a case along with its row index and column names.
+    The matrix is cached as a .npy file and reopened memory-mapped on later calls with the same
+    case, ROI selection and preprocessing. If the case vector is already loaded, pass it as
+    `vector` to avoid reading it again on a cache miss. Pass a fitted `preprocessor` to apply the
+    transform of another case; otherwise one is fit to this case with `exclude_column_patterns`.
+    """
+    if preprocessor is None:
+        preprocessor = FeaturePreprocessor(exclude_column_patterns)
+    manifest = build_feature_store(case_name)
+    key = get_matrix_key(case_name, rois, preprocessor, manifest)
+    matrix_file, index_file, columns_file = get_matrix_files(case_name, key)
+
+    with record('preprocess', case=case_name) as entry:
+        if use_cache and matrix_file.exists() and index_file.exists() and columns_file.exists():
+            index = pandas.read_parquet(index_file)
+            if vector is None or len(vector) == len(index):
+                with open(columns_file) as f:
+                    columns = json.load(f).get('columns')
+                if not preprocessor.is_fitted:
+                    preprocessor.columns = columns
+                entry.update(cache='hit', rows=len(index), columns=len(columns))
+                return numpy.load(matrix_file, mmap_mode='r'), index, columns
+
+        if vector is None:
+            vector = get_case_vector(case_name, rois=rois)
+        if not preprocessor.is_fitted:
+            preprocessor.fit(vector)
+        matrix = preprocessor.transform(vector)
+        index = pandas.DataFrame(dict(roiname=vector['roiname'].to_numpy()), index=vector.index)
+        columns = list(preprocessor.columns)
+        entry.update(cache='miss', rows=len(matrix), columns=len(columns))
+
+        matrix_file.parent.mkdir(parents=True, exist_ok=True)
+        # write under a temporary name so an interrupted run never leaves a truncated matrix
+        tmp_matrix_file = matrix_file.with_suffix('.tmp.npy')
+        numpy.save(tmp_matrix_file, matrix)
+        os.replace(tmp_matrix_file, matrix_file)
+        index.to_parquet(index_file)
+        with open(columns_file, 'w') as f:
+            json.dump(dict(
+                case=case_name,
+                rois=rois,
+                preprocessor=preprocessor.get_params(),
+                columns=columns,
+            ), f)
+    return numpy.load(matrix_file, mmap_mode='r'), index, columns
@@ -0,0 +1,168 @@
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas
+import pyarrow
+import pyarrow.parquet as pq
+from pyarrow import csv
+
+from .constants import DOWNLOADS_FOLDER, FEATURE_STORE_FOLDER
+from .instrumentation import record
+from .schema import CSV_COLUMN_TYPES, apply_schema, concat_vectors
+
+# bump to invalidate every existing store when the stored layout changes
+STORE_VERSION = 3
+MANIFEST_FILENAME = 'manifest.json'
+PARTITION_FILENAME = 'part-0.parquet'
+
+
+def read_vector_file(filepath):
+    # pyarrow names the unlabeled index column '' where pandas would use 'Unnamed: 0'
+    table = csv.read_csv(
+        str(filepath),
+        read_options=csv.ReadOptions(use_threads=False),
+        # empty strings are missing values, as read_csv reads them
+        convert_options=csv.ConvertOptions(column_types=CSV_COLUMN_TYPES, strings_can_be_null=True),
+    )
+    table = table.drop([
+        name for name in table.column_names
+        if name == '' or 'Unnamed' in name
+    ])
+    # columns without any values are inferred as null; pandas reads them as float64
+    for i, field in enumerate(table.schema):
+        if pyarrow.types.is_null(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pyarrow.float64()))
+    return table.to_pandas()
+
+
+def read_roi_vector(meta_vector_file, prop_vector_file):
+    meta = read_vector_file(meta_vector_file)
+    props = read_vector_file(prop_vector_file)
+    intersection_cols = list(meta.columns.intersection(props.columns))
+    props = props.drop(intersection_cols, axis=1)
+    return pandas.concat([meta, props], axis=1)
+
+
+def pair_vector_files(meta_vector_files, prop_vectors, rois=None):
+    prop_vector_files = {f.name: f for f in prop_vectors.glob('*.csv')}
+    roi_vector_files = {}
+    for meta_vector_file in meta_vector_files:
+        roi_name = meta_vector_file.name.replace('.csv', '')
+        if rois is None or roi_name in rois:
+            prop_vector_file = prop_vector_files.get(meta_vector_file.name)
+            if prop_vector_file:
+                roi_vector_files[roi_name] = (meta_vector_file, prop_vector_file)
+            else:
+                print('No prop file for', meta_vector_file.name)
+    return roi_vector_files
+
+
+def get_store_folder(case_name):
+    return FEATURE_STORE_FOLDER / case_name
+
+
+def get_partition_path(store_folder, roi_name):
+    return store_folder / f'roiname={roi_name}' / PARTITION_FILENAME
+
+
+def read_manifest(store_folder):
+    manifest_file = store_folder / MANIFEST_FILENAME
+    if manifest_file.exists():
+        with open(manifest_file) as f:
+            try:
+                manifest = json.load(f)
+                if manifest.get('version') == STORE_VERSION:
+                    return manifest
+            except json.JSONDecodeError:
+                pass
+    return dict(version=STORE_VERSION, columns=[], rois={})
+
+
+def write_roi_partition(store_folder, roi_name, vector_files):
+    vector = apply_schema(read_roi_vector(*vector_files))
+    partition_path = get_partition_path(store_folder, roi_name)
+    partition_path.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(
+        pyarrow.Table.from_pandas(vector, preserve_index=False),
+        partition_path,
+    )
+    return list(vector.columns), len(vector)
+
+
+def build_feature_store(case_name, max_workers=None):
+    """
+    Sync the parquet store of a case with its downloaded CSVs and return its manifest.
+    Only ROIs whose nucleiMeta/nucleiProps mtimes changed since the last build are re-read.
+    The returned manifest lists ROIs in source file order.
+    """
+    case_folder = next(DOWNLOADS_FOLDER.glob(case_name))
+    store_folder = get_store_folder(case_name)
+    meta_vector_files = list((case_folder / 'nucleiMeta').glob('*.csv'))
+    roi_vector_files = pair_vector_files(meta_vector_files, case_folder / 'nucleiProps')
+    manifest = read_manifest(store_folder)
+
+    roi_records = {}
+    stale_rois = []
+    for roi_name, vector_files in roi_vector_files.items():
+        mtimes = [f.stat().st_mtime_ns for f in vector_files]
+        roi_record = manifest['rois'].get(roi_name)
+        if (
+            roi_record is None or roi_record.get('mtimes') != mtimes or
+            not get_partition_path(store_folder, roi_name).exists()
+        ):
+            roi_record = dict(mtimes=mtimes)
+            stale_rois.append(roi_name)
+        roi_records[roi_name] = roi_record
+
+    for roi_name in manifest['rois']:
+        if roi_name not in roi_records:
+            shutil.rmtree(get_partition_path(store_folder, roi_name).parent, ignore_errors=True)
+
+    changed = len(stale_rois) or roi_records.keys() != manifest['rois'].keys()
+    manifest['rois'] = roi_records
+    if changed:
+        with record('ingest', case=case_name, rois=len(stale_rois)) as entry, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            written = executor.map(
+                lambda roi_name: write_roi_partition(store_folder, roi_name, roi_vector_files[roi_name]),
+                stale_rois,
+            )
+            for roi_name, (columns, n_rows) in zip(stale_rois, written):
+                roi_records[roi_name]['rows'] = n_rows
+                # the manifest lists the union of the ROI columns, in the order they were first seen
+                known_columns = set(manifest['columns'])
+                new_columns = [c for c in columns if c not in known_columns]
+                if len(manifest['columns']) and (new_columns or len(columns) < len(manifest['columns'])):
+                    print(f'\tColumns of {roi_name} differ from other regions of {case_name}; missing values are filled.')
+                manifest['columns'] = manifest['columns'] + new_columns
+            entry.update(rows=sum(roi_records[roi_name]['rows'] for roi_name in stale_rois), columns=len(manifest['columns']))
+        store_folder.mkdir(parents=True, exist_ok=True)
+        with open(store_folder / MANIFEST_FILENAME, 'w') as f:
+            json.dump(manifest, f)
+    return manifest
+
+
+def read_roi_partition(case_name, roi_name, columns=None):
+    partition_path = get_partition_path(get_store_folder(case_name), roi_name)
+    if columns is not None:
+        # a ROI may lack some columns of the store; they are filled when ROIs are concatenated
+        partition_columns = set(pq.read_schema(partition_path).names)
+        columns = [c for c in columns if c in partition_columns]
+    return pq.read_table(partition_path, columns=columns, use_threads=False).to_pandas()
+
+
+def get_store_columns(case_name, columns=None):
+    manifest = read_manifest(get_store_folder(case_name))
+    if columns is None:
+        return None
+    return [c for c in manifest['columns'] if c in columns]
+
+
+def read_feature_store(case_name, roi_names, columns=None, max_workers=None):
+    columns = get_store_columns(case_name, columns)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        vectors = list(executor.map(
+            lambda roi_name: read_roi_partition(case_name, roi_name, columns=columns),
+            roi_names,
+        ))
+    return concat_vectors(vectors)
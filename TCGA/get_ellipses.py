@@ -1,9 +1,31 @@
 import argparse
 import json
+
 import pandas
 
-from .read_vectors import get_case_vector
 from .constants import DOWNLOADS_FOLDER, ELLIPSES_FOLDER
+from .read_vectors import get_roi_region, iter_case_rois
+from .schema import to_wide_numpy
+
+ELLIPSE_COLUMNS = [
+    'roiname',
+    'Unconstrained.Identifier.CentroidX',
+    'Unconstrained.Identifier.CentroidY',
+    'Size.MinorAxisLength',
+    'Size.MajorAxisLength',
+    'Orientation.Orientation',
+]
+
+
+def get_roi_ellipses(roi_name, roi_vector):
+    roi = get_roi_region(roi_name)
+    return pandas.DataFrame(dict(
+        x=to_wide_numpy(roi_vector["Unconstrained.Identifier.CentroidX"]) * 2 + roi.get('left'),
+        y=to_wide_numpy(roi_vector["Unconstrained.Identifier.CentroidY"]) * 2 + roi.get('top'),
+        width=to_wide_numpy(roi_vector["Size.MinorAxisLength"]) * 2,
+        height=to_wide_numpy(roi_vector["Size.MajorAxisLength"]) * 2,
+        orientation=0 - to_wide_numpy(roi_vector["Orientation.Orientation"]),
+    ))
 
 
 def get_ellipses(cases=None):
@@ -11,26 +33,18 @@ def get_ellipses(cases=None):
     for case_folder in DOWNLOADS_FOLDER.glob('*'):
         case_name = case_folder.name
         if (cases is None and 'test' not in case_name) or (cases is not None and case_name in cases):
-            ellipses = pandas.DataFrame([], columns=['x', 'y', 'width', 'height', 'orientation'])
-            vector = get_case_vector(case_name=case_name)
-            for roi_name, roi_group in list(vector.groupby('roiname')):
-                components = roi_name.split('_')[2:]
-                roi = {}
-                for component in components:
-                    key, value = component.split('-')
-                    roi[key] = int(value)
-                for index, row in roi_group.iterrows():
-                    ellipses.loc[len(ellipses)] = dict(
-                        x=row["Unconstrained.Identifier.CentroidX"] * 2 + roi.get('left'),
-                        y=row["Unconstrained.Identifier.CentroidY"] * 2 + roi.get('top'),
-                        width=row["Size.MinorAxisLength"] * 2,
-                        height=row["Size.MajorAxisLength"] * 2,
-                        orientation=0 - row["Orientation.Orientation"],
-                    )
+            n_ellipses = 0
+            # ROIs are read and written one at a time so memory is bounded by the largest ROI
             with open(ELLIPSES_FOLDER / f'{case_name}.json', 'w') as f:
-                contents = ellipses.to_dict(orient='records')
-                json.dump(contents, f)
-                print(f'Wrote {len(ellipses)} ellipses to {f.name}.')
+                f.write('[')
+                for roi_name, roi_vector in iter_case_rois(case_name, columns=ELLIPSE_COLUMNS):
+                    for record in get_roi_ellipses(roi_name, roi_vector).to_dict(orient='records'):
+                        if n_ellipses > 0:
+                            f.write(', ')
+                        f.write(json.dumps(record))
+                        n_ellipses += 1
+                f.write(']')
+                print(f'Wrote {n_ellipses} ellipses to {f.name}.')
 
 
 def main(raw_args=None):
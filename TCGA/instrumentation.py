@@ -0,0 +1,141 @@
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from datetime import datetime
+
+from .constants import RUN_LOGS_FOLDER
+
+# the run settings live in environment variables so spawned worker processes inherit them
+RUN_LOG_VARIABLE = 'TCGA_RUN_LOG'
+PROFILE_VARIABLE = 'TCGA_PROFILE'
+CONTEXT_VARIABLE = 'TCGA_RUN_CONTEXT'
+
+# only the outermost record of a process is profiled; cProfile does not nest
+_active_profiler = None
+
+
+def start_run(name, profile=False):
+    """
+    Start writing records to a new run log, RUN_LOGS_FOLDER/<name>-<timestamp>.jsonl.
+    With `profile`, each outermost record also saves a cProfile file next to the log.
+    """
+    RUN_LOGS_FOLDER.mkdir(parents=True, exist_ok=True)
+    run_log = RUN_LOGS_FOLDER / f'{name}-{datetime.now().strftime("%Y%m%d-%H%M%S")}.jsonl'
+    os.environ[RUN_LOG_VARIABLE] = str(run_log)
+    if profile:
+        os.environ[PROFILE_VARIABLE] = str(run_log.with_suffix(''))
+    else:
+        os.environ.pop(PROFILE_VARIABLE, None)
+    os.environ[CONTEXT_VARIABLE] = json.dumps(dict(run=run_log.stem))
+    return run_log
+
+
+def get_context():
+    return json.loads(os.environ.get(CONTEXT_VARIABLE, '{}'))
+
+
+@contextlib.contextmanager
+def context(**labels):
+    """Add labels, such as the case name, to every record made inside this block."""
+    previous = os.environ.get(CONTEXT_VARIABLE)
+    os.environ[CONTEXT_VARIABLE] = json.dumps({**get_context(), **labels}, default=str)
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop(CONTEXT_VARIABLE, None)
+        else:
+            os.environ[CONTEXT_VARIABLE] = previous
+
+
+def get_peak_rss_mb():
+    """Return the peak RSS over the lifetime of the process."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / 1024 ** (2 if sys.platform == 'darwin' else 1)
+
+
+def get_rss_mb():
+    """Return the current RSS of the process, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * resource.getpagesize() / 1024 ** 2
+
+
+def write_record(entry):
+    run_log = os.environ.get(RUN_LOG_VARIABLE)
+    if run_log is None:
+        return
+    # one write per line; appends from concurrent processes do not interleave
+    with open(run_log, 'a') as f:
+        f.write(json.dumps(entry, default=str) + '\n')
+
+
+def get_profile_path(entry):
+    profile_folder = os.environ.get(PROFILE_VARIABLE)
+    if profile_folder is None:
+        return None
+    name = '-'.join(
+        str(entry[k]).replace('/', '_').replace(' ', '_')
+        for k in ('case', 'stage', 'group') if entry.get(k) is not None
+    )
+    return f'{profile_folder}/{name}-{os.getpid()}-{time.monotonic_ns()}.prof'
+
+
+@contextlib.contextmanager
+def record(stage, **fields):
+    """
+    Measure the block as one stage and append it to the run log as a JSON line with
+    wall time, CPU time and memory. The yielded dict can be updated inside the block
+    with more fields, e.g. rows, columns or cache='hit'.
+
+    The process peak RSS only grows, so a stage records how much it raised the peak,
+    peak_rss_delta_mb, along with the current RSS at its start and end.
+    """
+    global _active_profiler
+    entry = dict(get_context(), stage=stage, **fields)
+    profiler = None
+    profile_path = get_profile_path(entry)
+    if profile_path is not None and _active_profiler is None:
+        profiler = _active_profiler = cProfile.Profile()
+        profiler.enable()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    rss_start, peak_start = get_rss_mb(), get_peak_rss_mb()
+    try:
+        yield entry
+    except Exception as e:
+        entry['error'] = str(e)
+        raise
+    finally:
+        entry['wall_seconds'] = round(time.perf_counter() - wall_start, 6)
+        entry['cpu_seconds'] = round(time.process_time() - cpu_start, 6)
+        rss_end = get_rss_mb()
+        entry['rss_start_mb'] = None if rss_start is None else round(rss_start, 2)
+        entry['rss_end_mb'] = None if rss_end is None else round(rss_end, 2)
+        entry['peak_rss_delta_mb'] = round(get_peak_rss_mb() - peak_start, 2)
+        if profiler is not None:
+            profiler.disable()
+            _active_profiler = None
+            os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+            profiler.dump_stats(profile_path)
+            entry['profile'] = profile_path
+        write_record(entry)
+
+
+def describe(value):
+    """Return the row and column counts of a stage output, when it has them."""
+    if isinstance(value, tuple) and len(value):
+        value = value[0]
+    shape = getattr(value, 'shape', None)
+    if shape is not None and len(shape) == 2:
+        return dict(rows=int(shape[0]), columns=int(shape[1]))
+    if isinstance(value, dict) and len(value) and all(hasattr(v, 'shape') for v in value.values()):
+        return dict(rows=int(sum(v.shape[0] for v in value.values())), groups=len(value))
+    return {}
@@ -0,0 +1,137 @@
+import os
+import pickle
+
+import numpy
+from pynndescent import NNDescent
+
+from .cache import hash_matrix
+from .constants import KNN_CACHE_FOLDER
+from .instrumentation import record
+
+# graphs are built with at least this many neighbors, so any smaller n_neighbors reuses them
+KNN_MAX_NEIGHBORS = 30
+# least recently used graphs are evicted once the cache grows past this size
+KNN_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+
+def get_graph_files(matrix_hash, metric, n_neighbors):
+    name = f'{matrix_hash}-{metric}-{n_neighbors}'
+    return KNN_CACHE_FOLDER / f'{name}.npz', KNN_CACHE_FOLDER / f'{name}.pkl'
+
+
+def find_cached_graph(matrix_hash, metric, n_neighbors):
+    # the smallest cached graph with enough neighbors is the cheapest to load
+    candidates = []
+    for graph_file in KNN_CACHE_FOLDER.glob(f'{matrix_hash}-{metric}-*.npz'):
+        k = graph_file.stem.rsplit('-', 1)[-1]
+        if k.isdigit() and int(k) >= n_neighbors:
+            candidates.append(int(k))
+    return min(candidates) if candidates else None
+
+
+def load_graph(matrix_hash, metric, n_neighbors, with_index=False):
+    """
+    Return the cached (indices, distances, search index) triple, with the index only if `with_index`.
+    Return None if another process evicted the graph after it was found.
+    """
+    graph_file, index_file = get_graph_files(matrix_hash, metric, n_neighbors)
+    try:
+        with numpy.load(graph_file) as graph:
+            indices, distances = graph['indices'], graph['distances']
+        index = None
+        if with_index:
+            with open(index_file, 'rb') as f:
+                index = pickle.load(f)
+        # the modification time of the graph file records the last use of an entry
+        os.utime(graph_file)
+    except FileNotFoundError:
+        return None
+    return indices, distances, index
+
+
+def build_knn_graph(matrix, n_neighbors, metric='euclidean'):
+    # the same forest and iteration settings UMAP uses for its own neighbor search
+    n_trees = min(64, 5 + int(round(matrix.shape[0] ** 0.5 / 20.0)))
+    n_iters = max(5, int(round(numpy.log2(matrix.shape[0]))))
+    index = NNDescent(
+        matrix,
+        n_neighbors=n_neighbors,
+        metric=metric,
+        n_trees=n_trees,
+        n_iters=n_iters,
+        max_candidates=60,
+        low_memory=True,
+        compressed=False,
+    )
+    indices, distances = index.neighbor_graph
+    return indices, distances, index
+
+
+def get_knn_graph(
+    matrix, n_neighbors, metric='euclidean', use_cache=True, with_index=False,
+    matrix_hash=None, max_neighbors=KNN_MAX_NEIGHBORS,
+):
+    """
+    Return the approximate nearest neighbors of every row of `matrix`, as the (indices, distances,
+    search index) triple UMAP accepts for `precomputed_knn`. Graphs are stored in KNN_CACHE_FOLDER,
+    keyed on the matrix content, the metric and the number of neighbors, and are built with
+    `max_neighbors` neighbors so later runs with any n_neighbors up to that reuse them.
+    The search index, needed to transform new data, is only loaded with `with_index`.
+    """
+    matrix_hash = matrix_hash or hash_matrix(matrix)
+    # a graph can not have more neighbors than there are other rows
+    k = min(max(n_neighbors, max_neighbors), len(matrix) - 1)
+    with record('knn', rows=int(matrix.shape[0]), n_neighbors=n_neighbors) as entry:
+        graph = None
+        cached_k = find_cached_graph(matrix_hash, metric, n_neighbors) if use_cache else None
+        if cached_k is not None:
+            graph = load_graph(matrix_hash, metric, cached_k, with_index)
+        if graph is not None:
+            entry['cache'] = 'hit'
+            indices, distances, index = graph
+        else:
+            entry['cache'] = 'miss'
+            indices, distances, index = build_knn_graph(matrix, k, metric)
+            KNN_CACHE_FOLDER.mkdir(parents=True, exist_ok=True)
+            graph_file, index_file = get_graph_files(matrix_hash, metric, k)
+            # write under temporary names so other workers never load a partial graph
+            tmp_graph_file = graph_file.with_suffix(f'.{os.getpid()}.tmp.npz')
+            tmp_index_file = index_file.with_suffix(f'.{os.getpid()}.tmp.pkl')
+            numpy.savez(tmp_graph_file, indices=indices, distances=distances)
+            with open(tmp_index_file, 'wb') as f:
+                pickle.dump(index, f)
+            os.replace(tmp_index_file, index_file)
+            os.replace(tmp_graph_file, graph_file)
+            prune()
+    # UMAP only trims a larger graph itself on inputs of 4096 rows or more
+    return indices[:, :n_neighbors], distances[:, :n_neighbors], index
+
+
+def prune(max_bytes=KNN_CACHE_MAX_BYTES):
+    """Evict least recently used graphs until the cache fits in max_bytes. Return the evicted names."""
+    entries = []
+    for graph_file in KNN_CACHE_FOLDER.glob('*.npz'):
+        if graph_file.name.endswith('.tmp.npz'):
+            continue
+        index_file = graph_file.with_suffix('.pkl')
+        # other workers may evict or replace entries while the cache is listed
+        try:
+            graph_stat = graph_file.stat()
+        except FileNotFoundError:
+            continue
+        try:
+            index_size = index_file.stat().st_size
+        except FileNotFoundError:
+            index_size = 0
+        entries.append((graph_stat.st_mtime, graph_stat.st_size + index_size, graph_file, index_file))
+    entries.sort(key=lambda e: e[0])
+    total = sum(e[1] for e in entries)
+    removed = []
+    for _, size, graph_file, index_file in entries:
+        if total <= max_bytes:
+            break
+        graph_file.unlink(missing_ok=True)
+        index_file.unlink(missing_ok=True)
+        total -= size
+        removed.append(graph_file.stem)
+    return removed
@@ -0,0 +1,55 @@
+import contextlib
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numba
+from threadpoolctl import threadpool_limits
+
+THREAD_ENV_VARIABLES = [
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'NUMBA_NUM_THREADS',
+]
+
+
+def get_thread_share(n_workers):
+    # inside a worker, nested pools split that worker's share instead of the whole machine
+    budget = int(os.environ.get('OMP_NUM_THREADS', os.cpu_count() or 1))
+    return max(1, budget // max(1, n_workers))
+
+
+def limit_threads(n_threads):
+    # environment variables cover libraries loaded later; loaded ones are limited directly
+    for variable in THREAD_ENV_VARIABLES:
+        os.environ[variable] = str(n_threads)
+    threadpool_limits(n_threads)
+    numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+
+
+def get_process_pool(n_workers):
+    """
+    Create a process pool in which each worker is limited to its share of the BLAS/numba threads.
+    Workers are spawned rather than forked so they never inherit a running thread pool.
+    """
+    return ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=limit_threads,
+        initargs=(get_thread_share(n_workers),),
+    )
+
+
+def run_captured(func, *args, **kwargs):
+    # buffer everything a task prints so concurrent tasks do not interleave their logs
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            result = func(*args, **kwargs)
+    except Exception:
+        # a failed task still shows what it printed, ahead of its traceback
+        print(log.getvalue(), end='', flush=True)
+        raise
+    return result, log.getvalue()
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import shutil
+
+import numpy
+import pandas
+
+from .instrumentation import describe, record
+
+# bump to invalidate every stored artifact when the pipeline layout changes
+PIPELINE_VERSION = 1
+
+
+class Artifact():
+    """Describes how a stage output is type checked, saved and loaded."""
+    python_type = object
+    persist = True
+
+    def check(self, stage_name, value):
+        if not isinstance(value, self.python_type):
+            raise TypeError(
+                f'Stage "{stage_name}" returned {type(value).__name__}, '
+                f'expected {self.python_type.__name__}.'
+            )
+
+    def save(self, value, path):
+        raise NotImplementedError
+
+    def load(self, path):
+        raise NotImplementedError
+
+
+class TransientArtifact(Artifact):
+    # outputs that are cheap to recompute or already cached elsewhere are never written
+    persist = False
+
+
+class JSONArtifact(Artifact):
+    python_type = dict
+
+    def save(self, value, path):
+        with open(path, 'w') as f:
+            json.dump(value, f)
+
+    def load(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+
+class FrameArtifact(Artifact):
+    python_type = pandas.DataFrame
+
+    def save(self, value, path):
+        value.to_parquet(path)
+
+    def load(self, path):
+        return pandas.read_parquet(path)
+
+
+class FramesArtifact(Artifact):
+    """A dict of named DataFrames, such as one result per group."""
+    python_type = dict
+
+    def check(self, stage_name, value):
+        super().check(stage_name, value)
+        for name, frame in value.items():
+            if not isinstance(frame, pandas.DataFrame):
+                raise TypeError(f'Stage "{stage_name}" returned {type(frame).__name__} for "{name}", expected DataFrame.')
+
+    def save(self, value, path):
+        path.mkdir(parents=True, exist_ok=True)
+        names = list(value.keys())
+        for i, name in enumerate(names):
+            value[name].to_parquet(path / f'{i}.parquet')
+        # names are written last; a folder without them is an incomplete artifact
+        with open(path / 'names.json', 'w') as f:
+            json.dump(names, f)
+
+    def load(self, path):
+        with open(path / 'names.json') as f:
+            names = json.load(f)
+        return {name: pandas.read_parquet(path / f'{i}.parquet') for i, name in enumerate(names)}
+
+
+class LabelsArtifact(Artifact):
+    """A dict of named integer label sequences, such as cluster labels per group, in one parquet file."""
+    python_type = dict
+
+    def save(self, value, path):
+        names = list(value.keys())
+        lengths = [len(labels) for labels in value.values()]
+        labels = numpy.concatenate([numpy.asarray(labels) for labels in value.values()]) if names else []
+        pandas.DataFrame(dict(
+            group=pandas.Categorical.from_codes(numpy.repeat(numpy.arange(len(names)), lengths), categories=names),
+            # the smallest integer type that holds every label
+            label=pandas.to_numeric(pandas.Series(labels, dtype='int64'), downcast='integer'),
+        )).to_parquet(path)
+
+    def load(self, path):
+        frame = pandas.read_parquet(path)
+        return {
+            name: labels.tolist()
+            # every category is a group, so a group without labels loads as an empty list
+            for name, labels in frame.groupby('group', observed=False, sort=False)['label']
+        }
+
+
+TRANSIENT = TransientArtifact()
+JSON = JSONArtifact()
+FRAME = FrameArtifact()
+FRAMES = FramesArtifact()
+LABELS = LabelsArtifact()
+
+
+class Stage():
+    """
+    A pipeline step. `func` is called with the outputs of the `inputs` stages and the `params`
+    as keyword arguments. The stage fingerprint covers `params`, the input fingerprints and
+    `dependencies`, which invalidate the stage (e.g. source file mtimes) without being passed to `func`.
+    Execution options that do not change the output (worker counts, credentials) should be bound
+    into `func` instead.
+    """
+    def __init__(self, name, func, inputs=None, params=None, dependencies=None, output=TRANSIENT, version=1):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs or [])
+        self.params = dict(params or {})
+        self.dependencies = dependencies
+        self.output = output
+        self.version = version
+
+
+class Pipeline():
+    """
+    Run declared stages on demand, storing persisted outputs under their fingerprint.
+    Requesting a stage only computes it, and the inputs it needs, when no artifact with
+    a matching fingerprint exists; `force` recomputes every requested stage.
+    """
+    def __init__(self, folder, stages, force=False):
+        self._folder = folder
+        self._stages = {stage.name: stage for stage in stages}
+        self._force = force
+        self._fingerprints = {}
+        self._values = {}
+        self.computed = []
+
+    def fingerprint(self, name):
+        if name not in self._fingerprints:
+            stage = self._stages[name]
+            key = dict(
+                version=PIPELINE_VERSION,
+                stage=name,
+                stage_version=stage.version,
+                params=stage.params,
+                dependencies=stage.dependencies,
+                inputs={i: self.fingerprint(i) for i in stage.inputs},
+            )
+            self._fingerprints[name] = hashlib.sha1(
+                json.dumps(key, sort_keys=True, default=str).encode()
+            ).hexdigest()[:16]
+        return self._fingerprints[name]
+
+    def artifact_path(self, name):
+        return self._folder / name / self.fingerprint(name)
+
+    def has_artifact(self, name):
+        stage = self._stages[name]
+        path = self.artifact_path(name)
+        if not stage.output.persist:
+            return False
+        if isinstance(stage.output, FramesArtifact):
+            return (path / 'names.json').exists()
+        return path.exists()
+
+    def get(self, name):
+        if name in self._values:
+            return self._values[name]
+        stage = self._stages[name]
+        if not self._force and self.has_artifact(name):
+            with record(name, cache='hit') as entry:
+                value = stage.output.load(self.artifact_path(name))
+                entry.update(describe(value))
+        else:
+            inputs = {i: self.get(i) for i in stage.inputs}
+            # inputs are resolved first, so each record only covers its own stage
+            with record(name, **(dict(cache='miss') if stage.output.persist else {})) as entry:
+                value = stage.func(**inputs, **stage.params)
+                stage.output.check(name, value)
+                self.computed.append(name)
+                if stage.output.persist:
+                    self.save(name, value)
+                entry.update(describe(value))
+        self._values[name] = value
+        return value
+
+    def save(self, name, value):
+        path = self.artifact_path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.is_dir():
+            shutil.rmtree(path)
+        self._stages[name].output.save(value, path)
+        # only the latest artifact of a stage is kept; older fingerprints are never requested again
+        for other in path.parent.iterdir():
+            if other.name != path.name:
+                if other.is_dir():
+                    shutil.rmtree(other, ignore_errors=True)
+                else:
+                    other.unlink(missing_ok=True)
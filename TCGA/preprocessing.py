@@ -0,0 +1,158 @@
+import json
+import re
+
+import numpy
+import pandas
+from sklearn.decomposition import IncrementalPCA
+
+# value used for missing feature values before normalization
+FILL_VALUE = -1
+# rows normalized at a time, bounding the temporary arrays used for the row norms
+NORMALIZE_CHUNK_SIZE = 100000
+# rows fit and projected at a time by the PCA stage
+PCA_CHUNK_SIZE = 50000
+
+
+def compile_patterns(patterns):
+    # one alternation matched from the start of the name, like re.match with each pattern
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+
+class FeaturePreprocessor():
+    """
+    Select, clean and normalize the feature columns of a vector.
+    `fit` resolves the exclude patterns against the columns of a vector once and keeps
+    the remaining float columns; `transform` copies those columns into a single float32
+    array, replaces missing values with `fill_value` and L1-normalizes each row in place.
+    A fitted preprocessor can be saved and loaded to apply the same transform to other cases.
+    """
+    def __init__(self, exclude_column_patterns=None, exclude_columns=None, normalize=True, fill_value=FILL_VALUE):
+        self.exclude_column_patterns = list(exclude_column_patterns or [])
+        self.exclude_columns = list(exclude_columns or [])
+        self.normalize = normalize
+        self.fill_value = fill_value
+        self.columns = None
+
+    @property
+    def is_fitted(self):
+        return self.columns is not None
+
+    def fit(self, vector):
+        pattern = compile_patterns(self.exclude_column_patterns)
+        excluded = set(self.exclude_columns)
+        self.columns = [
+            c for c in vector.columns
+            if pandas.api.types.is_float_dtype(vector[c].dtype) and
+            c not in excluded and
+            (pattern is None or pattern.match(c) is None)
+        ]
+        return self
+
+    def transform(self, vector, out=None):
+        """
+        Return the preprocessed float32 matrix of `vector`, with one column per fitted column.
+        Columns that `vector` does not have are filled with `fill_value`.
+        If `out` is given, the result is written into it instead of a new array.
+        """
+        if not self.is_fitted:
+            raise AttributeError('FeaturePreprocessor has not been fit yet. Run `fit` first.')
+        present = [c for c in self.columns if c in vector.columns]
+        if out is None and len(present) == len(self.columns):
+            # the only copy made; it never shares memory with the vector, so it can be modified in place
+            out = vector[self.columns].to_numpy(dtype=numpy.float32, copy=True)
+        elif len(present) == len(self.columns):
+            out[:] = vector[self.columns].to_numpy(dtype=numpy.float32)
+        else:
+            if out is None:
+                out = numpy.empty((len(vector), len(self.columns)), dtype=numpy.float32)
+            positions = {c: j for j, c in enumerate(self.columns)}
+            out[:] = self.fill_value
+            out[:, [positions[c] for c in present]] = vector[present].to_numpy(dtype=numpy.float32)
+        numpy.nan_to_num(out, copy=False, nan=self.fill_value)
+        if self.normalize:
+            normalize_rows(out)
+        return out
+
+    def fit_transform(self, vector, out=None):
+        return self.fit(vector).transform(vector, out=out)
+
+    def get_params(self):
+        return dict(
+            exclude_column_patterns=self.exclude_column_patterns,
+            exclude_columns=self.exclude_columns,
+            normalize=self.normalize,
+            fill_value=self.fill_value,
+        )
+
+    def save(self, path):
+        if not self.is_fitted:
+            raise AttributeError('FeaturePreprocessor has not been fit yet. Run `fit` first.')
+        with open(path, 'w') as f:
+            json.dump(dict(**self.get_params(), columns=self.columns), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            state = json.load(f)
+        preprocessor = cls(**{k: v for k, v in state.items() if k != 'columns'})
+        preprocessor.columns = state.get('columns')
+        return preprocessor
+
+
+def normalize_rows(matrix, chunk_size=NORMALIZE_CHUNK_SIZE):
+    # same result as sklearn.preprocessing.normalize(matrix, norm='l1'), without copying the matrix
+    for start in range(0, len(matrix), chunk_size):
+        chunk = matrix[start:start + chunk_size]
+        norms = numpy.abs(chunk).sum(axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        numpy.divide(chunk, norms, out=chunk)
+    return matrix
+
+
+def get_chunks(n_rows, chunk_size, min_size=1):
+    # a last chunk shorter than min_size joins the one before it
+    starts = list(range(0, n_rows, chunk_size))
+    if len(starts) > 1 and n_rows - starts[-1] < min_size:
+        starts.pop()
+    return list(zip(starts, starts[1:] + [n_rows]))
+
+
+def reduce_components(matrix, n_components, chunk_size=PCA_CHUNK_SIZE):
+    """
+    Project `matrix` onto its first `n_components` principal components. The PCA is fit and
+    applied one chunk of rows at a time, so a memory-mapped matrix is never read into memory whole.
+    Return the float32 projection and the fitted IncrementalPCA.
+    """
+    # every partial fit needs at least n_components rows
+    chunks = get_chunks(len(matrix), max(chunk_size, n_components), min_size=n_components)
+    pca = IncrementalPCA(n_components=n_components)
+    for start, end in chunks:
+        pca.partial_fit(matrix[start:end])
+    out = numpy.empty((len(matrix), n_components), dtype=numpy.float32)
+    for start, end in chunks:
+        out[start:end] = pca.transform(matrix[start:end])
+    return out, pca
+
+
+def find_duplicate_rows(matrix, chunk_size=NORMALIZE_CHUNK_SIZE):
+    """
+    Group the identical rows of `matrix`. Return the position of the first row of each group,
+    the group of every row and the number of rows in each group, so that `matrix[first][groups]`
+    equals `matrix`. Rows are grouped by a vectorized hash of their values and then compared with
+    the first row of their group, so a hash collision only skips deduplication, never merges rows.
+    """
+    chunks = get_chunks(len(matrix), chunk_size)
+    hashes = numpy.empty(len(matrix), dtype=numpy.uint64)
+    for start, end in chunks:
+        hashes[start:end] = pandas.util.hash_pandas_object(pandas.DataFrame(matrix[start:end]), index=False).to_numpy()
+    groups, unique_hashes = pandas.factorize(hashes)
+    # factorize numbers groups in order of appearance, so assigning in reverse leaves each group's first row
+    first = numpy.empty(len(unique_hashes), dtype=numpy.intp)
+    first[groups[::-1]] = numpy.arange(len(matrix))[::-1]
+    for start, end in chunks:
+        if not numpy.array_equal(matrix[start:end], matrix[first[groups[start:end]]]):
+            positions = numpy.arange(len(matrix))
+            return positions, positions, numpy.ones(len(matrix), dtype=numpy.intp)
+    return first, groups, numpy.bincount(groups)
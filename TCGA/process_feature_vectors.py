@@ -1,23 +1,258 @@
 import argparse
 import getpass
-import re
-import json
-import pandas
+from concurrent.futures import as_completed
+from functools import partial
 from pathlib import Path
 
+import pandas
 from matplotlib import colormaps
-from sklearn.preprocessing import normalize
 
-from .annotations import upload_annotation, clear_annotations, write_annotation
-from .constants import (ANNOTATIONS_FOLDER, CLASS_PREFIX, COLUMN_NAMES,
-                        DOWNLOADS_FOLDER, REDUCE_DIMS_RESULTS_FOLDER)
+from .annotations import clear_annotations, upload_annotation, write_annotation
+from .clustering import (CLUSTER_METHODS, CORRECTION_METHODS,
+                         DEFAULT_CLUSTER_METHOD, DEFAULT_SCORE_METHOD,
+                         MAX_CLUSTERS, N_CORRELATION_COLS, RANDOM_STATE,
+                         SCORE_METHODS, SIGNIFICANCE_LEVEL,
+                         SILHOUETTE_SAMPLE_SIZE,
+                         find_cluster_distinction_columns, find_clusters,
+                         print_distinction_columns)
+from .constants import (ANNOTATIONS_FOLDER, DOWNLOADS_FOLDER, PIPELINE_FOLDER,
+                        REDUCE_DIMS_RESULTS_FOLDER)
+from .embedding import DEFAULT_REFIT_THRESHOLD
+from .feature_matrix import MATRIX_CACHE_VERSION, get_feature_matrix
+from .feature_store import build_feature_store
+from .instrumentation import context, record, start_run
+from .parallel import get_process_pool, run_captured
+from .pipeline import FRAME, FRAMES, JSON, LABELS, Pipeline, Stage
 from .read_vectors import get_case_vector
-from .reduce_dims import plot_results, tsne, umap
-from .clustering import find_clusters, find_cluster_distinction_columns
+from .reduce_dims import (MIN_GROUP_SIZES, REDUCERS, apply_pca, get_reducer,
+                          incremental_umap, plot_results)
+from .scheduler import schedule_tasks
+from .schema import get_classifications
+
+
+def load_vector(case_name, rois):
+    return get_case_vector(case_name, rois=rois)
+
+
+def assign_groups(vector, groupby):
+    if groupby == 'roi':
+        labels = vector['roiname'].astype('category')
+    elif groupby == 'class':
+        labels = get_classifications(vector)
+    else:
+        labels = pandas.Categorical(['all'] * len(vector))
+    return pandas.DataFrame(dict(group=labels), index=vector.index)
+
+
+def get_group_positions(groups):
+    # group order matches grouping the vector by the same attribute
+    return groups.groupby('group', observed=True).indices
+
+
+def clean_matrix(vector, case_name, rois, exclude_column_patterns, use_cache=True):
+    return get_feature_matrix(
+        case_name,
+        rois=rois,
+        exclude_column_patterns=exclude_column_patterns,
+        vector=vector,
+        use_cache=use_cache,
+    )
+
+
+def project_matrix(matrix, pca_components=None):
+    matrix, index, columns = matrix
+    return apply_pca(matrix, pca_components), index, columns
+
+
+def reduce_groups(
+    groups, components, reduce_dims_func, min_group_size,
+    case_name, group_logs, use_cache=True, group_workers=1, incremental=False, refit_threshold=DEFAULT_REFIT_THRESHOLD,
+):
+    matrix, matrix_index, columns = components
+    min_size = min_group_size if min_group_size is not None else MIN_GROUP_SIZES.get(reduce_dims_func, 1)
+    reduce_func = get_reducer(reduce_dims_func)
+    if incremental:
+        reduce_func = partial(incremental_umap, case_name=case_name, refit_threshold=refit_threshold)
+    group_positions = get_group_positions(groups)
+
+    # schedule dimensionality reductions for every group large enough to embed
+    tasks = {}
+    for group_name, positions in group_positions.items():
+        if len(positions) >= min_size:
+            result_filepath = Path(REDUCE_DIMS_RESULTS_FOLDER, reduce_dims_func, case_name, f'{group_name}.parquet')
+            group_matrix = matrix if len(positions) == len(matrix) else matrix[positions]
+            kwargs = dict(use_cache=use_cache, index=groups.index[positions], columns=columns)
+            if incremental:
+                kwargs.update(roinames=matrix_index['roiname'].to_numpy()[positions], group_name=str(group_name))
+            tasks[group_name] = (len(positions), reduce_func, (group_matrix, result_filepath), kwargs)
+        else:
+            group_logs[group_name] = f'\tSkipping {reduce_dims_func.upper()} for {len(positions)} features; at least {min_size} are required.\n'
+    reductions = schedule_tasks(tasks, workers=group_workers)
+
+    all_results = {}
+    for group_name in group_positions:
+        if group_name in reductions:
+            result, group_logs[group_name] = reductions[group_name]
+            if result is not None:
+                all_results[group_name] = result
+    return all_results
+
+
+def write_group_annotations(vector, groups, case_name, group_logs, reductions=None):
+    annotation_files = {}
+    for group_name, positions in get_group_positions(groups).items():
+        print(f'\tEvaluating group "{group_name}".')
+        print(group_logs.get(group_name, ''), end='')
+        result = reductions.get(group_name) if reductions is not None else None
+        annotation_filepath = Path(ANNOTATIONS_FOLDER, case_name, f'{group_name}.json')
+        with record('annotation', group=group_name, rows=len(positions)):
+            write_annotation(annotation_filepath, vector.iloc[positions], result, group_name)
+        annotation_files[group_name] = str(annotation_filepath)
+    return annotation_files
+
+
+def cluster_groups(reductions, max_clusters, score_method, cluster_method, group_workers=1):
+    return find_clusters(
+        reductions, max_clusters=max_clusters, score_method=score_method, workers=group_workers, method=cluster_method,
+    )
+
+
+def find_group_distinctions(vector, groups, clusters, case_name, correction=None, effect_size=False):
+    group_vectors = (
+        (group_name, vector.iloc[positions])
+        for group_name, positions in get_group_positions(groups).items()
+    )
+    return find_cluster_distinction_columns(
+        case_name, None, group_vectors, print_results=True, clusters=clusters,
+        correction=correction, effect_size=effect_size,
+    )
+
+
+def upload_group_annotations(annotations, case_name, username, password):
+    clear_annotations(case_name, username, password)
+    for group_name, annotation_filepath in annotations.items():
+        with record('upload_annotation', group=group_name):
+            upload_annotation(case_name, Path(annotation_filepath), username, password)
+    return annotations
+
+
+def get_case_pipeline(
+    case_name, rois, reduce_dims, reduce_dims_func, no_cache, exclude_column_patterns, groupby,
+    username=None, password=None, group_workers=1, min_group_size=None, max_clusters=MAX_CLUSTERS,
+    pca_components=None, incremental=False, refit_threshold=DEFAULT_REFIT_THRESHOLD, score_method=DEFAULT_SCORE_METHOD,
+    cluster_method=DEFAULT_CLUSTER_METHOD, correction=None, effect_size=False,
+):
+    """
+    Declare the stages that process one case. Each stage is fingerprinted by its parameters
+    and inputs, so a rerun only recomputes the stages downstream of a changed setting.
+    """
+    manifest = build_feature_store(case_name)
+    sources = {roi_name: roi_record.get('mtimes') for roi_name, roi_record in manifest['rois'].items()}
+    # logs of reductions computed in this run, printed with their group's annotation;
+    # annotations are cheap to write and stay transient so every run reports each group
+    group_logs = {}
+    stages = [
+        Stage(
+            'vector', partial(load_vector, case_name=case_name),
+            params=dict(rois=sorted(rois) if rois is not None else None),
+            dependencies=sources,
+        ),
+        Stage(
+            'groups', assign_groups,
+            inputs=['vector'], params=dict(groupby=groupby), output=FRAME,
+        ),
+        Stage(
+            'matrix', partial(clean_matrix, case_name=case_name, rois=rois, use_cache=not no_cache),
+            inputs=['vector'], params=dict(exclude_column_patterns=exclude_column_patterns),
+            dependencies=dict(matrix_version=MATRIX_CACHE_VERSION),
+        ),
+        Stage(
+            'components', project_matrix,
+            inputs=['matrix'], params=dict(pca_components=pca_components),
+        ),
+        Stage(
+            'reductions', partial(
+                reduce_groups,
+                case_name=case_name,
+                group_logs=group_logs,
+                use_cache=not no_cache,
+                group_workers=group_workers,
+            ),
+            inputs=['groups', 'components'],
+            params=dict(
+                reduce_dims_func=reduce_dims_func,
+                min_group_size=min_group_size,
+                incremental=incremental,
+                refit_threshold=refit_threshold,
+            ),
+            output=FRAMES,
+        ),
+        Stage(
+            'annotations', partial(write_group_annotations, case_name=case_name, group_logs=group_logs),
+            inputs=['vector', 'groups'] + (['reductions'] if reduce_dims else []),
+        ),
+        Stage(
+            'upload', partial(upload_group_annotations, case_name=case_name, username=username, password=password),
+            inputs=['annotations'],
+        ),
+        Stage(
+            'clusters', partial(cluster_groups, group_workers=group_workers),
+            inputs=['reductions'],
+            params=dict(max_clusters=max_clusters, score_method=score_method, cluster_method=cluster_method),
+            dependencies=dict(random_state=RANDOM_STATE, silhouette_sample_size=SILHOUETTE_SAMPLE_SIZE),
+            output=LABELS,
+        ),
+        Stage(
+            'distinctions', partial(find_group_distinctions, case_name=case_name),
+            inputs=['vector', 'groups', 'clusters'],
+            params=dict(correction=correction, effect_size=effect_size),
+            dependencies=dict(significance_level=SIGNIFICANCE_LEVEL, n_columns=N_CORRELATION_COLS),
+            output=JSON,
+        ),
+    ]
+    return Pipeline(PIPELINE_FOLDER / case_name, stages, force=no_cache)
+
+
+def process_case(
+    case_name, rois, upload, reduce_dims, reduce_dims_func, no_cache, exclude_column_patterns, groupby, clusters, cluster_distinctions,
+    username=None, password=None, group_workers=1, min_group_size=None, max_clusters=MAX_CLUSTERS,
+    pca_components=None, incremental=False, refit_threshold=DEFAULT_REFIT_THRESHOLD, score_method=DEFAULT_SCORE_METHOD,
+    cluster_method=DEFAULT_CLUSTER_METHOD, correction=None, effect_size=False,
+):
+    print(f'Evaluating {case_name}.')
+    with context(case=case_name):
+        pipeline = get_case_pipeline(
+            case_name, rois, reduce_dims, reduce_dims_func, no_cache, exclude_column_patterns, groupby,
+            username=username, password=password, group_workers=group_workers,
+            min_group_size=min_group_size, max_clusters=max_clusters, pca_components=pca_components,
+            incremental=incremental, refit_threshold=refit_threshold, score_method=score_method,
+            cluster_method=cluster_method, correction=correction, effect_size=effect_size,
+        )
+
+        all_results = {}
+        if reduce_dims:
+            all_results = pipeline.get('reductions')
+        pipeline.get('annotations')
+        if upload:
+            pipeline.get('upload')
+
+        # find clusters
+        cluster_results = None
+        if reduce_dims and clusters:
+            cluster_results = pipeline.get('clusters')
+            if cluster_distinctions:
+                distinction_columns = pipeline.get('distinctions')
+                if 'distinctions' not in pipeline.computed:
+                    print_distinction_columns(distinction_columns)
+
+    return all_results, cluster_results
 
 
 def process_feature_vectors(
     cases, rois, upload, reduce_dims, reduce_dims_func, no_cache, plot, exclude_column_patterns, groupby, clusters, cluster_distinctions,
+    workers=1, group_workers=1, min_group_size=None, max_clusters=MAX_CLUSTERS, pca_components=None,
+    incremental=False, refit_threshold=DEFAULT_REFIT_THRESHOLD, score_method=DEFAULT_SCORE_METHOD,
+    cluster_method=DEFAULT_CLUSTER_METHOD, correction=None, effect_size=False,
 ):
     username = None
     password = None
@@ -26,110 +261,53 @@ def process_feature_vectors(
         username = input('Girder Username: ')
         password = getpass.getpass('Girder Password: ')
 
+    case_names = []
     for case in DOWNLOADS_FOLDER.glob('*'):
         case_name = case.name.split('.')[0]
         if cases is None or case_name in cases:
-            print(f'Evaluating {case_name}.')
-            vector = None
-            groups = None
-            all_results = {}
-
-            # manage result files
-            case_results_folder = REDUCE_DIMS_RESULTS_FOLDER / reduce_dims_func / case_name
-            if not case_results_folder.exists():
-                case_results_folder.mkdir(parents=True, exist_ok=True)
-            group_records_file =  case_results_folder / 'all_groups.json'
-            group_records = {}
-            if group_records_file.exists():
-                with open(group_records_file) as f:
-                    try:
-                        group_records = json.load(f)
-                    except json.JSONDecodeError:
-                        pass
-
-            # avoid loading case vector if only using previous result files
-            if not (upload or no_cache):
-                group_names = group_records.get(groupby)
-                if group_names is not None:
-                    for group_name in group_names:
-                        group_result_file = case_results_folder / f'{group_name}.parquet'
-                        if group_result_file.exists():
-                            group_result = pandas.read_parquet(group_result_file)
-                            all_results[group_name] = group_result
-
-            # clear annotations if uploading new ones
-            if upload:
-                clear_annotations(case_name, username, password)
-
-            if not len(all_results):
-                vector = get_case_vector(case_name, rois=rois)
-
-                # create groups
-                groups = {'all': vector}.items()
-                if groupby == 'roi':
-                    groups = vector.groupby('roiname')
-                if groupby == 'class':
-                    class_cols = [c for c in COLUMN_NAMES if CLASS_PREFIX in c]
-                    classes = [c.replace(CLASS_PREFIX, '') for c in vector[class_cols].idxmax(axis=1)]
-                    vector = vector.assign(classification=classes)
-                    groups = vector.groupby('classification')
-
-                # record groups
-                if groupby is not None:
-                    group_records[groupby] = list(groups.groups.keys())
-                    with open(group_records_file, 'w') as f:
-                        json.dump(group_records, f)
-
-                # evaluate groups
-                for group_name, group in groups:
-                    print(f'\tEvaluating group "{group_name}".')
-                    group_copy = group.copy()
-
-                    # remove any excluded columns
-                    if exclude_column_patterns is not None:
-                        group_copy = group_copy.drop([
-                            c for c in COLUMN_NAMES if any(re.match(fr'{pattern}', c) for pattern in exclude_column_patterns)
-                        ], axis=1, errors='ignore')
-
-                    # clean and normalize data
-                    group_copy = group_copy.drop([
-                        c for c in group_copy.columns
-                        if str(group_copy[c].dtype) != 'float64'
-                    ], axis=1).fillna(-1)
-                    normalize(group_copy, axis=1, norm='l1')
-
-                    # get dimensionality reduction results
-                    result = None
-                    if reduce_dims:
-                        result_filepath = Path(REDUCE_DIMS_RESULTS_FOLDER, reduce_dims_func, case_name, f'{group_name}.parquet')
-                        if reduce_dims_func == 'umap':
-                            result = umap(group_copy, result_filepath, use_cache=not no_cache)
-                        elif reduce_dims_func == 'tsne':
-                            result = tsne(group_copy, result_filepath, use_cache=not no_cache)
-
-                    if result is not None:
-                        all_results[group_name] = result
-
-                    annotation_filepath = Path(ANNOTATIONS_FOLDER, case_name, f'{group_name}.json')
-                    write_annotation(annotation_filepath, group, result, group_name)
-
-                    if upload:
-                        upload_annotation(case_name, annotation_filepath, username, password)
-
-            # find clusters
-            cluster_results = None
-            if reduce_dims and clusters:
-                clusters_file = case_results_folder / 'clusters.json'
-                cluster_results = find_clusters(all_results, clusters_file=clusters_file, use_cache=not no_cache)
-                if cluster_distinctions:
-                    find_cluster_distinction_columns(case_name, clusters_file, groups, print_results=True)
+            case_names.append(case_name)
 
+    case_args = (
+        rois, upload, reduce_dims, reduce_dims_func, no_cache, exclude_column_patterns, groupby, clusters, cluster_distinctions,
+    )
+    case_kwargs = dict(
+        username=username,
+        password=password,
+        group_workers=group_workers,
+        min_group_size=min_group_size,
+        max_clusters=max_clusters,
+        pca_components=pca_components,
+        incremental=incremental,
+        refit_threshold=refit_threshold,
+        score_method=score_method,
+        cluster_method=cluster_method,
+        correction=correction,
+        effect_size=effect_size,
+    )
+    if workers is not None and workers > 1 and len(case_names) > 1:
+        # each worker gets an equal share of the BLAS/numba threads; case logs are printed whole
+        n_workers = min(workers, len(case_names))
+        with get_process_pool(n_workers) as executor:
+            futures = {
+                executor.submit(run_captured, process_case, case_name, *case_args, **case_kwargs): case_name
+                for case_name in case_names
+            }
+            for future in as_completed(futures):
+                (all_results, cluster_results), log = future.result()
+                print(log, end='')
+                # show result plot
+                if reduce_dims and plot:
+                    plot_results(all_results, title=futures[future], cluster_results=cluster_results)
+    else:
+        for case_name in case_names:
+            all_results, cluster_results = process_case(case_name, *case_args, **case_kwargs)
             # show result plot
             if reduce_dims and plot:
                 plot_results(all_results, title=case_name, cluster_results=cluster_results)
 
     print('Done.')
 
+
 def main(raw_args=None):
     parser = argparse.ArgumentParser(
         prog="FeatureVectorProcess",
@@ -152,7 +330,7 @@ def main(raw_args=None):
         help='Reduce dimensionality of feature vectors and include results in annotation.'
     )
     parser.add_argument(
-        '--reduce-dims-func', choices=['umap', 'tsne'], default='umap',
+        '--reduce-dims-func', choices=list(REDUCERS), default='umap',
         help='Function to use for dimensionality reduction. Only used if --reduce-dims is specified. Default=umap.'
     )
     parser.add_argument(
@@ -179,7 +357,59 @@ def main(raw_args=None):
         '--cluster-distinctions', action='store_true',
         help='Determine which columns are most statistically different between clusters. Only used if --reduce-dims and --clusters are specified.'
     )
+    parser.add_argument(
+        '--correction', choices=CORRECTION_METHODS,
+        help='Adjust cluster distinction p-values for the number of columns tested. Only used if --cluster-distinctions is specified.'
+    )
+    parser.add_argument(
+        '--effect-size', action='store_true',
+        help='Report the p-value and effect size (eta squared) of each cluster distinction column. Only used if --cluster-distinctions is specified.'
+    )
+    parser.add_argument(
+        '--max-clusters', type=int, default=MAX_CLUSTERS,
+        help=f'Upper bound (exclusive) on the number of clusters to try. Only used if --clusters is specified. Default={MAX_CLUSTERS}.'
+    )
+    parser.add_argument(
+        '--cluster-method', choices=CLUSTER_METHODS, default=DEFAULT_CLUSTER_METHOD,
+        help=f'Clustering algorithm; minibatch-kmeans and hdbscan scale to larger groups. Only used if --clusters is specified. Default={DEFAULT_CLUSTER_METHOD}.'
+    )
+    parser.add_argument(
+        '--cluster-score', choices=list(SCORE_METHODS), default=DEFAULT_SCORE_METHOD,
+        help=f'Score used to choose the number of clusters. sampled-silhouette scores a sample of groups with more than {SILHOUETTE_SAMPLE_SIZE} features. Only used if --clusters is specified. Default={DEFAULT_SCORE_METHOD}.'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of cases to process in parallel worker processes. Default=1.'
+    )
+    parser.add_argument(
+        '--group-workers', type=int, default=1,
+        help='Number of groups to reduce and cluster in parallel worker processes, largest groups first. Default=1.'
+    )
+    parser.add_argument(
+        '--min-group-size', type=int,
+        help='Skip dimensionality reduction for groups with fewer features. Default depends on --reduce-dims-func.'
+    )
+    parser.add_argument(
+        '--pca-components', type=int,
+        help='Project the features onto this many principal components before dimensionality reduction, e.g. 50. Only used if --reduce-dims is specified.'
+    )
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Keep the fitted UMAP of each case and group and only project nuclei it has not seen, e.g. from newly added ROIs. Only used if --reduce-dims is specified.'
+    )
+    parser.add_argument(
+        '--refit-threshold', type=float, default=DEFAULT_REFIT_THRESHOLD,
+        help=f'Refit an incremental UMAP once this share of its group was not in its fit. Only used if --incremental is specified. Default={DEFAULT_REFIT_THRESHOLD}.'
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Save a cProfile file for each stage next to the run log in TCGA/run_logs.'
+    )
     args = vars(parser.parse_args(raw_args))
+    if args.get('incremental') and (args.get('reduce_dims_func') != 'umap' or args.get('pca_components')):
+        parser.error('--incremental only applies to a UMAP reduction without --pca-components.')
+    if args.get('max_clusters') < 3 and args.get('cluster_method') != 'hdbscan':
+        parser.error('--max-clusters is exclusive and must be at least 3 to try 2 clusters.')
     cases, rois, upload, reduce_dims, reduce_dims_func, no_cache, plot, exclude_column_patterns, groupby, clusters, cluster_distinctions = (
         args.get('cases'),
         args.get('rois'),
@@ -193,8 +423,20 @@ def main(raw_args=None):
         args.get('clusters'),
         args.get('cluster_distinctions')
     )
+    start_run('process_feature_vectors', profile=args.get('profile'))
     process_feature_vectors(
        cases, rois, upload, reduce_dims, reduce_dims_func, no_cache, plot, exclude_column_patterns, groupby, clusters, cluster_distinctions,
+       workers=args.get('workers'),
+       group_workers=args.get('group_workers'),
+       min_group_size=args.get('min_group_size'),
+       max_clusters=args.get('max_clusters'),
+       pca_components=args.get('pca_components'),
+       incremental=args.get('incremental'),
+       refit_threshold=args.get('refit_threshold'),
+       score_method=args.get('cluster_score'),
+       cluster_method=args.get('cluster_method'),
+       correction=args.get('correction'),
+       effect_size=args.get('effect_size'),
     )
 
 
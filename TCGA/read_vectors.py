@@ -1,43 +1,38 @@
-import pandas
+from .feature_store import (build_feature_store, get_store_columns,
+                            read_feature_store, read_roi_partition)
 
-from .constants import DOWNLOADS_FOLDER
 
+def get_roi_region(roi_name):
+    # assumes roiname is a string like "TCGA-3C-AALI-01Z-00-DX1_roi-0_left-15953_top-45779_right-18001_bottom-47827"
+    region = {}
+    for component in roi_name.split('_')[2:]:
+        key, value = component.split('-')
+        region[key] = int(value)
+    return region
 
-def get_case_vector(case_name, rois=None):
-    results = None
-    case_folder = next(DOWNLOADS_FOLDER.glob(case_name))
-    meta_vectors = case_folder / 'nucleiMeta'
-    prop_vectors = case_folder / 'nucleiProps'
-    meta_vector_files = list(meta_vectors.glob('*.csv'))
-    prop_vector_files = list(prop_vectors.glob('*.csv'))
-    num_regions = len(meta_vector_files) if rois is None else len(rois)
+
+def get_case_vector(case_name, rois=None, columns=None, max_workers=None):
+    manifest = build_feature_store(case_name, max_workers=max_workers)
+    num_regions = len(manifest['rois']) if rois is None else len(rois)
     print(f'\tReading features in {num_regions} region(s).')
 
-    for meta_vector_file in meta_vector_files:
-        roi_name = meta_vector_file.name.replace('.csv', '')
-        if rois is None or roi_name in rois:
-            prop_vector_file = next((
-                f for f in prop_vector_files
-                if f.name == meta_vector_file.name
-            ), None)
-            if prop_vector_file:
-                meta = pandas.read_csv(
-                    str(meta_vector_file),
-                    usecols=lambda x: 'Unnamed' not in x
-                ).reset_index(drop=True)
-                props = pandas.read_csv(
-                    str(prop_vector_file),
-                    usecols=lambda x: 'Unnamed' not in x
-                ).reset_index(drop=True)
-                intersection_cols = list(meta.columns.intersection(props.columns))
-                # print(intersection_cols)
-                props = props.drop(intersection_cols, axis=1)
-                vector = pandas.concat([meta, props], axis=1)
-                if results is None:
-                    results = vector
-                else:
-                    results = pandas.concat([results, vector])
-            else:
-                print('No prop file for', meta_vector_file.name)
+    # only the partitions and columns that were asked for are read from the store
+    roi_names = [
+        roi_name for roi_name in manifest['rois']
+        if rois is None or roi_name in rois
+    ]
+    results = read_feature_store(case_name, roi_names, columns=columns, max_workers=max_workers)
     print(f'\tFound {len(results)} features.')
     return results
+
+
+def iter_case_rois(case_name, rois=None, columns=None):
+    """
+    Yield (roi_name, vector) pairs for the selected ROIs of a case, reading one ROI partition at a time.
+    Peak memory depends on the largest ROI instead of the whole case.
+    """
+    manifest = build_feature_store(case_name)
+    columns = get_store_columns(case_name, columns)
+    for roi_name in manifest['rois']:
+        if rois is None or roi_name in rois:
+            yield roi_name, read_roi_partition(case_name, roi_name, columns=columns)
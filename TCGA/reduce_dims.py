@@ -1,96 +1,372 @@
 import argparse
+import itertools
 import math
 import os
-import re
 import warnings
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Union
 
 import matplotlib
 import matplotlib.pyplot as plt
+import numpy
 import pandas
 import umap as umap_lib
 from sklearn import manifold
-from sklearn.preprocessing import normalize
 
-from .constants import PLOTS_FOLDER, DOWNLOADS_FOLDER, REDUCE_DIMS_RESULTS_FOLDER, COLUMN_NAMES
-from .read_vectors import get_case_vector
-from .client import get_client, get_case_folder_item, sync_file
+try:
+    import openTSNE
+except ImportError:
+    openTSNE = None
+
+from .cache import get_result_key, hash_matrix, load_result, store_result
+from .client import get_case_folder_item, get_client, sync_file
+from .constants import (DOWNLOADS_FOLDER, PLOTS_FOLDER,
+                        REDUCE_DIMS_RESULTS_FOLDER)
+from .corpus import FeatureCorpus
+from .embedding import (DEFAULT_BATCH_SIZE, DEFAULT_REFIT_THRESHOLD,
+                        DEFAULT_SAMPLE_SIZE, fit_shared_model,
+                        fit_shared_preprocessor, get_strata,
+                        get_stratified_sample, transform_case,
+                        update_embedding)
+from .feature_matrix import get_feature_matrix
+from .instrumentation import context, record, start_run
+from .knn import get_knn_graph
+from .parallel import get_process_pool, get_thread_share, run_captured
+from .preprocessing import find_duplicate_rows, reduce_components
 
 # suppress warnings
 warnings.simplefilter("ignore")
 
+# reducers by name, filled by register_reducer
+REDUCERS = {}
+# smallest group each reducer can embed with its default parameters
+MIN_GROUP_SIZES = {}
+
+
+def get_input_matrix(vector, index=None, columns=None):
+    # reducers accept either a DataFrame or a (possibly memory-mapped) matrix with a separate index
+    if isinstance(vector, pandas.DataFrame):
+        return vector.to_numpy(), vector.index, list(vector.columns)
+    if index is None:
+        index = pandas.RangeIndex(len(vector))
+    return vector, index, columns
+
+
+def apply_pca(matrix, n_components=None):
+    """
+    Project a feature matrix onto `n_components` principal components before a reduction,
+    and report the share of variance they explain. Without `n_components`, or with at least
+    as many components as columns, return the matrix unchanged.
+    """
+    if not n_components or n_components >= matrix.shape[1] or len(matrix) < 2:
+        return matrix
+    n_components = min(n_components, len(matrix))
+    with record('pca', rows=int(matrix.shape[0]), columns=int(matrix.shape[1]), components=n_components) as entry:
+        result, pca = reduce_components(matrix, n_components)
+        explained_variance = float(pca.explained_variance_ratio_.sum())
+        entry['explained_variance'] = round(explained_variance, 4)
+    print(
+        f'\tReduced {matrix.shape[1]} columns to {n_components} principal components, '
+        f'explaining {explained_variance:.1%} of the variance.'
+    )
+    return result
+
+
+def cached_reduction(
+    reducer_name, compute, matrix, result_filepath, params, use_cache=True, index=None, columns=None,
+):
+    """
+    Run `compute(matrix, matrix_hash)` through the result cache. Results are keyed on the input content,
+    the columns, the reducer name and `params`, not on result_filepath, so every backend caches alike.
+    Identical rows are embedded once and share coordinates; the multiplicity column of the result
+    counts the rows with the same features, so clustering and plots can weight them.
+    Return the result as a DataFrame, or None if the reducer failed.
+    """
+    if result_filepath is not None and not result_filepath.parent.exists():
+        result_filepath.parent.mkdir(parents=True, exist_ok=True)
+
+    label = reducer_name.upper()
+    group = result_filepath.stem if result_filepath is not None else None
+    with record(reducer_name, group=group, rows=int(matrix.shape[0]), columns=int(matrix.shape[1])) as entry:
+        matrix_hash = hash_matrix(matrix)
+        key = get_result_key(matrix, columns, reducer_name, params, matrix_hash=matrix_hash)
+        if use_cache:
+            df = load_result(key, index)
+            if df is not None:
+                entry['cache'] = 'hit'
+                if result_filepath is not None:
+                    df.to_parquet(result_filepath)
+                return df
+
+        entry['cache'] = 'miss'
+        print(f'\tEvaluating {label} for {len(matrix)} features... ', end='')
+        start = datetime.now()
+        try:
+            first, groups, counts = find_duplicate_rows(matrix)
+            entry['unique_rows'] = len(first)
+            if len(first) < len(matrix):
+                result = numpy.asarray(compute(matrix[first], None))[groups]
+            else:
+                result = numpy.asarray(compute(matrix, matrix_hash))
+            df = pandas.DataFrame(
+                result,
+                index=index,
+                columns=['x', 'y', 'z'][:result.shape[1]]
+            )
+            df['multiplicity'] = counts[groups]
+            if result_filepath is not None:
+                df.to_parquet(result_filepath)
+            store_result(key, df, reducer_name, params, columns=columns)
+            print(f'Completed in {datetime.now() - start} seconds.')
+            return df
+        except Exception as e:
+            entry['error'] = str(e)
+            print(f'Error: {str(e)}. Skipping {label} evaluation.')
+
+
 def umap(
-    vector: pandas.DataFrame,
-    result_filepath: Path,
+    vector: Union[pandas.DataFrame, numpy.ndarray],
+    result_filepath: Optional[Path],
     use_cache: bool=True,
     n_components: int=2,
     n_neighbors: int=15,
-    init: str='random'
+    min_dist: float=0.1,
+    init: str='random',
+    index: Optional[pandas.Index]=None,
+    columns: Optional[List[str]]=None,
+    knn: Optional[tuple]=None,
 ):
-    if result_filepath.exists() and use_cache:
-        return pandas.read_parquet(result_filepath)
-    if not result_filepath.parent.exists():
-        result_filepath.parent.mkdir(parents=True, exist_ok=True)
+    matrix, index, columns = get_input_matrix(vector, index, columns)
+    params = dict(n_components=n_components, n_neighbors=n_neighbors, min_dist=min_dist, init=init)
 
-    print(f'\tEvaluating UMAP for {len(vector)} features... ', end='')
-    start = datetime.now()
-    # https://umap-learn.readthedocs.io/en/latest/parameters.html
-    reducer = umap_lib.UMAP(
-        n_components=n_components,
-        n_neighbors=n_neighbors,
-        init=init,
-    )
-    try:
-        result = reducer.fit_transform(vector.to_numpy())
-        df = pandas.DataFrame(
-            result,
-            index=vector.index,
-            columns=['x', 'y']
-        )
-        df.to_parquet(result_filepath)
-        print(f'Completed in {datetime.now() - start} seconds.')
-        return df
-    except Exception as e:
-        print(f'Error: {str(e)}. Skipping UMAP evaluation.')
+    def compute(matrix, matrix_hash):
+        # the neighbor graph depends only on the input, so it is shared by runs with other parameters;
+        # UMAP ignores a graph for groups no larger than n_neighbors, which are quick to embed anyway
+        precomputed_knn = (None, None, None)
+        if knn is not None and knn[0].shape[0] == len(matrix) and knn[0].shape[1] >= n_neighbors:
+            precomputed_knn = (knn[0][:, :n_neighbors], knn[1][:, :n_neighbors], None)
+        elif len(matrix) > n_neighbors:
+            precomputed_knn = get_knn_graph(matrix, n_neighbors, use_cache=use_cache, matrix_hash=matrix_hash)
+        # https://umap-learn.readthedocs.io/en/latest/parameters.html
+        return umap_lib.UMAP(
+            n_components=n_components,
+            n_neighbors=n_neighbors,
+            min_dist=min_dist,
+            init=init,
+            precomputed_knn=precomputed_knn,
+        ).fit_transform(matrix)
+
+    return cached_reduction('umap', compute, matrix, result_filepath, params, use_cache, index, columns)
 
 
 def tsne(
-    vector: pandas.DataFrame,
-    result_filepath: Path,
+    vector: Union[pandas.DataFrame, numpy.ndarray],
+    result_filepath: Optional[Path],
     use_cache: bool=True,
     perplexity: int=100,
     n_components: int=2,
     max_iterations: int=300,
-    init: str='random'
+    init: str='random',
+    index: Optional[pandas.Index]=None,
+    columns: Optional[List[str]]=None,
 ):
-    if result_filepath.exists() and use_cache:
-        return pandas.read_parquet(result_filepath)
+    matrix, index, columns = get_input_matrix(vector, index, columns)
+    params = dict(perplexity=perplexity, n_components=n_components, max_iterations=max_iterations, init=init)
+
+    def compute(matrix, matrix_hash):
+        # https://scikit-learn.org/stable/modules/generated/sklearn.manifold.TSNE.html
+        return manifold.TSNE(
+            perplexity=perplexity,
+            n_components=n_components,
+            max_iter=max_iterations,
+            init=init,
+        ).fit_transform(matrix)
+
+    return cached_reduction('tsne', compute, matrix, result_filepath, params, use_cache, index, columns)
+
+
+def fft_tsne(
+    vector: Union[pandas.DataFrame, numpy.ndarray],
+    result_filepath: Optional[Path],
+    use_cache: bool=True,
+    perplexity: float=30,
+    n_components: int=2,
+    initialization: str='pca',
+    random_state: int=0,
+    index: Optional[pandas.Index]=None,
+    columns: Optional[List[str]]=None,
+):
+    matrix, index, columns = get_input_matrix(vector, index, columns)
+    params = dict(perplexity=perplexity, n_components=n_components, initialization=initialization, random_state=random_state)
+
+    def compute(matrix, matrix_hash):
+        # https://opentsne.readthedocs.io/en/latest/api/index.html
+        # FFT-interpolated gradients on all of this process's threads; pool workers get their share
+        return openTSNE.TSNE(
+            perplexity=perplexity,
+            n_components=n_components,
+            initialization=initialization,
+            random_state=random_state,
+            negative_gradient_method='fft',
+            n_jobs=get_thread_share(1),
+        ).fit(numpy.ascontiguousarray(matrix, dtype=numpy.float64))
+
+    return cached_reduction('fft-tsne', compute, matrix, result_filepath, params, use_cache, index, columns)
+
+
+def pca(
+    vector: Union[pandas.DataFrame, numpy.ndarray],
+    result_filepath: Optional[Path],
+    use_cache: bool=True,
+    n_components: int=2,
+    index: Optional[pandas.Index]=None,
+    columns: Optional[List[str]]=None,
+):
+    matrix, index, columns = get_input_matrix(vector, index, columns)
+    params = dict(n_components=n_components)
+
+    def compute(matrix, matrix_hash):
+        return reduce_components(matrix, n_components)[0]
+
+    return cached_reduction('pca', compute, matrix, result_filepath, params, use_cache, index, columns)
+
+
+def incremental_umap(
+    vector: Union[pandas.DataFrame, numpy.ndarray],
+    result_filepath: Path,
+    use_cache: bool=True,
+    index: Optional[pandas.Index]=None,
+    columns: Optional[List[str]]=None,
+    roinames: Optional[numpy.ndarray]=None,
+    case_name: Optional[str]=None,
+    group_name: Optional[str]=None,
+    refit_threshold: float=DEFAULT_REFIT_THRESHOLD,
+    **params,
+):
+    # like umap, but reusing the model of earlier runs on this case and group; see update_embedding
     if not result_filepath.parent.exists():
         result_filepath.parent.mkdir(parents=True, exist_ok=True)
+    matrix, index, columns = get_input_matrix(vector, index, columns)
+    group_name = group_name or result_filepath.stem
+    with record('incremental_umap', group=group_name, rows=int(matrix.shape[0]), columns=int(matrix.shape[1])) as entry:
+        try:
+            result = update_embedding(
+                matrix, roinames, case_name, group_name, columns=columns,
+                refit_threshold=refit_threshold, use_cache=use_cache, entry=entry, **params,
+            )
+            df = pandas.DataFrame(result, index=index, columns=['x', 'y'])
+            # every nucleus keeps its own point, so no point is shared by several rows
+            df['multiplicity'] = 1
+            df.to_parquet(result_filepath)
+            return df
+        except Exception as e:
+            entry['error'] = str(e)
+            print(f'Error: {str(e)}. Skipping UMAP evaluation.')
+
+
+def register_reducer(name, func, min_group_size=1, sweep_params=None):
+    """
+    Make a reducer available by name to the CLIs, sweeps and notebooks.
+    `func(matrix, result_filepath, use_cache=..., index=..., columns=..., **params)` returns a DataFrame
+    of x, y coordinates or None. `min_group_size` is the smallest group it can embed with its defaults,
+    and `sweep_params` maps each parameter a sweep may vary to its default value.
+    """
+    REDUCERS[name] = dict(func=func, min_group_size=min_group_size, sweep_params=dict(sweep_params or {}))
+    MIN_GROUP_SIZES[name] = min_group_size
+
+
+def get_reducer(name):
+    if name not in REDUCERS:
+        raise ValueError(f'Unknown reducer "{name}". Registered reducers: {", ".join(REDUCERS)}.')
+    return REDUCERS[name]['func']
+
+
+# UMAP needs more points than output dimensions; scikit-learn TSNE needs more points than its
+# perplexity, and openTSNE more than three times its perplexity
+register_reducer('umap', umap, min_group_size=3, sweep_params=dict(n_neighbors=15, min_dist=0.1))
+register_reducer('tsne', tsne, min_group_size=101, sweep_params=dict(perplexity=100))
+register_reducer('pca', pca, min_group_size=2)
+if openTSNE is not None:
+    register_reducer('fft-tsne', fft_tsne, min_group_size=91, sweep_params=dict(perplexity=30))
+
 
-    print(f'\tEvaluating TSNE for {len(vector)} features... ', end='')
+def get_sweep_configs(reduce_dims_func, **values):
+    # every combination of the given values of the reducer's sweep parameters; the others keep their defaults
+    grid = {
+        param: values.get(param) or [default]
+        for param, default in REDUCERS[reduce_dims_func]['sweep_params'].items()
+    }
+    return [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+
+def get_config_name(params):
+    return ', '.join(f'{k}={v}' for k, v in params.items())
+
+
+def run_sweep_config(reduce_dims_func, matrix, params, use_cache=True, columns=None, knn=None):
+    # a matrix file is reopened memory-mapped, so workers share the page cache instead of a copy
+    if isinstance(matrix, (str, Path)):
+        matrix = numpy.load(matrix, mmap_mode='r')
+    if knn is not None:
+        params = dict(params, knn=knn)
+    result, _ = run_captured(get_reducer(reduce_dims_func), matrix, None, use_cache=use_cache, columns=columns, **params)
+    return result
+
+
+def sweep(
+    matrix: numpy.ndarray,
+    result_filepath: Path,
+    reduce_dims_func: str,
+    configs: List[dict],
+    use_cache: bool=True,
+    index: Optional[pandas.Index]=None,
+    columns: Optional[List[str]]=None,
+    executor=None,
+):
+    """
+    Run one reduction per parameter configuration and write all of them to `result_filepath`,
+    with a config column naming the parameters of each row. With an `executor`, configurations
+    run concurrently in its worker processes. Every configuration reuses the same neighbor graph,
+    and each one is still cached on its own, so a wider grid only computes the new configurations.
+    """
+    matrix, index, columns = get_input_matrix(matrix, index, columns)
+    print(f'\tSweeping {len(configs)} {reduce_dims_func.upper()} configurations for {len(matrix)} features... ', end='')
     start = datetime.now()
-    # https://scikit-learn.org/stable/modules/generated/sklearn.manifold.TSNE.html
-    tsne = manifold.TSNE(
-        perplexity=perplexity,
-        n_components=n_components,
-        max_iter=max_iterations,
-        init=init,
-    )
-    try:
-        result = tsne.fit_transform(vector.to_numpy())
-        df = pandas.DataFrame(
-            result,
-            index=vector.index,
-            columns=[['x', 'y', 'z'][i] for i in range(n_components)]
-        )
-        df.to_parquet(result_filepath)
-        print(f'Completed in {datetime.now() - start} seconds.')
-        return df
-    except Exception as e:
-        print(f'Error: {str(e)}. Skipping TSNE evaluation.')
+    knn = None
+    if reduce_dims_func == 'umap':
+        # the graph is built on the unique rows, which are what each configuration embeds
+        max_neighbors = max(params['n_neighbors'] for params in configs)
+        unique_matrix = matrix[find_duplicate_rows(matrix)[0]]
+        if len(unique_matrix) > max_neighbors:
+            knn = get_knn_graph(unique_matrix, max_neighbors, use_cache=use_cache)[:2]
+    with record('sweep', group=result_filepath.stem, rows=int(matrix.shape[0]), configs=len(configs)):
+        if executor is not None:
+            # workers receive the path of a memory-mapped matrix rather than its contents
+            shared_matrix = getattr(matrix, 'filename', None) or matrix
+            futures = [
+                executor.submit(run_sweep_config, reduce_dims_func, shared_matrix, params, use_cache, columns, knn)
+                for params in configs
+            ]
+            results = [future.result() for future in futures]
+        else:
+            results = [run_sweep_config(reduce_dims_func, matrix, params, use_cache, columns, knn) for params in configs]
+
+    frames = []
+    for params, result in zip(configs, results):
+        if result is not None:
+            result = result.set_axis(index)
+            result['config'] = get_config_name(params)
+            frames.append(result)
+    if not frames:
+        print('Error: every configuration failed.')
+        return None
+    df = pandas.concat(frames)
+    if not result_filepath.parent.exists():
+        result_filepath.parent.mkdir(parents=True, exist_ok=True)
+    df.to_parquet(result_filepath)
+    print(f'Completed in {datetime.now() - start} seconds.')
+    return df
 
 
 # assumes n_components == 2
@@ -101,14 +377,25 @@ def plot_results(
     show=True,
     save=True,
 ):
-    result_items = list(results.items())
+    # sweep results hold one configuration per value of their config column, each in its own subplot
+    result_items = []
+    for result_title, result_data in results.items():
+        if 'config' in result_data.columns:
+            result_items += [
+                (f'{result_title} {config}', config_data)
+                for config, config_data in result_data.groupby('config', sort=False)
+            ]
+        else:
+            result_items.append((result_title, result_data))
     subplots_width = round(math.sqrt(len(result_items)))
     subplots_height = math.ceil(len(result_items) / subplots_width)
+    # squeeze=False keeps a 2D array of axes even for a single result
     fig, subplots = plt.subplots(
         subplots_width,
         subplots_height,
         sharex=True,
         sharey=True,
+        squeeze=False,
     )
     fig.suptitle(title)
 
@@ -120,7 +407,9 @@ def plot_results(
                 x = result_data['x']
                 y = result_data['y']
                 c = cluster_results.get(result_title, None) if cluster_results is not None else None
-                ax.scatter(x, y, c=c, s=2)
+                # rows with identical features share a point; draw it larger instead of overplotting
+                s = 2 * result_data['multiplicity'] if 'multiplicity' in result_data.columns else 2
+                ax.scatter(x, y, c=c, s=s)
                 ax.set_title(result_title)
                 i += 1
     if not PLOTS_FOLDER.exists():
@@ -136,12 +425,16 @@ def main(raw_args=None):
         prog="ReduceDims",
         description="Process feature vectors and optionally upload resulting annotations",
     )
+    parser.add_argument(
+        'command', nargs='?', choices=['reduce', 'sweep'], default='reduce',
+        help='Run one reduction per case, or sweep a grid of reducer parameters per case. Default=reduce.'
+    )
     parser.add_argument(
         '--cases', nargs='*',
         help='List of case names to process. If not specified, process all downloaded cases.'
     )
     parser.add_argument(
-        '--reduce_dims_func', choices=['umap', 'tsne'], default='umap',
+        '--reduce_dims_func', choices=list(REDUCERS), default='umap',
         help='Function to use for dimensionality reduction. Only used if --reduce-dims is specified. Default=umap.'
     )
     parser.add_argument(
@@ -166,7 +459,61 @@ def main(raw_args=None):
     parser.add_argument(
         '--password', type=str, help='Girder password for upload'
     )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Save a cProfile file for each stage next to the run log in TCGA/run_logs.'
+    )
+    parser.add_argument(
+        '--shared', action='store_true',
+        help='Fit one UMAP on a stratified sample of the selected cases and project every case into its shared coordinates.'
+    )
+    parser.add_argument(
+        '--sample-size', type=int, default=DEFAULT_SAMPLE_SIZE,
+        help=f'Number of features to fit the shared UMAP on. Only used if --shared is specified. Default={DEFAULT_SAMPLE_SIZE}.'
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+        help=f'Number of features per transform batch. Only used if --shared is specified. Default={DEFAULT_BATCH_SIZE}.'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of worker processes for --shared transform batches or sweep configurations. Default=1.'
+    )
+    parser.add_argument(
+        '--n-neighbors', nargs='+', type=int,
+        help='UMAP n_neighbors values to sweep. Only used by sweep. Default=15.'
+    )
+    parser.add_argument(
+        '--min-dist', nargs='+', type=float,
+        help='UMAP min_dist values to sweep. Only used by sweep. Default=0.1.'
+    )
+    parser.add_argument(
+        '--perplexity', nargs='+', type=float,
+        help='TSNE perplexity values to sweep. Only used by sweep. Default depends on --reduce_dims_func.'
+    )
+    parser.add_argument(
+        '--pca-components', type=int,
+        help='Project the features onto this many principal components before dimensionality reduction, e.g. 50. If not specified, reduce all features.'
+    )
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Keep the fitted UMAP of each case and only project nuclei it has not seen, e.g. from newly added ROIs.'
+    )
+    parser.add_argument(
+        '--refit-threshold', type=float, default=DEFAULT_REFIT_THRESHOLD,
+        help=f'Refit the incremental UMAP once this share of a case was not in its fit. Only used if --incremental is specified. Default={DEFAULT_REFIT_THRESHOLD}.'
+    )
     args = vars(parser.parse_args(raw_args))
+    if args.get('shared') and args.get('reduce_dims_func') != 'umap':
+        parser.error('--shared requires --reduce_dims_func umap; TSNE cannot transform new data.')
+    if args.get('shared') and args.get('command') == 'sweep':
+        parser.error('--shared can not be combined with sweep.')
+    if args.get('shared') and args.get('pca_components'):
+        parser.error('--pca-components can not be combined with --shared.')
+    if args.get('incremental') and (
+        args.get('reduce_dims_func') != 'umap' or args.get('shared') or args.get('command') == 'sweep' or args.get('pca_components')
+    ):
+        parser.error('--incremental only applies to a UMAP reduction without --shared, sweep or --pca-components.')
 
     cases = args.get('cases')
     reduce_dims_func = args.get('reduce_dims_func')
@@ -176,61 +523,102 @@ def main(raw_args=None):
     upload = args.get('upload')
     username = args.get('username')
     password = args.get('password')
+    shared = args.get('shared')
+    batch_size = args.get('batch_size')
+    workers = args.get('workers')
+    command = args.get('command')
+    start_run('reduce_dims', profile=args.get('profile'))
 
     client = None
     if upload:
         client = get_client(username, password)
 
-    all_results = {}
+    case_names = []
     for case in DOWNLOADS_FOLDER.glob('*'):
         case_name = case.name.split('.')[0]
         if cases is None or case_name in cases:
+            case_names.append(case_name)
+
+    # one pool serves every case, so each worker imports and compiles UMAP only once
+    executor = None
+    if workers > 1 and (shared or command == 'sweep'):
+        executor = get_process_pool(workers)
+
+    if shared:
+        # one model for all cases, fit on a sample that covers every case and class
+        strata = get_strata(case_names)
+        sample_rows = get_stratified_sample(strata, args.get('sample_size'))
+        preprocessor = fit_shared_preprocessor(strata, sample_rows, exclude_column_patterns=exclude_column_patterns)
+        corpus = FeatureCorpus(case_names, use_cache=not no_cache, preprocessor=preprocessor)
+        corpus_index = corpus.index
+        model_file = fit_shared_model(corpus, sample_rows, use_cache=not no_cache)
+
+    all_results = {}
+    for case_name in case_names:
+        with context(case=case_name):
             print(f'Evaluating {case_name}.')
             case_results_folder = REDUCE_DIMS_RESULTS_FOLDER / reduce_dims_func / case_name
             if not case_results_folder.exists():
                 case_results_folder.mkdir(parents=True, exist_ok=True)
 
-            result_file = None
-            result_filename = f'{case_name} {reduce_dims_func.upper()}*.parquet'
-            result_files = list(case_results_folder.glob(result_filename))
-
-            if len(result_files) and not no_cache:
-                result_files.sort()
-                result_file = result_files[0]
+            if shared:
+                result_file = case_results_folder / f'{case_name} SHARED {reduce_dims_func.upper()}.parquet'
+                result = transform_case(
+                    corpus, case_name, model_file,
+                    batch_size=batch_size, executor=executor, max_pending=2 * workers, index=corpus_index,
+                )
+                result.to_parquet(result_file)
             else:
-                # compute dimensionality reduction results
-                result_file = case_results_folder / result_filename.replace('*', f' ({len(result_files)})')
-                vector = get_case_vector(case_name)
-                if exclude_column_patterns is not None:
-                    vector = vector.drop([
-                        c for c in COLUMN_NAMES if any(re.match(fr'{pattern}', c) for pattern in exclude_column_patterns)
-                    ], axis=1, errors='ignore')
-                vector = vector.drop([
-                    c for c in vector.columns
-                    if str(vector[c].dtype) != 'float64'
-                ], axis=1).fillna(-1)
-                normalize(vector, axis=1, norm='l1')
-
-                if reduce_dims_func == 'umap':
-                    umap(vector, result_file, use_cache=not no_cache)
-                elif reduce_dims_func == 'tsne':
-                    tsne(vector, result_file, use_cache=not no_cache)
-
-            if result_file is not None and result_file.exists():
-                all_results[case_name] = pandas.read_parquet(result_file)
+                # the result cache decides whether a matching reduction already exists
+                result_file = case_results_folder / f'{case_name} {reduce_dims_func.upper()}.parquet'
+                matrix, index, columns = get_feature_matrix(
+                    case_name,
+                    exclude_column_patterns=exclude_column_patterns,
+                    use_cache=not no_cache,
+                )
+                matrix = apply_pca(matrix, args.get('pca_components'))
+
+                if command == 'sweep':
+                    result_file = case_results_folder / f'{case_name} {reduce_dims_func.upper()} SWEEP.parquet'
+                    configs = get_sweep_configs(
+                        reduce_dims_func,
+                        n_neighbors=args.get('n_neighbors'),
+                        min_dist=args.get('min_dist'),
+                        perplexity=args.get('perplexity'),
+                    )
+                    result = sweep(
+                        matrix, result_file, reduce_dims_func, configs,
+                        use_cache=not no_cache, index=index.index, columns=columns, executor=executor,
+                    )
+                elif args.get('incremental'):
+                    result = incremental_umap(
+                        matrix, result_file, use_cache=not no_cache, index=index.index, columns=columns,
+                        roinames=index['roiname'].to_numpy(), case_name=case_name, group_name='all',
+                        refit_threshold=args.get('refit_threshold'),
+                    )
+                else:
+                    reduce_func = get_reducer(reduce_dims_func)
+                    result = reduce_func(matrix, result_file, use_cache=not no_cache, index=index.index, columns=columns)
+
+            # a reducer that skipped or failed returns None; a result file from an earlier run is not used
+            if result is not None:
+                all_results[case_name] = result
                 if upload:
                     print(f'Uploading {result_file.name} to Girder.')
-                    case_folder_item = get_case_folder_item(client, case_name)
-                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    sync_file(
-                        client,
-                        case_folder_item,
-                        result_file,
-                        timestamp=timestamp,
-                        exclude_column_patterns=exclude_column_patterns,
-                    )
+                    with record('upload', rows=len(all_results[case_name])):
+                        case_folder_item = get_case_folder_item(client, case_name)
+                        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                        sync_file(
+                            client,
+                            case_folder_item,
+                            result_file,
+                            timestamp=timestamp,
+                            exclude_column_patterns=exclude_column_patterns,
+                        )
 
-    if plot:
+    if executor is not None:
+        executor.shutdown()
+    if plot and all_results:
         plot_results(all_results)
 
 
@@ -0,0 +1,26 @@
+from .parallel import get_process_pool, run_captured
+
+
+def schedule_tasks(tasks, workers=1):
+    """
+    Run independent tasks, starting with the largest, and return {name: (result, log)}.
+    `tasks` maps each name to a (size, func, args, kwargs) tuple. With more than one worker,
+    tasks run in a process pool; since the pool starts tasks in submission order, the largest
+    tasks never end up waiting behind the small ones. Each task's output is captured so the
+    caller can print logs in its own order.
+    """
+    order = sorted(tasks, key=lambda name: tasks[name][0], reverse=True)
+    results = {}
+    if workers is not None and workers > 1 and len(order) > 1:
+        with get_process_pool(min(workers, len(order))) as executor:
+            futures = {}
+            for name in order:
+                _, func, args, kwargs = tasks[name]
+                futures[name] = executor.submit(run_captured, func, *args, **kwargs)
+            for name, future in futures.items():
+                results[name] = future.result()
+    else:
+        for name in order:
+            _, func, args, kwargs = tasks[name]
+            results[name] = run_captured(func, *args, **kwargs)
+    return results
@@ -0,0 +1,101 @@
+import numpy
+import pandas
+import pyarrow
+
+from .constants import CLASS_PREFIX, COLUMN_NAMES
+
+# column roles follow the groups documented in column_descriptions.txt
+LABEL_COLUMNS = [
+    c for c in COLUMN_NAMES
+    if c in ('slide', 'roiname') or c.endswith('Classif.StandardClass') or c.endswith('Classif.SuperClass')
+]
+IDENTIFIER_COLUMNS = [c for c in COLUMN_NAMES if 'Identifier.' in c]
+CLASS_COLUMNS = [c for c in COLUMN_NAMES if CLASS_PREFIX in c]
+CLASS_NAMES = [c.replace(CLASS_PREFIX, '') for c in CLASS_COLUMNS]
+# identifiers are integers, except the intensity weighted centroids
+INTEGER_COLUMNS = [c for c in IDENTIFIER_COLUMNS if 'Weighted' not in c]
+# CSV types of the known columns, so parsing does not depend on the values in the first block
+CSV_COLUMN_TYPES = {
+    c: pyarrow.string() if c in LABEL_COLUMNS else pyarrow.int64() if c in INTEGER_COLUMNS else pyarrow.float64()
+    for c in COLUMN_NAMES
+}
+
+
+def is_label_column(vector, column):
+    dtype = vector[column].dtype
+    return (
+        column in LABEL_COLUMNS or
+        isinstance(dtype, pandas.CategoricalDtype) or
+        pandas.api.types.is_string_dtype(dtype)
+    )
+
+
+def apply_schema(vector):
+    """
+    Convert a vector read with inferred dtypes to its compact typed form:
+    float features become float32, string labels become categoricals,
+    and integer columns (such as the identifiers) are downcast to the smallest integer type.
+    """
+    typed = {}
+    for column in vector.columns:
+        values = vector[column]
+        if is_label_column(vector, column):
+            typed[column] = values.astype('category')
+        elif pandas.api.types.is_float_dtype(values.dtype):
+            typed[column] = values.astype(numpy.float32)
+        elif pandas.api.types.is_integer_dtype(values.dtype):
+            typed[column] = pandas.to_numeric(values, downcast='integer')
+        else:
+            typed[column] = values
+    return pandas.DataFrame(typed, index=vector.index)
+
+
+def concat_vectors(vectors):
+    # categoricals only survive concatenation when every frame shares the same categories
+    vectors = [v for v in vectors if v is not None]
+    if not len(vectors):
+        return None
+    # ROIs can lack columns, so every column of any ROI is unified
+    for column in dict.fromkeys(c for v in vectors for c in v.columns):
+        first = next(v for v in vectors if column in v.columns)
+        if isinstance(first[column].dtype, pandas.CategoricalDtype):
+            categories = pandas.api.types.union_categoricals(
+                [v[column] for v in vectors if column in v.columns],
+                sort_categories=True,
+            ).categories
+            for v in vectors:
+                if column in v.columns:
+                    v[column] = v[column].cat.set_categories(categories)
+    return pandas.concat(vectors)
+
+
+def to_wide_numpy(values):
+    # compact int16/float32 columns overflow or lose precision in coordinate arithmetic
+    if pandas.api.types.is_integer_dtype(values.dtype):
+        return values.to_numpy(dtype=numpy.int64)
+    return values.to_numpy(dtype=numpy.float64)
+
+
+def get_feature_columns(vector):
+    return [
+        c for c in vector.columns
+        if pandas.api.types.is_float_dtype(vector[c].dtype)
+    ]
+
+
+def get_classifications(vector):
+    """
+    Return the most probable class of each nucleus as a categorical,
+    using a single argmax over the class probability columns.
+    """
+    class_columns = [c for c in CLASS_COLUMNS if c in vector.columns]
+    class_names = numpy.array([c.replace(CLASS_PREFIX, '') for c in class_columns])
+    probabilities = vector[class_columns].to_numpy(dtype=numpy.float32)
+    # idxmax skips missing values; make them lose every comparison instead
+    probabilities = numpy.where(numpy.isnan(probabilities), -numpy.inf, probabilities)
+    codes = numpy.argmax(probabilities, axis=1)
+    # sorted categories keep group order identical to grouping by the class name strings
+    order = numpy.argsort(class_names)
+    ranks = numpy.empty_like(order)
+    ranks[order] = numpy.arange(len(order))
+    return pandas.Categorical.from_codes(ranks[codes], categories=class_names[order])
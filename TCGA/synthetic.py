@@ -0,0 +1,211 @@
+import argparse
+import math
+import shutil
+from datetime import datetime
+
+import numpy
+import pandas
+import pyarrow
+import pyarrow.csv
+
+from .constants import COLUMN_NAMES, DOWNLOADS_FOLDER
+from .parallel import get_process_pool
+from .schema import CLASS_NAMES
+
+# ROIs are 2048px tiles of the slide; nucleus coordinates are stored at half resolution
+ROI_SIZE = 2048
+ROI_SCALE = 2
+# the downloaded test case has about 1200 nuclei per ROI
+NUCLEI_PER_ROI = 1200
+MISSING_FRACTION = 0.01
+
+# relative frequency of each fine-grained class, roughly as in the test case
+CLASS_FREQUENCIES = dict(
+    CancerEpithelium=0.45,
+    StromalCellNOS=0.3,
+    ActiveStromalCellNOS=0.02,
+    TILsCell=0.12,
+    ActiveTILsCell=0.01,
+    NormalEpithelium=0.02,
+    OtherCell=0.02,
+    UnknownOrAmbiguousCell=0.04,
+    BACKGROUND=0.02,
+)
+SUPERCLASSES = dict(
+    CancerEpithelium='EpithelialSuperclass',
+    NormalEpithelium='EpithelialSuperclass',
+    StromalCellNOS='StromalSuperclass',
+    ActiveStromalCellNOS='StromalSuperclass',
+    TILsCell='TILsSuperclass',
+    ActiveTILsCell='TILsSuperclass',
+    OtherCell='OtherSuperclass',
+    UnknownOrAmbiguousCell='AmbiguousSuperclass',
+    BACKGROUND='BACKGROUND',
+)
+SUPERCLASS_NAMES = list(dict.fromkeys(SUPERCLASSES.values()))
+
+# nucleiMeta holds everything up to the ROI name; nucleiProps repeats the keys and holds the features
+META_COLUMNS = COLUMN_NAMES[:COLUMN_NAMES.index('roiname') + 1]
+PROPS_COLUMNS = ['Identifier.ObjectCode', 'slide', 'roiname'] + COLUMN_NAMES[COLUMN_NAMES.index('roiname') + 1:]
+FEATURE_COLUMNS = [
+    c for c in PROPS_COLUMNS[3:]
+    if not c.startswith('Identifier.') and c not in ('Size.MajorAxisLength', 'Size.MinorAxisLength', 'Orientation.Orientation')
+]
+
+
+def get_slide_name(case_name):
+    return f'{case_name}-01Z-00-DX1'
+
+
+def get_roi_names(case_name, n_rois):
+    # tile ROIs row by row over a square grid, like ROIs cut from one slide
+    slide_name = get_slide_name(case_name)
+    columns = math.ceil(math.sqrt(n_rois))
+    roi_names = []
+    for i in range(n_rois):
+        left = (i % columns) * ROI_SIZE
+        top = (i // columns) * ROI_SIZE
+        roi_names.append(
+            f'{slide_name}_roi-{i}_left-{left}_top-{top}_right-{left + ROI_SIZE}_bottom-{top + ROI_SIZE}'
+        )
+    return roi_names
+
+
+def get_class_means(seed):
+    # every class gets its own feature profile, so reductions and clusters have structure to find
+    rng = numpy.random.default_rng(seed)
+    return rng.normal(0, 1, (len(CLASS_NAMES), len(FEATURE_COLUMNS)))
+
+
+def get_probabilities(rng, classes, confidence):
+    probabilities = rng.dirichlet(numpy.ones(len(CLASS_NAMES)), len(classes))
+    probabilities[numpy.arange(len(classes)), classes] += confidence
+    return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+
+def get_superclass_probabilities(probabilities):
+    return numpy.stack([
+        probabilities[:, [i for i, c in enumerate(CLASS_NAMES) if SUPERCLASSES[c] == superclass]].sum(axis=1)
+        for superclass in SUPERCLASS_NAMES
+    ], axis=1)
+
+
+def generate_roi_vector(case_name, roi_name, n_nuclei, seed, class_means):
+    """Return a vector of `n_nuclei` random nuclei for one ROI, with every column of COLUMN_NAMES."""
+    rng = numpy.random.default_rng(seed)
+    frequencies = numpy.array([CLASS_FREQUENCIES[c] for c in CLASS_NAMES])
+    classes = rng.choice(len(CLASS_NAMES), n_nuclei, p=frequencies / frequencies.sum())
+    columns = {}
+
+    # location and shape, in ROI coordinates at half resolution
+    centroid_x = rng.uniform(0, ROI_SIZE / ROI_SCALE, n_nuclei)
+    centroid_y = rng.uniform(0, ROI_SIZE / ROI_SCALE, n_nuclei)
+    major_axis = rng.gamma(9, 1.2, n_nuclei) + 2
+    minor_axis = major_axis * rng.uniform(0.5, 1, n_nuclei)
+    radius = major_axis / 2
+    for prefix in ('', 'Unconstrained.'):
+        columns[f'{prefix}Identifier.Xmin'] = numpy.maximum(centroid_x - radius, 0).astype(int)
+        columns[f'{prefix}Identifier.Ymin'] = numpy.maximum(centroid_y - radius, 0).astype(int)
+        columns[f'{prefix}Identifier.Xmax'] = (centroid_x + radius).astype(int)
+        columns[f'{prefix}Identifier.Ymax'] = (centroid_y + radius).astype(int)
+        columns[f'{prefix}Identifier.CentroidX'] = centroid_x.astype(int)
+        columns[f'{prefix}Identifier.CentroidY'] = centroid_y.astype(int)
+    columns['Identifier.ObjectCode'] = numpy.arange(1, n_nuclei + 1)
+    columns['Identifier.WeightedCentroidX'] = centroid_x + rng.normal(0, 0.5, n_nuclei)
+    columns['Identifier.WeightedCentroidY'] = centroid_y + rng.normal(0, 0.5, n_nuclei)
+    columns['Size.MajorAxisLength'] = major_axis
+    columns['Size.MinorAxisLength'] = minor_axis
+    columns['Orientation.Orientation'] = rng.uniform(-math.pi / 2, math.pi / 2, n_nuclei)
+
+    # classifications; the unconstrained model is a noisier version of the constrained one
+    for prefix, confidence in (('', 2), ('Unconstrained.', 1)):
+        probabilities = get_probabilities(rng, classes, confidence)
+        superclass_probabilities = get_superclass_probabilities(probabilities)
+        columns[f'{prefix}Classif.StandardClass'] = numpy.array(CLASS_NAMES)[probabilities.argmax(axis=1)]
+        columns[f'{prefix}Classif.SuperClass'] = numpy.array(SUPERCLASS_NAMES)[superclass_probabilities.argmax(axis=1)]
+        for i, class_name in enumerate(CLASS_NAMES):
+            columns[f'{prefix}ClassifProbab.{class_name}'] = probabilities[:, i]
+        for i, superclass in enumerate(SUPERCLASS_NAMES):
+            columns[f'{prefix}SuperClassifProbab.{superclass}'] = superclass_probabilities[:, i]
+    columns['slide'] = numpy.full(n_nuclei, get_slide_name(case_name))
+    columns['roiname'] = numpy.full(n_nuclei, roi_name)
+
+    features = class_means[classes] + rng.normal(0, 1, (n_nuclei, len(FEATURE_COLUMNS)))
+    features[rng.random(features.shape) < MISSING_FRACTION] = numpy.nan
+    for j, column in enumerate(FEATURE_COLUMNS):
+        columns[column] = features[:, j]
+    return pandas.DataFrame({c: columns[c] for c in COLUMN_NAMES})
+
+
+def write_vector_file(vector, filepath):
+    # like DataFrame.to_csv, with an unnamed index column first, but much faster
+    table = pyarrow.Table.from_pandas(vector, preserve_index=False)
+    table = table.add_column(0, '', pyarrow.array(numpy.arange(len(vector))))
+    pyarrow.csv.write_csv(table, filepath)
+
+
+def write_roi(case_name, roi_name, n_nuclei, seed, class_means):
+    case_folder = DOWNLOADS_FOLDER / case_name
+    vector = generate_roi_vector(case_name, roi_name, n_nuclei, seed, class_means)
+    write_vector_file(vector[META_COLUMNS], case_folder / 'nucleiMeta' / f'{roi_name}.csv')
+    write_vector_file(vector[PROPS_COLUMNS], case_folder / 'nucleiProps' / f'{roi_name}.csv')
+    return n_nuclei
+
+
+def generate_case(case_name, n_nuclei, nuclei_per_roi=NUCLEI_PER_ROI, seed=0, workers=1):
+    """
+    Write a synthetic case with `n_nuclei` nuclei to DOWNLOADS_FOLDER/<case_name>, as nucleiMeta and
+    nucleiProps CSV files per ROI. The same arguments always produce the same files.
+    ROIs are generated one at a time, so memory use does not grow with the case size.
+    """
+    n_rois = max(1, math.ceil(n_nuclei / nuclei_per_roi))
+    print(f'Generating {n_nuclei} nuclei in {n_rois} region(s) for {case_name}.')
+    start = datetime.now()
+    case_folder = DOWNLOADS_FOLDER / case_name
+    shutil.rmtree(case_folder, ignore_errors=True)
+    for folder in ('nucleiMeta', 'nucleiProps'):
+        (case_folder / folder).mkdir(parents=True, exist_ok=True)
+
+    roi_names = get_roi_names(case_name, n_rois)
+    roi_sizes = [n_nuclei // n_rois + (i < n_nuclei % n_rois) for i in range(n_rois)]
+    roi_seeds = numpy.random.SeedSequence(seed).generate_state(n_rois)
+    class_means = get_class_means(seed)
+    args = [
+        (case_name, roi_name, int(n), int(roi_seed), class_means)
+        for roi_name, n, roi_seed in zip(roi_names, roi_sizes, roi_seeds)
+    ]
+    if workers is not None and workers > 1 and n_rois > 1:
+        with get_process_pool(min(workers, n_rois)) as executor:
+            list(executor.map(write_roi, *zip(*args)))
+    else:
+        for roi_args in args:
+            write_roi(*roi_args)
+    print(f'Completed in {datetime.now() - start} seconds.')
+    return case_folder
+
+
+def main(raw_args=None):
+    parser = argparse.ArgumentParser(
+        prog="SyntheticCase",
+        description="Generate a synthetic case of HIPS nucleiMeta/nucleiProps CSV files in the downloads folder.",
+    )
+    parser.add_argument('case', help='Name of the case to write. An existing case with this name is replaced.')
+    parser.add_argument('--nuclei', type=int, default=10000, help='Number of nuclei to generate. Default=10000.')
+    parser.add_argument(
+        '--nuclei-per-roi', type=int, default=NUCLEI_PER_ROI,
+        help=f'Number of nuclei in each ROI. Default={NUCLEI_PER_ROI}.'
+    )
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. Default=0.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of ROIs to write in parallel. Default=1.')
+    args = vars(parser.parse_args(raw_args))
+    generate_case(
+        args.get('case'),
+        args.get('nuclei'),
+        nuclei_per_roi=args.get('nuclei_per_roi'),
+        seed=args.get('seed'),
+        workers=args.get('workers'),
+    )
+
+
+if __name__ == '__main__':
+    main()
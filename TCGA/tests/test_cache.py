@@ -0,0 +1,81 @@
+import os
+
+import numpy
+import pandas
+import pytest
+
+from TCGA import cache
+from TCGA.cache import (get_result_key, list_entries, load_result, prune,
+                        store_result)
+from TCGA.reduce_dims import cached_reduction
+
+COLUMNS = ['Size.Area', 'Shape.Extent', 'Nucleus.Intensity.Mean']
+
+
+@pytest.fixture(autouse=True)
+def cache_folder(tmp_path, monkeypatch):
+    # keep cached results out of the package folder
+    monkeypatch.setattr(cache, 'RESULT_CACHE_FOLDER', tmp_path / 'result_cache')
+    return tmp_path / 'result_cache'
+
+
+@pytest.fixture
+def computed():
+    # the inputs each reduction actually computes, rather than loads
+    return []
+
+
+def reduce(matrix, computed, columns=COLUMNS, params=None, result_filepath=None):
+    def compute(matrix, matrix_hash):
+        computed.append(len(matrix))
+        return matrix[:, :2] * 2
+    return cached_reduction('test', compute, matrix, result_filepath, params or dict(scale=2), columns=columns)
+
+
+def get_matrix(seed=0):
+    return numpy.random.default_rng(seed).random((50, 3), dtype=numpy.float32)
+
+
+def test_identical_input_hits(computed, tmp_path):
+    matrix = get_matrix()
+    first = reduce(matrix, computed)
+    second = reduce(matrix.copy(), computed, result_filepath=tmp_path / 'result.parquet')
+    assert computed == [50]
+    pandas.testing.assert_frame_equal(first, second)
+    # a hit is still written to the requested result file
+    pandas.testing.assert_frame_equal(pandas.read_parquet(tmp_path / 'result.parquet'), first)
+
+
+@pytest.mark.parametrize('change', ['params', 'columns', 'content'])
+def test_changed_input_misses(computed, change):
+    matrix = get_matrix()
+    reduce(matrix, computed)
+    if change == 'params':
+        reduce(matrix, computed, params=dict(scale=3))
+    elif change == 'columns':
+        reduce(matrix, computed, columns=COLUMNS[::-1])
+    else:
+        changed = matrix.copy()
+        changed[10, 1] += 1
+        reduce(changed, computed)
+    assert computed == [50, 50]
+    assert len(list_entries()) == 2
+
+
+def test_prune_evicts_least_recently_used(cache_folder):
+    keys = []
+    for i in range(4):
+        matrix = get_matrix(seed=i)
+        key = get_result_key(matrix, COLUMNS, 'test', {})
+        store_result(key, pandas.DataFrame(matrix, columns=COLUMNS), 'test', {}, columns=COLUMNS, max_bytes=None)
+        # entries are used a second apart, oldest first
+        os.utime(cache_folder / f'{key}.json', (1000 + i, 1000 + i))
+        keys.append(key)
+    # loading the oldest entry makes it the most recently used
+    assert load_result(keys[0]) is not None
+
+    sizes = list_entries().set_index('key')['size']
+    removed = prune(max_bytes=int(sizes[[keys[0], keys[3]]].sum()))
+    assert removed == [keys[1], keys[2]]
+    assert sorted(list_entries()['key']) == sorted([keys[0], keys[3]])
+    assert not (cache_folder / f'{keys[1]}.parquet').exists()
@@ -0,0 +1,182 @@
+import numpy
+import pandas
+import pytest
+from scipy import stats
+from sklearn import cluster
+from sklearn.datasets import make_blobs
+from sklearn.metrics import adjusted_rand_score
+
+from TCGA.clustering import (MAX_CLUSTERS, N_AFFINITY_NEIGHBORS, RANDOM_STATE,
+                             SCORE_METHODS, SILHOUETTE_SAMPLE_SIZE,
+                             choose_clusters, find_cluster_distinction_columns,
+                             find_clusters, fit_hdbscan, fit_minibatch_kmeans,
+                             get_anova, get_spectral_maps)
+
+
+@pytest.mark.parametrize('n_clusters', range(2, MAX_CLUSTERS))
+def test_spectral_maps_match_spectral_clustering(n_clusters):
+    data, _ = make_blobs(n_samples=400, centers=n_clusters, cluster_std=2.0, random_state=RANDOM_STATE)
+    # one embedding with the most components serves every number of clusters
+    maps = get_spectral_maps(data, MAX_CLUSTERS - 1)
+    _, labels, _ = cluster.k_means(maps[:, :n_clusters], n_clusters, random_state=RANDOM_STATE, n_init=10)
+
+    expected = cluster.SpectralClustering(
+        n_clusters=n_clusters,
+        affinity='nearest_neighbors',
+        n_neighbors=N_AFFINITY_NEIGHBORS,
+        eigen_solver='arpack',
+        random_state=RANDOM_STATE,
+    ).fit_predict(data)
+    assert adjusted_rand_score(expected, labels) == pytest.approx(1)
+
+
+def get_clustered_values(n_rows=600, n_columns=4, offset=0, seed=0):
+    rng = numpy.random.default_rng(seed)
+    labels = rng.integers(0, 3, n_rows)
+    # the first column differs between clusters, the others are noise
+    values = rng.normal(size=(n_rows, n_columns)) + offset
+    values[:, 0] += labels * 0.3
+    return values, labels
+
+
+def get_expected_anova(values, labels):
+    clusters = numpy.unique(labels[labels >= 0])
+    return [stats.f_oneway(*[values[labels == c, j] for c in clusters]) for j in range(values.shape[1])]
+
+
+@pytest.mark.parametrize('offset', [0, 1e6])
+def test_anova_matches_f_oneway(offset):
+    values, labels = get_clustered_values(offset=offset)
+    # noise rows are left out
+    labels[:20] = -1
+    # chunks smaller than the input accumulate across several passes of the loop
+    f_stats, p_values, effect_sizes = get_anova(values, labels, chunk_size=128)
+    expected = get_expected_anova(values, labels)
+    numpy.testing.assert_allclose(f_stats[0], [e.statistic for e in expected], rtol=1e-6)
+    numpy.testing.assert_allclose(p_values[0], [e.pvalue for e in expected], rtol=1e-6, atol=1e-300)
+    assert ((effect_sizes >= 0) & (effect_sizes <= 1)).all()
+
+
+def test_anova_nan_column():
+    values, labels = get_clustered_values()
+    values[5, 1] = numpy.nan
+    f_stats, p_values, _ = get_anova(values, labels)
+    expected = get_expected_anova(values, labels)
+    # like f_oneway, a missing value makes the column's result NaN without affecting other columns
+    assert numpy.isnan(f_stats[0, 1]) and numpy.isnan(p_values[0, 1])
+    assert numpy.isnan(expected[1].statistic)
+    numpy.testing.assert_allclose(f_stats[0, [0, 2, 3]], [expected[j].statistic for j in (0, 2, 3)], rtol=1e-6)
+
+
+def test_anova_groups():
+    first_values, first_labels = get_clustered_values(seed=1)
+    second_values, second_labels = get_clustered_values(n_rows=300, seed=2)
+    # a group with a single cluster can not be tested
+    third_values, third_labels = get_clustered_values(n_rows=50, seed=3)
+    third_labels[:] = 0
+    codes = numpy.repeat([0, 1, 2], [600, 300, 50])
+    f_stats, p_values, _ = get_anova(
+        numpy.concatenate([first_values, second_values, third_values]),
+        numpy.concatenate([first_labels, second_labels, third_labels]),
+        codes,
+    )
+    for i, (values, labels) in enumerate([(first_values, first_labels), (second_values, second_labels)]):
+        expected = get_expected_anova(values, labels)
+        numpy.testing.assert_allclose(f_stats[i], [e.statistic for e in expected], rtol=1e-6)
+    assert numpy.isnan(f_stats[2]).all() and numpy.isnan(p_values[2]).all()
+
+
+def test_distinction_columns_of_every_group():
+    groups, clusters = [], {}
+    for i, name in enumerate(['first', 'second']):
+        values, labels = get_clustered_values(seed=i)
+        group = pandas.DataFrame(values, columns=[f'Feature.{j}' for j in range(values.shape[1])])
+        if name == 'second':
+            group = group.drop(columns=['Feature.3'])
+        groups.append((name, group))
+        clusters[name] = labels
+    distinctions = find_cluster_distinction_columns(None, None, groups, clusters=clusters, effect_size=True)
+
+    for name, group in groups:
+        expected = get_expected_anova(group.to_numpy(), clusters[name])
+        assert 'Feature.0' in distinctions[name]
+        for column, result in distinctions[name].items():
+            j = list(group.columns).index(column)
+            assert result['f_stat'] == pytest.approx(expected[j].statistic)
+            assert result['p_value'] < 0.05
+    assert 'Feature.3' not in distinctions['second']
+
+
+@pytest.mark.parametrize('max_clusters', [1, 2])
+def test_too_few_max_clusters(max_clusters):
+    data, _ = make_blobs(n_samples=100, centers=3, random_state=RANDOM_STATE)
+    with pytest.raises(ValueError, match='at least 3'):
+        find_clusters(dict(all=pandas.DataFrame(data, columns=['x', 'y'])), max_clusters=max_clusters)
+
+
+def get_blob_labels(n_samples, centers=3):
+    data, labels = make_blobs(n_samples=n_samples, centers=centers, cluster_std=2.0, random_state=RANDOM_STATE)
+    return data, labels
+
+
+@pytest.mark.parametrize('n_samples', [500, SILHOUETTE_SAMPLE_SIZE])
+def test_sampled_silhouette_is_exact_for_small_groups(n_samples):
+    data, labels = get_blob_labels(n_samples)
+    score, interval = SCORE_METHODS['sampled-silhouette'](data, labels)
+    assert interval is None
+    assert score == SCORE_METHODS['silhouette'](data, labels)[0]
+
+
+def test_sampled_silhouette_interval_covers_exact():
+    data, labels = get_blob_labels(int(SILHOUETTE_SAMPLE_SIZE * 1.5))
+    score, interval = SCORE_METHODS['sampled-silhouette'](data, labels)
+    exact, _ = SCORE_METHODS['silhouette'](data, labels)
+    assert 0 < interval < 0.05
+    assert abs(score - exact) <= interval
+
+
+@pytest.mark.parametrize('score_method', list(SCORE_METHODS))
+def test_choose_clusters_direction(score_method):
+    candidates = [(numpy.array([i]), score, None) for i, score in enumerate([0.5, 0.2, 0.9, 0.2])]
+    labels, score, _ = choose_clusters(candidates, score_method)
+    # davies-bouldin is lower for better clusterings, every other score is higher
+    if score_method == 'davies-bouldin':
+        assert score == 0.2 and labels[0] == 1
+    else:
+        assert score == 0.9 and labels[0] == 2
+
+
+@pytest.mark.parametrize('score_method', list(SCORE_METHODS))
+def test_score_methods_find_separated_clusters(score_method):
+    data, _ = make_blobs(n_samples=300, centers=3, cluster_std=1.5, random_state=RANDOM_STATE)
+    labels = find_clusters(dict(all=pandas.DataFrame(data, columns=['x', 'y'])), score_method=score_method)['all']
+    assert len(set(labels)) == 3
+
+
+# three blobs far enough apart that every method should find them
+SEPARATED_CENTERS = [[-10, -10], [0, 10], [10, -10]]
+
+
+def test_minibatch_kmeans_labels():
+    data, expected = make_blobs(n_samples=1000, centers=SEPARATED_CENTERS, cluster_std=1.5, random_state=RANDOM_STATE)
+    # chunks smaller than the group, so the fit and the labels are computed chunk by chunk
+    labels = fit_minibatch_kmeans(data, 3, chunk_size=128)
+    assert labels.shape == (1000,)
+    assert numpy.issubdtype(labels.dtype, numpy.integer)
+    assert set(labels) == {0, 1, 2}
+    assert adjusted_rand_score(expected, labels) > 0.95
+
+
+@pytest.mark.parametrize('sample_size', [None, 500])
+def test_hdbscan_labels(sample_size):
+    data, expected = make_blobs(n_samples=1000, centers=SEPARATED_CENTERS, cluster_std=1.5, random_state=RANDOM_STATE)
+    # points far from every blob are noise
+    outliers = numpy.array([[-60.0, -60.0], [60.0, 60.0], [-60.0, 60.0]])
+    data = numpy.concatenate([data, outliers])
+    kwargs = dict(sample_size=sample_size, chunk_size=128) if sample_size else {}
+    labels = fit_hdbscan(data, **kwargs)
+    assert labels.shape == (len(data),)
+    assert numpy.issubdtype(labels.dtype, numpy.integer)
+    assert adjusted_rand_score(expected, labels[:1000]) > 0.95
+    if sample_size is None:
+        assert (labels[1000:] == -1).all()
@@ -0,0 +1,62 @@
+import numpy
+import pytest
+
+from TCGA import cache, embedding, knn
+from TCGA.embedding import update_embedding
+from TCGA.reduce_dims import incremental_umap, pca
+
+
+@pytest.fixture(autouse=True)
+def models_folder(tmp_path, monkeypatch):
+    # keep models, neighbor graphs and results out of the package folders
+    monkeypatch.setattr(cache, 'RESULT_CACHE_FOLDER', tmp_path / 'result_cache')
+    monkeypatch.setattr(embedding, 'MODELS_FOLDER', tmp_path / 'models')
+    monkeypatch.setattr(knn, 'KNN_CACHE_FOLDER', tmp_path / 'knn_cache')
+    return tmp_path / 'models'
+
+
+def get_case(n_rois, nuclei_per_roi=100, seed=0):
+    rng = numpy.random.default_rng(seed)
+    matrix = rng.normal(size=(n_rois * nuclei_per_roi, 8)).astype(numpy.float32)
+    roinames = numpy.repeat([f'roi-{i}' for i in range(n_rois)], nuclei_per_roi)
+    return matrix, roinames
+
+
+def test_existing_nuclei_keep_coordinates():
+    matrix, roinames = get_case(10)
+    first = update_embedding(matrix[:900], roinames[:900], 'case', 'all', refit_threshold=0.2)
+    entry = {}
+    second = update_embedding(matrix, roinames, 'case', 'all', refit_threshold=0.2, entry=entry)
+    assert entry == dict(new=100, refit=False)
+    numpy.testing.assert_array_equal(second[:900], first)
+    assert numpy.isfinite(second[900:]).all()
+
+
+def test_refit_past_threshold():
+    matrix, roinames = get_case(10)
+    update_embedding(matrix[:500], roinames[:500], 'case', 'all', refit_threshold=0.2)
+    entry = {}
+    update_embedding(matrix, roinames, 'case', 'all', refit_threshold=0.2, entry=entry)
+    assert entry == dict(new=500, refit=True)
+
+
+def test_stale_models_are_pruned(models_folder):
+    matrix, roinames = get_case(3)
+    update_embedding(matrix, roinames, 'case', 'all', n_neighbors=10)
+    update_embedding(matrix, roinames, 'case', 'all-roi', n_neighbors=10)
+    update_embedding(matrix, roinames, 'case', 'all', n_neighbors=15)
+    files = sorted(p.name for p in (models_folder / 'incremental' / 'case').iterdir())
+    # the group "all" keeps only its latest model; another group with a similar name is untouched
+    assert len(files) == 4
+    assert len([f for f in files if f.startswith('all-roi-')]) == 2
+
+
+def test_incremental_result_format(tmp_path):
+    matrix, roinames = get_case(3)
+    result = incremental_umap(
+        matrix, tmp_path / 'result.parquet', roinames=roinames, case_name='case', group_name='all',
+    )
+    # the same columns as the results of the other reducers
+    expected = pca(matrix, None, use_cache=False)
+    assert list(result.columns) == list(expected.columns) == ['x', 'y', 'multiplicity']
+    assert (result['multiplicity'] == 1).all()
@@ -0,0 +1,98 @@
+import os
+
+import numpy
+import pytest
+
+from TCGA import feature_store, synthetic
+from TCGA.feature_store import (build_feature_store, get_partition_path,
+                                get_store_folder, read_feature_store)
+from TCGA.synthetic import (META_COLUMNS, PROPS_COLUMNS, generate_case,
+                            generate_roi_vector, get_class_means,
+                            write_vector_file)
+
+CASE_NAME = 'store-test'
+
+
+@pytest.fixture
+def case_folder(tmp_path, monkeypatch):
+    # write the case and its store to a temporary folder instead of the package
+    monkeypatch.setattr(synthetic, 'DOWNLOADS_FOLDER', tmp_path / 'downloads')
+    monkeypatch.setattr(feature_store, 'DOWNLOADS_FOLDER', tmp_path / 'downloads')
+    monkeypatch.setattr(feature_store, 'FEATURE_STORE_FOLDER', tmp_path / 'feature_store')
+    return generate_case(CASE_NAME, 300, nuclei_per_roi=100)
+
+
+@pytest.fixture
+def written(monkeypatch):
+    # the ROIs each build writes to the store
+    written = []
+    write_roi_partition = feature_store.write_roi_partition
+
+    def record_write(store_folder, roi_name, vector_files):
+        written.append(roi_name)
+        return write_roi_partition(store_folder, roi_name, vector_files)
+    monkeypatch.setattr(feature_store, 'write_roi_partition', record_write)
+    return written
+
+
+def test_unchanged_rois_are_not_rebuilt(case_folder, written):
+    manifest = build_feature_store(CASE_NAME)
+    assert len(written) == 3
+    assert sum(r['rows'] for r in manifest['rois'].values()) == 300
+
+    written.clear()
+    assert build_feature_store(CASE_NAME) == manifest
+    assert written == []
+
+
+def test_touched_roi_is_rebuilt(case_folder, written):
+    manifest = build_feature_store(CASE_NAME)
+    roi_name = list(manifest['rois'])[1]
+    written.clear()
+
+    props_file = case_folder / 'nucleiProps' / f'{roi_name}.csv'
+    stat = props_file.stat()
+    os.utime(props_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    manifest = build_feature_store(CASE_NAME)
+    assert written == [roi_name]
+    assert manifest['rois'][roi_name]['mtimes'][1] == props_file.stat().st_mtime_ns
+
+
+def test_deleted_roi_is_removed(case_folder, written):
+    manifest = build_feature_store(CASE_NAME)
+    roi_name = list(manifest['rois'])[0]
+    partition_path = get_partition_path(get_store_folder(CASE_NAME), roi_name)
+    assert partition_path.exists()
+    written.clear()
+
+    for folder in ('nucleiMeta', 'nucleiProps'):
+        (case_folder / folder / f'{roi_name}.csv').unlink()
+    manifest = build_feature_store(CASE_NAME)
+    assert written == []
+    assert roi_name not in manifest['rois']
+    assert not partition_path.parent.exists()
+    assert len(read_feature_store(CASE_NAME, list(manifest['rois']))) == 200
+
+
+def test_added_roi_columns_are_unioned(case_folder, written, capsys):
+    manifest = build_feature_store(CASE_NAME)
+    written.clear()
+
+    roi_name = 'added-roi'
+    vector = generate_roi_vector(CASE_NAME, roi_name, 50, 1, get_class_means(0))
+    vector['Extra.Feature'] = 1.5
+    write_vector_file(vector[META_COLUMNS], case_folder / 'nucleiMeta' / f'{roi_name}.csv')
+    write_vector_file(vector[PROPS_COLUMNS + ['Extra.Feature']], case_folder / 'nucleiProps' / f'{roi_name}.csv')
+    capsys.readouterr()
+
+    new_manifest = build_feature_store(CASE_NAME)
+    assert written == [roi_name]
+    assert new_manifest['columns'] == manifest['columns'] + ['Extra.Feature']
+    assert f'Columns of {roi_name} differ' in capsys.readouterr().out
+
+    # the ROIs without the column read it as missing
+    vector = read_feature_store(CASE_NAME, list(new_manifest['rois']), columns=['roiname', 'Extra.Feature'])
+    added = (vector['roiname'] == roi_name).to_numpy()
+    assert len(vector) == 350
+    assert (vector['Extra.Feature'][added] == 1.5).all()
+    assert numpy.isnan(vector['Extra.Feature'][~added]).all()
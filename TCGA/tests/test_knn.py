@@ -0,0 +1,65 @@
+import numpy
+import pytest
+from sklearn.neighbors import NearestNeighbors
+
+from TCGA import cache, knn
+from TCGA.knn import get_knn_graph
+from TCGA.reduce_dims import umap
+
+
+@pytest.fixture(autouse=True)
+def cache_folders(tmp_path, monkeypatch):
+    # keep cached graphs and results out of the package folder
+    monkeypatch.setattr(knn, 'KNN_CACHE_FOLDER', tmp_path / 'knn_cache')
+    monkeypatch.setattr(cache, 'RESULT_CACHE_FOLDER', tmp_path / 'result_cache')
+
+
+@pytest.fixture
+def built(monkeypatch):
+    # the number of rows of every graph actually built, rather than loaded
+    sizes = []
+    build_knn_graph = knn.build_knn_graph
+
+    def counting_build(matrix, n_neighbors, metric='euclidean'):
+        sizes.append(len(matrix))
+        return build_knn_graph(matrix, n_neighbors, metric)
+    monkeypatch.setattr(knn, 'build_knn_graph', counting_build)
+    return sizes
+
+
+def get_matrix(n_rows=500, seed=0):
+    return numpy.random.default_rng(seed).random((n_rows, 10), dtype=numpy.float32)
+
+
+def test_second_reduction_reuses_graph(built):
+    matrix = get_matrix()
+    first = umap(matrix, None, n_neighbors=15, min_dist=0.1)
+    # another min_dist misses the result cache, but needs the same neighbors
+    second = umap(matrix, None, n_neighbors=15, min_dist=0.5)
+    assert built == [500]
+    assert first.shape == second.shape == (500, 3)
+    assert len(list(knn.KNN_CACHE_FOLDER.glob('*.npz'))) == 1
+
+
+def test_smaller_n_neighbors_reuses_graph(built):
+    matrix = get_matrix()
+    indices, distances, _ = get_knn_graph(matrix, 15)
+    smaller_indices, smaller_distances, _ = get_knn_graph(matrix.copy(), 5)
+    assert built == [500]
+    numpy.testing.assert_array_equal(smaller_indices, indices[:, :5])
+    numpy.testing.assert_array_equal(smaller_distances, distances[:, :5])
+
+
+@pytest.mark.parametrize('n_rows', [100, 1000])
+def test_small_groups_match_exact_neighbors(n_rows):
+    # UMAP searches groups under 4096 rows exactly, so the approximate graph must be equivalent there
+    n_neighbors = 15
+    matrix = get_matrix(n_rows)
+    indices, distances, _ = get_knn_graph(matrix, n_neighbors, use_cache=False)
+    exact_distances, exact_indices = NearestNeighbors(n_neighbors=n_neighbors).fit(matrix).kneighbors(matrix)
+
+    found = sum(len(set(row) & set(exact_row)) for row, exact_row in zip(indices, exact_indices))
+    assert found / exact_indices.size > 0.99
+    # every row is its own nearest neighbor
+    numpy.testing.assert_array_equal(indices[:, 0], numpy.arange(n_rows))
+    numpy.testing.assert_allclose(distances[:, -1], exact_distances[:, -1], rtol=0.05, atol=1e-5)
@@ -0,0 +1,80 @@
+import numpy
+import pandas
+
+from TCGA.pipeline import FRAME, JSON, LABELS, Pipeline, Stage
+
+
+def get_pipeline(folder, calls, offset=1, scale=2):
+    def make_frame(offset):
+        calls.append('frame')
+        return pandas.DataFrame(dict(value=[offset, offset + 1]))
+
+    def summarize(frame, scale):
+        calls.append('summary')
+        return dict(total=int(frame['value'].sum()) * scale)
+
+    return Pipeline(folder, [
+        Stage('frame', make_frame, params=dict(offset=offset), output=FRAME),
+        Stage('summary', summarize, inputs=['frame'], params=dict(scale=scale), output=JSON),
+    ])
+
+
+def test_unchanged_stages_are_loaded(tmp_path):
+    calls = []
+    assert get_pipeline(tmp_path, calls).get('summary') == dict(total=6)
+    assert calls == ['frame', 'summary']
+
+    calls.clear()
+    pipeline = get_pipeline(tmp_path, calls)
+    assert pipeline.get('summary') == dict(total=6)
+    assert calls == []
+    assert pipeline.computed == []
+
+
+def test_param_change_recomputes_only_its_stage(tmp_path):
+    calls = []
+    get_pipeline(tmp_path, calls).get('summary')
+
+    calls.clear()
+    assert get_pipeline(tmp_path, calls, scale=3).get('summary') == dict(total=9)
+    assert calls == ['summary']
+
+
+def test_input_change_recomputes_downstream_stages(tmp_path):
+    calls = []
+    first = get_pipeline(tmp_path, calls)
+    first.get('summary')
+
+    calls.clear()
+    second = get_pipeline(tmp_path, calls, offset=5)
+    assert second.get('summary') == dict(total=22)
+    assert calls == ['frame', 'summary']
+    assert second.fingerprint('summary') != first.fingerprint('summary')
+
+
+def test_only_latest_artifact_is_kept(tmp_path):
+    calls = []
+    for scale in [2, 3, 4]:
+        pipeline = get_pipeline(tmp_path, calls, scale=scale)
+        pipeline.get('summary')
+    assert [p.name for p in (tmp_path / 'summary').iterdir()] == [pipeline.fingerprint('summary')]
+    assert len(list((tmp_path / 'frame').iterdir())) == 1
+
+
+def test_labels_round_trip(tmp_path):
+    labels = dict(
+        first=numpy.array([0, 1, 1, -1, 2]),
+        second=[3, 3, 0],
+        empty=[],
+    )
+    path = tmp_path / 'labels.parquet'
+    LABELS.save(labels, path)
+    # labels are stored in the smallest integer type that holds them
+    assert pandas.read_parquet(path)['label'].dtype == numpy.int8
+    loaded = LABELS.load(path)
+    assert loaded == dict(first=[0, 1, 1, -1, 2], second=[3, 3, 0], empty=[])
+    assert list(loaded) == list(labels)
+
+    LABELS.save(dict(large=[0, 1000]), path)
+    assert pandas.read_parquet(path)['label'].dtype == numpy.int16
+    assert LABELS.load(path) == dict(large=[0, 1000])
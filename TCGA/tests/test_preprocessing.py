@@ -0,0 +1,98 @@
+import numpy
+import pandas
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import normalize
+
+from TCGA.preprocessing import (FeaturePreprocessor, find_duplicate_rows,
+                                reduce_components)
+
+
+def get_vector(n_rows=50, seed=0):
+    rng = numpy.random.default_rng(seed)
+    vector = pandas.DataFrame(
+        rng.normal(size=(n_rows, 4)),
+        columns=['Size.Area', 'Shape.Extent', 'Identifier.CentroidX', 'Nucleus.Intensity.Mean'],
+    )
+    vector['roiname'] = 'roi-0'
+    vector['Identifier.ObjectCode'] = numpy.arange(n_rows)
+    vector.loc[3, 'Shape.Extent'] = numpy.nan
+    return vector
+
+
+def test_rows_are_l1_normalized():
+    vector = get_vector()
+    preprocessor = FeaturePreprocessor(exclude_column_patterns=['Identifier.*'])
+    matrix = preprocessor.fit_transform(vector)
+    assert preprocessor.columns == ['Size.Area', 'Shape.Extent', 'Nucleus.Intensity.Mean']
+    assert matrix.dtype == numpy.float32
+    numpy.testing.assert_allclose(numpy.abs(matrix).sum(axis=1), 1, rtol=1e-6)
+
+    expected = vector[preprocessor.columns].fillna(preprocessor.fill_value).to_numpy()
+    numpy.testing.assert_allclose(matrix, normalize(expected, norm='l1'), rtol=1e-5)
+
+
+def test_missing_columns_are_filled():
+    vector = get_vector()
+    preprocessor = FeaturePreprocessor(normalize=False).fit(vector)
+    matrix = preprocessor.transform(vector.drop(columns=['Size.Area']))
+    assert (matrix[:, preprocessor.columns.index('Size.Area')] == preprocessor.fill_value).all()
+
+
+def test_json_round_trip(tmp_path):
+    vector = get_vector()
+    preprocessor = FeaturePreprocessor(exclude_column_patterns=['Identifier.*'], exclude_columns=['Shape.Extent'])
+    matrix = preprocessor.fit_transform(vector)
+    preprocessor.save(tmp_path / 'preprocessor.json')
+
+    loaded = FeaturePreprocessor.load(tmp_path / 'preprocessor.json')
+    assert loaded.get_params() == preprocessor.get_params()
+    assert loaded.columns == preprocessor.columns
+    # the loaded transform applies the same columns to another vector
+    numpy.testing.assert_array_equal(loaded.transform(vector), matrix)
+    other = get_vector(seed=1)
+    numpy.testing.assert_array_equal(loaded.transform(other), preprocessor.transform(other))
+
+
+def get_duplicated_matrix(seed=0):
+    rng = numpy.random.default_rng(seed)
+    unique = rng.random((20, 5), dtype=numpy.float32)
+    return unique[rng.integers(0, len(unique), 200)]
+
+
+def test_duplicate_rows_round_trip():
+    matrix = get_duplicated_matrix()
+    # a small chunk size makes groups span several chunks
+    first, groups, counts = find_duplicate_rows(matrix, chunk_size=16)
+    numpy.testing.assert_array_equal(matrix[first][groups], matrix)
+    assert len(first) == len(numpy.unique(matrix, axis=0))
+    assert (groups[first] == numpy.arange(len(first))).all()
+    assert (first == numpy.sort(first)).all()
+    assert counts.sum() == len(matrix)
+    numpy.testing.assert_array_equal(counts, numpy.bincount(groups))
+
+
+def test_duplicate_rows_hash_collision(monkeypatch):
+    # every row hashes alike, so the comparison with the first row of the group must fail
+    def collide(frame, index=False):
+        return pandas.Series(numpy.zeros(len(frame), dtype=numpy.uint64))
+    monkeypatch.setattr(pandas.util, 'hash_pandas_object', collide)
+
+    matrix = get_duplicated_matrix()
+    first, groups, counts = find_duplicate_rows(matrix, chunk_size=16)
+    numpy.testing.assert_array_equal(first, numpy.arange(len(matrix)))
+    numpy.testing.assert_array_equal(groups, numpy.arange(len(matrix)))
+    assert (counts == 1).all()
+    numpy.testing.assert_array_equal(matrix[first][groups], matrix)
+
+
+def test_chunked_components_match_pca():
+    rng = numpy.random.default_rng(0)
+    # a few dominant directions, so the leading components are well separated
+    matrix = rng.normal(size=(1000, 3)) * [10, 5, 2] @ rng.normal(size=(3, 20)) + rng.normal(size=(1000, 20)) * 0.1
+    result, pca = reduce_components(matrix, 3, chunk_size=128)
+    expected = PCA(n_components=3).fit(matrix)
+    assert result.dtype == numpy.float32
+    numpy.testing.assert_allclose(pca.explained_variance_ratio_, expected.explained_variance_ratio_, rtol=1e-3)
+    # components are only defined up to their sign
+    signs = numpy.sign((result * expected.transform(matrix)).sum(axis=0))
+    numpy.testing.assert_allclose(result * signs, expected.transform(matrix), rtol=1e-3, atol=1e-2)
@@ -7,7 +7,7 @@ BASE_COMMAND = ["python", "-m", "TCGA.process_feature_vectors"]
 
 def test_help():
     output = get_output(*BASE_COMMAND, "-h")
-    assert len(output) == 39
+    assert len(output) == 88
     assert output[0].startswith("usage:")
 
 
@@ -78,7 +78,11 @@ def test_umap_groups(groupby):
     for group_name, feature_count in expected_groups:
         expected_output += [
             f'Evaluating group "{group_name}".',
-            f'Evaluating UMAP for {feature_count} features... Completed in ([\d:.]*) seconds.',
+            (
+                f'Evaluating UMAP for {feature_count} features... Completed in ([\d:.]*) seconds.'
+                if feature_count >= 3 else
+                f'Skipping UMAP for {feature_count} features; at least 3 are required.'
+            ),
         ]
     expected_output += [
         'Done.',
@@ -0,0 +1,72 @@
+import os
+
+import pandas
+import pytest
+from utils import compare_outputs, get_output
+
+CASE_NAME = 'reduce-test'
+
+
+@pytest.fixture
+def data_folder(tmp_path):
+    # write the case, caches and results to a temporary folder instead of the package
+    return tmp_path / 'data'
+
+
+@pytest.fixture
+def data_env(data_folder):
+    env = {**os.environ, 'TCGA_DATA_FOLDER': str(data_folder)}
+    get_output(
+        'python', '-m', 'TCGA.synthetic', CASE_NAME,
+        '--nuclei', '300',
+        '--nuclei-per-roi', '100',
+        env=env,
+    )
+    return env
+
+
+def get_result(data_folder, name):
+    return pandas.read_parquet(data_folder / 'reduce_dims_results' / 'umap' / CASE_NAME / f'{CASE_NAME} {name}.parquet')
+
+
+def test_sweep(data_folder, data_env):
+    output = get_output(
+        'python', '-m', 'TCGA.reduce_dims', 'sweep',
+        '--cases', CASE_NAME,
+        '--n-neighbors', '5', '15',
+        '--min-dist', '0.1',
+        env=data_env,
+    )
+    expected_output = [
+        f'Evaluating {CASE_NAME}.',
+        'Reading features in 3 region\\(s\\).',
+        'Found 300 features.',
+        'Sweeping 2 UMAP configurations for 300 features... Completed in ([\\d:.]*) seconds.',
+    ]
+    compare_outputs(output, expected_output)
+    result = get_result(data_folder, 'UMAP SWEEP')
+    assert list(result.columns) == ['x', 'y', 'multiplicity', 'config']
+    assert result['config'].value_counts().to_dict() == {
+        'n_neighbors=5, min_dist=0.1': 300,
+        'n_neighbors=15, min_dist=0.1': 300,
+    }
+
+
+def test_pca_components(data_folder, data_env):
+    output = get_output(
+        'python', '-m', 'TCGA.reduce_dims',
+        '--cases', CASE_NAME,
+        '--pca-components', '5',
+        env=data_env,
+    )
+    expected_output = [
+        f'Evaluating {CASE_NAME}.',
+        'Reading features in 3 region\\(s\\).',
+        'Found 300 features.',
+        'Reduced ([\\d]*) columns to 5 principal components, explaining ([\\d.]*)% of the variance.',
+        'Evaluating UMAP for 300 features... Completed in ([\\d:.]*) seconds.',
+    ]
+    compare_outputs(output, expected_output)
+    result = get_result(data_folder, 'UMAP')
+    assert list(result.columns) == ['x', 'y', 'multiplicity']
+    assert len(result) == 300
@@ -0,0 +1,63 @@
+import json
+import os
+
+import pytest
+from utils import compare_outputs, get_output
+
+
+@pytest.fixture
+def data_env(tmp_path):
+    # write cases, caches and run logs to a temporary folder instead of the package
+    return {**os.environ, 'TCGA_DATA_FOLDER': str(tmp_path / 'data')}
+
+
+def test_synthetic_case(data_env):
+    output = get_output(
+        'python', '-m', 'TCGA.synthetic', 'synthetic-test',
+        '--nuclei', '2500',
+        '--nuclei-per-roi', '1000',
+        env=data_env,
+    )
+    expected_output = [
+        'Generating 2500 nuclei in 3 region\\(s\\) for synthetic-test.',
+        'Completed in ([\\d:.]*) seconds.',
+    ]
+    compare_outputs(output, expected_output)
+
+    output = get_output(
+        'python', '-m', 'TCGA.process_feature_vectors',
+        '--cases', 'synthetic-test',
+        env=data_env,
+    )
+    expected_output = [
+        'Evaluating synthetic-test.',
+        'Reading features in 3 region\\(s\\).',
+        'Found 2500 features.',
+        'Evaluating group "all".',
+        'Done.',
+    ]
+    compare_outputs(output, expected_output)
+
+
+def test_benchmark(tmp_path, data_env):
+    benchmarks = ['ingest', 'get_case_vector', 'preprocess', 'write_annotation', 'get_ellipses']
+    result_file = tmp_path / 'results.json'
+    output = get_output(
+        'python', '-m', 'TCGA.benchmark', 'run',
+        '--nuclei', '500',
+        '--benchmarks', *benchmarks,
+        '--output', str(result_file),
+        env=data_env,
+    )
+    expected_output = [
+        'Generating 500 nuclei in 1 region\\(s\\) for synthetic-500.',
+        'Completed in ([\\d:.]*) seconds.',
+        'Benchmarking 500 nuclei.',
+        *[f'{benchmark}: ([\\d.]*) seconds.' for benchmark in benchmarks],
+        f'Wrote 5 results to {result_file}.',
+    ]
+    compare_outputs(output, expected_output)
+    with open(result_file) as f:
+        results = json.load(f)['results']
+    assert [r['stage'] for r in results] == benchmarks
+    assert all(r['nuclei'] == 500 for r in results)
@@ -0,0 +1,57 @@
+import importlib.util
+from pathlib import Path
+
+import pandas
+import pytest
+
+from TCGA import cache
+from TCGA.synthetic import generate_roi_vector, get_class_means
+
+# the notebook helpers need the requirements in jupyter/requirements.txt
+pytest.importorskip('ipywidgets')
+pytest.importorskip('large_image')
+pytest.importorskip('plotly')
+
+# the notebooks import the module from their own folder, which is not a package
+UMAP_MANAGER_FILE = Path(__file__).parent.parent.parent / 'jupyter' / 'umap_manager.py'
+spec = importlib.util.spec_from_file_location('umap_manager', UMAP_MANAGER_FILE)
+umap_manager = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(umap_manager)
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'RESULT_CACHE_FOLDER', tmp_path / 'result_cache')
+
+    def read_data(self, data_path):
+        self._raw_data = generate_roi_vector('case', 'roi-0', 200, 0, get_class_means(0))
+    monkeypatch.setattr(umap_manager.UMAPManager, 'read_data', read_data)
+    manager = umap_manager.UMAPManager(tmp_path)
+    manager.compute_density = False
+    return manager
+
+
+def test_reduce_with_returns_coordinates(manager):
+    output = manager.reduce_with('pca')
+    assert output.shape == (200, 2)
+
+
+def test_compare_reductions(manager, monkeypatch):
+    plotted = []
+
+    class Figure():
+        def show(self):
+            pass
+
+    def scatter(data, **kwargs):
+        plotted.append(data)
+        return Figure()
+    monkeypatch.setattr(umap_manager.px, 'scatter', scatter)
+
+    manager.compare_reductions(first=dict(reducer='pca'), second=dict(reducer='pca', n_components=2))
+    data, = plotted
+    assert list(data.columns) == ['x', 'y', 'set']
+    assert data['set'].value_counts().to_dict() == dict(first=200, second=200)
+    pandas.testing.assert_frame_equal(
+        data[data['set'] == 'first'][['x', 'y']], data[data['set'] == 'second'][['x', 'y']],
+    )
@@ -2,9 +2,10 @@ import re
 import subprocess
 
 
-def get_output(*args):
+def get_output(*args, env=None):
     p = subprocess.Popen(
         args,
+        env=env,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
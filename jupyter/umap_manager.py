@@ -14,9 +14,14 @@ import pickle
 
 from IPython.display import display
 from PIL import Image
-from sklearn.preprocessing import normalize
 from scipy.spatial.distance import cdist
 
+# the TCGA package must be importable, see "Run the notebooks" in the README
+from TCGA.clustering import get_coordinates
+from TCGA.knn import get_knn_graph
+from TCGA.preprocessing import FeaturePreprocessor, find_duplicate_rows, normalize_rows
+from TCGA.reduce_dims import REDUCERS, get_reducer
+
 # from https://umap-learn.readthedocs.io/en/latest/api.html
 DEFAULT_UMAP_KWARGS = dict(
     n_neighbors=15,
@@ -72,6 +77,8 @@ class UMAPManager():
         self._compute_density = True
         self._umap_kwargs = DEFAULT_UMAP_KWARGS
         self._umap_transform = None
+        self._preprocessor = None
+        self._features = None
         if data_path is not None:
             self.read_data(data_path)
 
@@ -93,8 +100,14 @@ class UMAPManager():
     def exclude_columns(self, cols):
         if not isinstance(cols, list):
             raise ValueError('exclude_columns must be a list.')
+        if cols != self._exclude_columns:
+            self._preprocessor = self._features = None
         self._exclude_columns = cols
 
+    @property
+    def preprocessor(self):
+        return self._preprocessor
+
     @property
     def class_filters(self):
         return self._class_filters
@@ -127,6 +140,11 @@ class UMAPManager():
 
     @property
     def data(self):
+        self._ensure_preprocessor()
+        return self._features
+
+    def _ensure_preprocessor(self):
+        # select the data and fit the preprocessor on it, unless that was already done
         if self._data is not None:
             data = self._data
         else:
@@ -143,13 +161,18 @@ class UMAPManager():
                 data =  self.compute_density_column(data.reset_index(), full=self._raw_data)
                 data.index = idx
             self._data = data
-        # drop excluded / non-numeric columns
-        data = data.drop([
-            c for c in data.columns
-            if c in self.exclude_columns or
-            str(data[c].dtype) != 'float64'
-        ], axis=1).fillna(-1)
-        return data
+            self._features = None
+        if self._features is None:
+            # drop excluded / non-numeric columns, fill missing values and normalize rows
+            if self._preprocessor is None:
+                self._preprocessor = FeaturePreprocessor(exclude_columns=self.exclude_columns).fit(data)
+            self._features = pd.DataFrame(
+                self._preprocessor.transform(data),
+                index=data.index,
+                columns=self._preprocessor.columns,
+                copy=False,
+            )
+        return self._preprocessor
 
     @property
     def columns(self):
@@ -162,6 +185,7 @@ class UMAPManager():
     def reset(self):
         self._umap_kwargs = DEFAULT_UMAP_KWARGS
         self._umap_transform = None
+        self._preprocessor = self._features = None
         self._exclude_columns = []
         self._sample_size = None
 
@@ -199,8 +223,7 @@ class UMAPManager():
             print('Found no HIPS data.')
 
     def write_data_parquet(self, path):
-        if self._data is None:
-            self.data
+        self._ensure_preprocessor()
         self._data.to_parquet(path)
 
     def save_transform(self, path):
@@ -210,6 +233,18 @@ class UMAPManager():
             pickle.dump(self._umap_transform, f)
         print(f'Saved UMAP Transform to {path}.')
 
+    def save_preprocessor(self, path):
+        if self._preprocessor is None:
+            raise AttributeError('Preprocessor has not been fit yet. Read `data` first.')
+        self._preprocessor.save(path)
+        print(f'Saved preprocessor to {path}.')
+
+    def load_preprocessor(self, path):
+        self._preprocessor = FeaturePreprocessor.load(path)
+        self._exclude_columns = self._preprocessor.exclude_columns
+        self._features = None
+        print(f'Loaded preprocessor from {path}.')
+
     def load_transform(self, path, overwrite=False):
         if self._umap_transform is not None and not overwrite:
             raise AttributeError('UMAP Transform already exists. Pass `overwrite=True` to allow overwrite.')
@@ -220,7 +255,22 @@ class UMAPManager():
     def train_transform(self, input_data):
         print('Training UMAP Transform.')
         start = datetime.now()
-        self._umap_transform = umap.UMAP(**self._umap_kwargs).fit(input_data)
+        umap_kwargs = dict(self._umap_kwargs)
+        # identical rows are fit once; transform_inference still places every row
+        if not umap_kwargs.get('unique'):
+            input_data = input_data[find_duplicate_rows(input_data)[0]]
+        if (
+            umap_kwargs.get('precomputed_knn')[0] is None
+            and isinstance(umap_kwargs.get('metric'), str)
+            and umap_kwargs.get('metric_kwds') is None
+            and len(input_data) > umap_kwargs.get('n_neighbors')
+        ):
+            # reuse the neighbor graph of this data when only other UMAP parameters change;
+            # the search index is kept so the fitted model can still transform new data
+            umap_kwargs['precomputed_knn'] = get_knn_graph(
+                input_data, umap_kwargs.get('n_neighbors'), metric=umap_kwargs.get('metric'), with_index=True,
+            )
+        self._umap_transform = umap.UMAP(**umap_kwargs).fit(input_data)
         print(f'Completed training in {(datetime.now() - start).total_seconds()} seconds.')
 
     def transform_inference(self, input_data):
@@ -236,8 +286,12 @@ class UMAPManager():
             self.exclude_columns = exclude_columns
         self.umap_kwargs = kwargs
         if input_data is None:
-            input_data = self.data
-        input_data = normalize(input_data, axis=1, norm='l1')
+            input_data = self.data.to_numpy()
+        elif isinstance(input_data, pd.DataFrame):
+            # rows taken from self.data are already normalized; normalizing again leaves them unchanged
+            input_data = self._ensure_preprocessor().transform(input_data)
+        else:
+            input_data = normalize_rows(np.array(input_data, dtype=np.float32))
         if self._umap_transform is None:
             self.train_transform(input_data)
         output_data = self.transform_inference(input_data)
@@ -322,12 +376,33 @@ class UMAPManager():
             display(result)
         return result
 
+    @property
+    def reducers(self):
+        return list(REDUCERS)
+
+    def reduce_with(self, reducer, input_data=None, use_cache=True, **params):
+        """
+        Reduce the preprocessed data with a reducer registered in TCGA.reduce_dims, such as 'tsne' or 'pca',
+        through the same result cache as the command line. Return the coordinates as an array.
+        """
+        if input_data is None:
+            input_data = self.data.to_numpy()
+        result = get_reducer(reducer)(input_data, None, use_cache=use_cache, **params)
+        # results also hold the multiplicity of duplicate rows; only the coordinates are returned
+        return get_coordinates(result) if result is not None else None
+
     def compare_reductions(self, **reductions):
         data = None
         max_x = max_y = 0
         min_x = min_y = 9999
         for name, kwarg_set in reductions.items():
-            output = self.reduce_dims(plot=False, **kwarg_set)
+            # a 'reducer' entry selects a registered backend; other sets use this manager's UMAP
+            kwarg_set = dict(kwarg_set)
+            reducer = kwarg_set.pop('reducer', None)
+            if reducer is not None:
+                output = self.reduce_with(reducer, **kwarg_set)
+            else:
+                output = self.reduce_dims(plot=False, **kwarg_set)
             mxx = np.max(output[:, 0])
             if max_x < mxx:
                 max_x = mxx